@@ -15,6 +15,7 @@ import numpy as np
 import pyglet
 import pyglet.gl as gl
 
+from juice                  import backend
 from juice.config           import config
 from juice.gameview         import GameView
 from juice.terrain          import Terrain
@@ -71,6 +72,15 @@ def parse_command_line():
         "-s", "--save", type=str, help="Save a map to file")
     parser.add_argument(
         "-l", "--load", type=str, help="Load a saved map")
+    parser.add_argument(
+        "-b", "--backend", type=str, choices=backend.get_backends(),
+        help="Compute backend for terrain generation (default: {})".format(
+            backend.get_backend())
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of workers for terrain generation, 0 for one per CPU (default: 1)"
+    )
     return parser.parse_args()
 
 def setup_logging(loglevel_str):
@@ -125,6 +135,12 @@ def main():
     setup_logging(args.log_level)
     info("random seed: %d", randseed)
 
+    if (args.backend):
+        backend.set_backend(args.backend)
+    info("compute backend: %s", backend.get_backend())
+
+    backend.set_workers(args.jobs)
+
     if (not args.load):
         terr = generate(args.dimension, randseed)
         if (args.save):
@@ -0,0 +1,197 @@
+
+import concurrent.futures
+import functools
+import multiprocessing.shared_memory
+import os
+
+import numpy as np
+
+from logging import debug, info, warning, error
+
+try:
+    import numba
+    import numba.extending
+except ImportError:
+    numba = None
+
+# Selection of the compute backend for hot loops which do not vectorize
+# cleanly (see juice.kernels). Kernels are written as plain Python operating
+# on numpy arrays and scalars only, so that the same source can be compiled
+# by an optional JIT compiler (numba) when the "jit" backend is active. The
+# "python" backend runs the kernels uncompiled or, where a kernel provides
+# one, a numpy-vectorized equivalent. Both backends produce identical
+# results.
+#
+# Compiled kernels release the GIL, so that work split into independent
+# parts can be spread over a pool of threads; the number of workers is set
+# with set_workers. The python backend runs such work in threads as well, for
+# identical results, but gains no speed from it. Work whose state is mostly
+# read can instead be spread over a pool of processes (see process_pool),
+# which gains speed with either backend, the state being placed in shared
+# memory (see SharedArrays).
+
+BACKEND_PYTHON  = "python"
+BACKEND_JIT     = "jit"
+
+_backend = BACKEND_JIT if numba else BACKEND_PYTHON
+_workers = 1
+
+def get_backends():
+
+    """ Return a tuple of the names of available backends. """
+
+    return (BACKEND_PYTHON, BACKEND_JIT) if numba else (BACKEND_PYTHON,)
+
+def get_backend():
+    return _backend
+
+def set_backend(name):
+
+    """ Select the backend used by all kernels. Raises ValueError for
+    unknown or unavailable backends.
+    """
+
+    global _backend
+
+    if (name not in get_backends()):
+        raise ValueError("Compute backend {} not available (available: {})".format(
+            name, ", ".join(get_backends())))
+
+    debug("Selecting compute backend {}".format(name))
+    _backend = name
+
+def get_workers():
+    return _workers
+
+def set_workers(n):
+
+    """ Set the number of workers (threads or processes) for parallel work,
+    or the number of CPUs if n is 0. Raises ValueError for negative numbers.
+    """
+
+    global _workers
+
+    if (n < 0):
+        raise ValueError("Invalid number of workers: {}".format(n))
+
+    _workers = n or os.cpu_count() or 1
+    debug("Using {} worker(s)".format(_workers))
+
+class _Kernel:
+
+    """ A callable dispatching to the compiled or uncompiled variant of a
+    kernel according to the active backend. Compilation is done lazily on
+    first use.
+    """
+
+    def __init__(self, fn, fallback=None):
+        self._fn = fn
+        self._fallback = fallback or fn
+        self._compiled = None
+
+        functools.update_wrapper(self, fn)
+
+    def __call__(self, *args):
+        if (_backend == BACKEND_JIT):
+            if (not self._compiled):
+                debug("Compiling kernel {}".format(self._fn.__name__))
+                self._compiled = numba.njit(self._fn, nogil=True)
+            return self._compiled(*args)
+
+        return self._fallback(*args)
+
+def helper(fn):
+
+    """ Decorator for plain functions called from kernels. Helpers stay
+    ordinary Python functions, but can also be inlined into compiled
+    kernels.
+    """
+
+    if (numba):
+        return numba.extending.register_jitable(fn)
+    return fn
+
+def kernel(fallback=None):
+
+    """ Decorator for kernel functions. fallback, if passed, is run by the
+    python backend instead of the uncompiled kernel source.
+    """
+
+    def decorator(fn):
+        return _Kernel(fn, fallback)
+
+    return decorator
+
+def process_pool(n, initializer=None, initargs=()):
+
+    """ Return a concurrent.futures.ProcessPoolExecutor of n worker
+    processes, which select the active backend and then call
+    initializer(*initargs), if passed.
+    """
+
+    return concurrent.futures.ProcessPoolExecutor(
+        n, initializer=_init_process, initargs=(_backend, initializer, initargs))
+
+def _init_process(name, initializer, initargs):
+    set_backend(name)
+
+    if (initializer):
+        initializer(*initargs)
+
+class SharedArrays:
+
+    """ Numpy arrays in shared memory, in the `arrays` list. Created from
+    arrays, copies of them are made; worker processes attach to the same
+    memory by passing the specs returned by get_specs instead. The memory is
+    freed once the creating process closes it (also on leaving a with
+    block), and every process which attached has exited or closed it. The
+    arrays must not be used after closing.
+    """
+
+    def __init__(self, arrays=(), specs=None):
+        self._owner = specs is None
+        self._shms = []
+        self.arrays = []
+
+        if (self._owner):
+            specs = [(None, np.shape(a), np.asarray(a).dtype.str) for a in arrays]
+
+        for (i, (name, shape, dtype)) in enumerate(specs):
+            size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+            shm = multiprocessing.shared_memory.SharedMemory(name, create=self._owner, size=size)
+            a = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+            if (self._owner):
+                a[...] = arrays[i]
+
+            self._shms.append(shm)
+            self.arrays.append(a)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_specs(self):
+        return [(shm.name, a.shape, a.dtype.str) for (shm, a) in zip(self._shms, self.arrays)]
+
+    def close(self):
+
+        """ Release the arrays, and free the memory if this process created
+        it. Memory still referenced by arrays elsewhere in the process stays
+        mapped until they are gone.
+        """
+
+        self.arrays = []
+
+        for shm in self._shms:
+            try:
+                shm.close()
+            except BufferError:
+                pass
+
+            if (self._owner):
+                shm.unlink()
+
+        self._shms = []
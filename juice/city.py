@@ -1,5 +1,234 @@
 
+import collections.abc
+import itertools
+
+import numpy as np
+import scipy.spatial
+
 class City:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
+
+    """ A light view of a city held in a CitySet. """
+
+    def __init__(self, cityset, i):
+        self._cityset = cityset
+        self.i = i
+
+    @property
+    def x(self):
+        return int(self._cityset.xs[self.i])
+
+    @property
+    def y(self):
+        return int(self._cityset.ys[self.i])
+
+    def __eq__(self, other):
+        return isinstance(other, City) and (self.x, self.y) == (other.x, other.y)
+
+    def __hash__(self):
+        return hash((self.x, self.y))
+
+    def __repr__(self):
+        return "City({}, {})".format(self.x, self.y)
+
+class CitySet(collections.abc.Sequence):
+
+    """ A set of cities stored as coordinate arrays (xs, ys, in game
+    coordinates), sorted in matrix order (by y, then x), along with a
+    KD-tree spatial index. Indexing yields City views; queries return
+    arrays of city indices.
+
+    Cities can be added and removed in place (see add and remove), which
+    shifts the indices of the cities after them; the spatial index is then
+    rebuilt on the next query needing it.
+    """
+
+    def __init__(self, xs=(), ys=()):
+        self.xs = np.asarray(xs, dtype=np.int64)
+        self.ys = np.asarray(ys, dtype=np.int64)
+
+        order = np.lexsort((self.xs, self.ys))
+        self.xs = self.xs[order]
+        self.ys = self.ys[order]
+
+        # Keys in matrix order for lookups by coordinates, and an ordering by
+        # x for rectangle queries
+
+        self._stride = int(self.xs.max(initial=-1)) + 1
+        self._keys = self.ys * self._stride + self.xs
+        self._by_x = None
+        self._tree = None
+
+    @classmethod
+    def from_matrix(cls, m):
+
+        """ Create a CitySet from the nonzero tiles of a matrix. """
+
+        (ys, xs) = np.nonzero(m)
+        return cls(xs, ys)
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __getitem__(self, i):
+        if (i < 0):
+            i += len(self)
+        if (i < 0 or i >= len(self)):
+            raise IndexError("City index out of range")
+        return City(self, i)
+
+    def get_coords(self):
+
+        """ Return an array of (x, y) coordinates. """
+
+        return np.stack((self.xs, self.ys), axis=1)
+
+    def add(self, x, y):
+
+        """ Add a city at (x, y) in place, keeping matrix order. Returns its
+        index, or that of the city already there.
+        """
+
+        i = self.find(x, y)
+
+        if (i >= 0):
+            return i
+
+        if (x >= self._stride):
+            self._stride = x + 1
+            self._keys = self.ys * self._stride + self.xs
+
+        key = y * self._stride + x
+        i = int(np.searchsorted(self._keys, key))
+
+        self.xs = np.insert(self.xs, i, x)
+        self.ys = np.insert(self.ys, i, y)
+        self._keys = np.insert(self._keys, i, key)
+        self._by_x = None
+        self._tree = None
+
+        return i
+
+    def remove(self, x, y):
+
+        """ Remove the city at (x, y) in place. Returns its former index, or
+        -1 if there is none.
+        """
+
+        i = self.find(x, y)
+
+        if (i < 0):
+            return i
+
+        self.xs = np.delete(self.xs, i)
+        self.ys = np.delete(self.ys, i)
+        self._keys = np.delete(self._keys, i)
+        self._by_x = None
+        self._tree = None
+
+        return i
+
+    def find(self, x, y):
+
+        """ Return the index of the city at (x, y), or -1. """
+
+        if (x < 0 or x >= self._stride):
+            return -1
+
+        i = int(np.searchsorted(self._keys, y * self._stride + x))
+
+        if (i < len(self) and self._keys[i] == y * self._stride + x):
+            return i
+        return -1
+
+    def nearest(self, x, y, k=1):
+
+        """ Return the indices of the k cities nearest to (x, y), nearest
+        first.
+        """
+
+        k = min(k, len(self))
+
+        if (not k):
+            return np.zeros(0, dtype=np.int64)
+
+        idx = self._get_tree().query((x, y), k=k)[1]
+        return np.atleast_1d(idx).astype(np.int64)
+
+    def within(self, x, y, r):
+
+        """ Return the indices of the cities within distance r of (x, y), in
+        ascending order.
+        """
+
+        if (not len(self)):
+            return np.zeros(0, dtype=np.int64)
+
+        return np.array(sorted(self._get_tree().query_ball_point((x, y), r)), dtype=np.int64)
+
+    def in_rect(self, x, y, w, h):
+
+        """ Return the indices of the cities in the rectangle (x, y, w, h),
+        exclusive at x + w and y + h, in ascending order.
+        """
+
+        if (self._by_x is None):
+            self._by_x = np.argsort(self.xs, kind="stable")
+
+        xs = self.xs[self._by_x]
+        i0 = np.searchsorted(xs, x, side="left")
+        i1 = np.searchsorted(xs, x + w, side="left")
+        idx = self._by_x[i0:i1]
+
+        return np.sort(idx[(self.ys[idx] >= y) & (self.ys[idx] < y + h)])
+
+    def thin(self, d):
+
+        """ Thin out cities closer than d to each other, greedily in matrix
+        order: a city is kept unless within distance d of a city kept
+        before it. Returns a boolean mask of kept cities.
+        """
+
+        keep = np.ones(len(self), dtype=bool)
+
+        if (not len(self)):
+            return keep
+
+        pairs = self._get_tree().query_pairs(d, output_type="ndarray")
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        starts = np.searchsorted(pairs[:, 0], np.arange(len(self) + 1))
+
+        for i in range(len(self)):
+            if (keep[i]):
+                keep[pairs[starts[i]:starts[i+1], 1]] = False
+
+        return keep
+
+    def delaunay_edges(self):
+
+        """ Return the edges of the Delaunay triangulation of the cities as
+        an (n, 2) array of index pairs (i < j), in ascending order. If the
+        cities are too few or collinear to triangulate, all pairs are
+        returned instead.
+        """
+
+        if (len(self) < 2):
+            return np.zeros((0, 2), dtype=np.int64)
+
+        try:
+            simplices = scipy.spatial.Delaunay(self.get_coords()).simplices
+        except scipy.spatial.QhullError:
+            return np.array(list(itertools.combinations(range(len(self)), 2)), dtype=np.int64)
+
+        edges = np.concatenate((simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]))
+        edges.sort(axis=1)
+
+        return np.unique(edges, axis=0).astype(np.int64)
+
+    def _get_tree(self):
+
+        """ Return the KD-tree of the cities, building it if needed. """
+
+        if (self._tree is None):
+            self._tree = scipy.spatial.cKDTree(self.get_coords())
+
+        return self._tree
@@ -0,0 +1,155 @@
+
+import collections
+
+from logging import debug, info, warning, error
+
+import numpy as np
+import scipy.signal
+
+FieldSpec = collections.namedtuple("FieldSpec", ["kernel", "masks"])
+
+_CacheEntry = collections.namedtuple("_CacheEntry", ["value", "sources"])
+
+class CityFields:
+
+    """ Smooth fields around the cities of a CityLayer, e.g. the
+    distance-weighted influence of cities or their population density. A
+    field is the convolution of the city point matrix (1 at every city) with
+    a kernel, computed by FFT, and optionally masked (set to 0) over the
+    nonzero tiles of other layers, e.g. the sea and rivers.
+
+    Fields are defined by FieldSpecs (a kernel and a tuple of TerrainLayer
+    types to mask by) in the `field_specs` dict of the CityLayer, keyed by
+    name, and computed on first access through get. They are kept until the
+    city matrix or a mask layer's matrix is replaced (e.g. by regeneration);
+    cities added or removed through CityLayer.add_city / remove_city are
+    applied to cached fields incrementally, by adding or subtracting the
+    kernel around the city.
+
+    Kernels are square matrices of odd side, centered on the city; see
+    linear_kernel and gaussian_kernel.
+    """
+
+    def __init__(self, clayer):
+        self.clayer = clayer
+        self._cache = {}
+
+    @staticmethod
+    def linear_kernel(radius):
+
+        """ Return a kernel falling off linearly from 1 at the center to 0 at
+        distance radius.
+        """
+
+        r = CityFields._kernel_distances(int(radius))
+        return np.maximum(1.0 - r / radius, 0.0)
+
+    @staticmethod
+    def gaussian_kernel(sigma, truncate=3.0):
+
+        """ Return a normalized Gaussian kernel (summing to 1), truncated at
+        truncate standard deviations.
+        """
+
+        r = CityFields._kernel_distances(int(np.ceil(sigma * truncate)))
+        kernel = np.exp(-0.5 * (r / sigma) ** 2)
+
+        return kernel / kernel.sum()
+
+    def get(self, name):
+
+        """ Return a field by name, (re)computing it if absent or stale. """
+
+        spec = self.clayer.field_specs[name]
+        current = self._get_sources(spec)
+        entry = self._cache.get(name)
+
+        if (entry and all(a is b for (a, b) in zip(entry.sources, current))):
+            return entry.value
+
+        debug("Computing city field {}".format(name))
+
+        points = (self.clayer.matrix != 0).astype(np.float64)
+        field = scipy.signal.fftconvolve(points, spec.kernel, mode="same")
+
+        # Clip round-off below zero (kernels are non-negative)
+
+        np.maximum(field, 0.0, out=field)
+        field *= self._get_mask(spec)
+
+        self._cache[name] = _CacheEntry(field, current)
+
+        return field
+
+    def invalidate(self):
+        self._cache.clear()
+
+    def update(self, x, y, sign):
+
+        """ Apply a city added (sign 1) or removed (sign -1) at (x, y) to the
+        cached fields which are still current.
+        """
+
+        for (name, entry) in list(self._cache.items()):
+            spec = self.clayer.field_specs.get(name)
+
+            if (spec is None or any(a is not b for (a, b) in zip(entry.sources, self._get_sources(spec)))):
+                del self._cache[name]
+                continue
+
+            (dst, src) = self._stamp_slices(entry.value.shape, spec.kernel.shape, x, y)
+            field = entry.value
+            field[dst] += sign * spec.kernel[src] * self._get_mask(spec, dst)
+
+            if (sign < 0):
+                np.maximum(field[dst], 0.0, out=field[dst])
+
+    def _get_sources(self, spec):
+
+        """ Return the matrices a field depends on, for staleness checks. """
+
+        terrain = self.clayer.terrain
+        sources = [self.clayer.matrix, spec.kernel]
+
+        for ltype in spec.masks:
+            sources.append(terrain.get_layer_by_type(ltype).matrix)
+
+        return tuple(sources)
+
+    def _get_mask(self, spec, window=(slice(None), slice(None))):
+
+        """ Return the mask of a field (1 where unmasked) over a window. """
+
+        terrain = self.clayer.terrain
+        mask = np.ones(self.clayer.matrix[window].shape, dtype=np.float64)
+
+        for ltype in spec.masks:
+            mask[terrain.get_layer_by_type(ltype).matrix[window] != 0] = 0.0
+
+        return mask
+
+    @staticmethod
+    def _kernel_distances(radius):
+
+        """ Return the distances from the center of a (2 * radius + 1)
+        square.
+        """
+
+        (dy, dx) = np.mgrid[-radius:radius+1, -radius:radius+1]
+        return np.hypot(dx, dy)
+
+    @staticmethod
+    def _stamp_slices(shape, kshape, x, y):
+
+        """ Return slice tuples (dst, src) such that field[dst] is covered by
+        kernel[src] when centered at (x, y).
+        """
+
+        (ky, kx) = (kshape[0] // 2, kshape[1] // 2)
+        (y0, y1) = (max(y - ky, 0), min(y + ky + 1, shape[0]))
+        (x0, x1) = (max(x - kx, 0), min(x + kx + 1, shape[1]))
+
+        return (
+            (slice(y0, y1), slice(x0, x1)),
+            (slice(y0 - y + ky, y1 - y + ky), slice(x0 - x + kx, x1 - x + kx))
+        )
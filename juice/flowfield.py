@@ -0,0 +1,103 @@
+
+from logging import debug, info, warning, error
+
+import numpy as np
+
+from juice.kernels import DX, DY, NO_DIRECTION
+
+class FlowField:
+
+    """ A flow-direction field over a matrix of keys (e.g. heights with a
+    random fractional part for tie-breaking), computed in vectorized passes.
+    Since rivers are line objects connected along tile edges, only edge
+    neighbors are considered (a D4 variant of the usual D8 field).
+
+    For every tile, the four edge directions (N, E, S, W as in
+    TerrainFields.DIRECTIONS) are ranked by the key of the neighbor in that
+    direction, lowest first, with off-map neighbors last. The ranking is
+    packed into the `order` matrix, two bits per rank starting from the
+    least significant bits; see get_direction. The lowest-ranked neighbor is
+    the steepest descent if its key is below the tile's own.
+
+    The `receivers` field (steepest descent direction or NO_DIRECTION for
+    local minima) is computed on first access.
+    """
+
+    NO_DIRECTION = NO_DIRECTION
+
+    # Rows processed at a time when ranking, to bound temporary memory
+
+    CHUNK_ROWS = 512
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.order = self._rank_directions(keys)
+
+        self._receivers = None
+
+    @staticmethod
+    def get_direction(order, rank):
+
+        """ Unpack the direction of given rank from (an element or matrix of)
+        packed orders.
+        """
+
+        return (order >> (2 * rank)) & 3
+
+    @property
+    def receivers(self):
+        if (self._receivers is None):
+            keys = self.keys
+            first = self.get_direction(self.order, 0)
+            lowest = np.full(keys.shape, np.inf)
+
+            for (i, nkeys) in enumerate(self._neighbor_keys(self._pad(keys))):
+                np.copyto(lowest, nkeys, where=(first == i))
+
+            self._receivers = \
+                np.where(lowest < keys, first, self.NO_DIRECTION).astype(np.uint8)
+
+        return self._receivers
+
+    @classmethod
+    def _rank_directions(cls, keys):
+        dim_y = keys.shape[0]
+        padded = cls._pad(keys)
+        order = np.zeros(keys.shape, dtype=np.uint8)
+
+        for y0 in range(0, dim_y, cls.CHUNK_ROWS):
+            y1 = min(y0 + cls.CHUNK_ROWS, dim_y)
+            nkeys = np.stack(tuple(cls._neighbor_keys(padded, y0, y1)))
+
+            # Rank stably, so ties go by direction index
+
+            ranked = np.argsort(nkeys, axis=0, kind="stable").astype(np.uint8)
+
+            for rank in range(4):
+                order[y0:y1] |= ranked[rank] << (2 * rank)
+
+        return order
+
+    @staticmethod
+    def _pad(keys):
+
+        """ Pad keys by one on every side with infinity (off-map), or the
+        largest value of their type for integer keys.
+        """
+
+        if (np.issubdtype(keys.dtype, np.integer)):
+            return np.pad(keys, 1, constant_values=np.iinfo(keys.dtype).max)
+        return np.pad(keys.astype(np.float64), 1, constant_values=np.inf)
+
+    @staticmethod
+    def _neighbor_keys(padded, y0=0, y1=None):
+
+        """ Generate views of the neighbor keys of rows y0 .. y1 in each
+        direction from padded keys.
+        """
+
+        dim_x = padded.shape[1] - 2
+        y1 = padded.shape[0] - 2 if y1 is None else y1
+
+        for (dx, dy) in zip(DX, DY):
+            yield padded[y0+1+dy:y1+1+dy, 1+dx:dim_x+1+dx]
@@ -2,12 +2,17 @@
 import numpy as np
 import scipy.ndimage as ndi
 
+from juice.layerindex import LayerIndex
+
 class GameFieldLayer:
 
     """ A class representing any matrix associated with the game field.
-    Notably subclassed by TerrainLayer. Accessible via [].
+    Notably subclassed by TerrainLayer. Accessible via []. An optional
+    LayerIndex for rectangle queries can be attached with build_index.
     """
 
+    index = None
+
     def __init__(self, matrix_or_dim, fill=0, dtype=np.uint8):
         
         """ Construct a new object by using an existing ndarray or creating a
@@ -24,24 +29,46 @@ class GameFieldLayer:
         """ A generator method to loop over a subset of coordinates of a layer's
         matrix. If skip_zero is true, only positions with a nonzero value are
         returned. If x, y (offsets of a rectangle), w, h (dimensions of a
-        rectangle) are not passed, yields all coordinates.
+        rectangle) are not passed, yields all coordinates; a missing w or h
+        extends the rectangle to the edge of the matrix.
+
+        Note: prefer get_point_arrays for anything but small rectangles.
+        """
+
+        (xs, ys, vs) = self.get_point_arrays(x, y, w, h, skip_zero)
+        yield from zip(xs.tolist(), ys.tolist(), vs.tolist())
+
+    def get_point_arrays(self, x=0, y=0, w=None, h=None, skip_zero=True):
+
+        """ Bulk variant of get_points. Returns a tuple of arrays (xs, ys,
+        values) in game coordinates, ordered row by row. Arguments are as for
+        get_points; if w or h is not passed, the rectangle extends to the
+        edge of the matrix along that dimension.
         """
 
-        it = None
+        window = self.get_window(x, y, w, h)
 
-        if (not w and not h):
-            it = np.nditer(self.matrix, flags=["multi_index"])
+        if (skip_zero):
+            (ys, xs) = np.nonzero(window > 0)
         else:
-            it = np.nditer(self.matrix[y:y+h, x:x+w], flags=["multi_index"])
+            (ys, xs) = np.indices(window.shape).reshape(2, -1)
 
-        while (not it.finished):
-            v = int(it[0])
+        return (xs + x, ys + y, window[ys, xs])
 
-            if (not skip_zero or v > 0):
-                p = it.multi_index
-                yield (x + p[1], y + p[0], v)
+    def get_window(self, x=0, y=0, w=None, h=None):
 
-            it.iternext()
+        """ Return a rectangle of the matrix given in game coordinates as a
+        numpy view (i.e. no copying is done and writes go through to the
+        layer). Note that the view itself is indexed in numpy order, i.e.
+        [y, x] relative to the rectangle's offsets. A rectangle extending
+        beyond the matrix is truncated; if w or h is not passed, it extends
+        to the edge of the matrix along that dimension.
+        """
+
+        y1 = None if h is None else y + h
+        x1 = None if w is None else x + w
+
+        return self.matrix[y:y1, x:x1]
 
     def foreach_neighbor(self, cb, x, y, *extra):
 
@@ -71,6 +98,15 @@ class GameFieldLayer:
 
         return self.foreach_matrix_edge_neighbor(self.matrix, cb, x, y, *extra)
 
+    def build_index(self, values=()):
+
+        """ Create a LayerIndex over the matrix, store it in the `index`
+        attribute and return it. See LayerIndex for values.
+        """
+
+        self.index = LayerIndex(self, values)
+        return self.index
+
     def label_segments(self, min_size=0):
 
         """ Object method variant of label_matrix_segments, operates on
@@ -135,3 +171,6 @@ class GameFieldLayer:
         """ Note the use of game coordinates (translated to numpy coords). """
     
         self.matrix[i[1], i[0]] = v
+
+        if (self.index):
+            self.index.update(i[0], i[1])
@@ -224,7 +224,9 @@ class GameView:
         sprites = []
         batch = pyglet.graphics.Batch()
 
-        for (cx, cy, v) in tilemap.get_points(tile_x, tile_y, tile_w, tile_h, skip_zero=False):
+        points = tilemap.get_point_arrays(tile_x, tile_y, tile_w, tile_h, skip_zero=False)
+
+        for (cx, cy, v) in zip(*(a.tolist() for a in points)):
             xdelta = cx - tile_x
             ydelta = cy - tile_y
             blitx = xdelta * tile_dim
@@ -0,0 +1,1185 @@
+
+import heapq
+import math
+
+import numpy as np
+
+from juice.backend import helper, kernel
+
+# Kernels for the scalar hot loops of terrain generation. Kernels must stay
+# within the subset of Python understood by the JIT compiler: numpy arrays,
+# scalars, tuples and homogeneous lists only, no closures or Python objects.
+# Coordinates are passed in game order (x, y), matrices are indexed [y, x].
+
+# Edge neighbor offsets in the order N, E, S, W (see TerrainFields.DIRECTIONS)
+
+DX = (0, 1, 0, -1)
+DY = (-1, 0, 1, 0)
+
+NO_DIRECTION = 0xFF
+
+# Number of priority sublevels per height in priority_flood
+
+FLOOD_SUBLEVELS = 16
+
+# Lookup table entries of classify_tiles other than tile types: tiles left
+# as they are and illegal tiles to be removed
+
+TT_KEEP     = -1
+TT_ILLEGAL  = -2
+
+@kernel()
+def trace_rivers(matrix, smatrix, order, steps, occupancy, xs, ys, ids, ok, keep, path, path_ends, start):
+
+    """ Trace rivers into matrix from each source (xs[i], ys[i]) in turn,
+    starting at index start, using river ID ids[i]; see
+    RiverLayer._trace_rivers for the rules. order holds the packed neighbor
+    rankings of a FlowField: of the suitable edge neighbors, the
+    lowest-ranked one is followed. For every river tile, steps records the
+    direction to the next tile (NO_DIRECTION at the river's end); a failed
+    river is removed by following its steps from the source. occupancy holds
+    the number of river edge neighbors of each tile and is maintained as
+    tiles are added and removed. If keep is false, every river is removed
+    again after tracing (used for speculative tracing).
+
+    Successes are written to ok. The flat indices (y * dim + x) of the tiles
+    visited by river i are recorded in path, ending at path_ends[i]. Returns
+    the index of the first river not traced for lack of space in path (the
+    river is removed), or len(ids) when done.
+    """
+
+    dim = matrix.shape[0]
+    p = path_ends[start-1] if start > 0 else 0
+
+    for i in range(start, len(ids)):
+        x = xs[i]
+        y = ys[i]
+        river_id = ids[i]
+        n_own_nbrs = 0
+        prev = 0
+        full = False
+
+        path_ends[i] = p
+
+        # The source itself and its edge neighbors must be free of rivers
+
+        if (matrix[y, x] != 0 or occupancy[y, x] > 0):
+            continue
+
+        if (p >= len(path)):
+            return i
+
+        while (True):
+            prev = matrix[y, x]
+            matrix[y, x] = river_id
+            path[p] = y * dim + x
+            p += 1
+
+            if (prev == 0):
+                for d in range(4):
+                    nx = x + DX[d]
+                    ny = y + DY[d]
+
+                    if (nx >= 0 and ny >= 0 and nx < dim and ny < dim):
+                        occupancy[ny, nx] += 1
+
+            # End upon reaching the sea (the river tile is used for DeltaLayer
+            # generation and removed therein) or converging with another
+            # river. Apart from the source, a river tile has exactly one edge
+            # neighbor of its own river, the previous tile.
+
+            if (smatrix[y, x] > 0 or occupancy[y, x] > n_own_nbrs):
+                ok[i] = True
+                break
+
+            # A neighbor is suitable if it is not part of this river and not
+            # more than one of its own edge neighbors (i.e. the current
+            # position) are. Only neighbors with several river neighbors need
+            # to be checked for the latter.
+
+            best_d = NO_DIRECTION
+
+            for rank in range(4):
+                d = (order[y, x] >> (2 * rank)) & 3
+                nx = x + DX[d]
+                ny = y + DY[d]
+
+                if (nx < 0 or ny < 0 or nx >= dim or ny >= dim):
+                    continue
+                elif (matrix[ny, nx] == river_id):
+                    continue
+
+                n_river_nbrs = 0
+
+                if (occupancy[ny, nx] > 1):
+                    for e in range(4):
+                        ex = nx + DX[e]
+                        ey = ny + DY[e]
+
+                        if (ex >= 0 and ey >= 0 and ex < dim and ey < dim):
+                            if (matrix[ey, ex] == river_id):
+                                n_river_nbrs += 1
+
+                if (n_river_nbrs <= 1):
+                    best_d = d
+                    break
+
+            if (best_d == NO_DIRECTION):
+                break
+            elif (p >= len(path)):
+                full = True
+                break
+
+            steps[y, x] = best_d
+            x += DX[best_d]
+            y += DY[best_d]
+            n_own_nbrs = 1
+
+        path_ends[i] = p
+
+        if (ok[i] and keep and not full):
+            continue
+
+        # Remove the river. Only its end may have been a tile of another
+        # river (upon converging), which is restored.
+
+        x = xs[i]
+        y = ys[i]
+
+        while (True):
+            d = steps[y, x]
+            steps[y, x] = NO_DIRECTION
+
+            if (d == NO_DIRECTION):
+                matrix[y, x] = prev
+            else:
+                matrix[y, x] = 0
+
+            if (matrix[y, x] == 0):
+                for e in range(4):
+                    ex = x + DX[e]
+                    ey = y + DY[e]
+
+                    if (ex >= 0 and ey >= 0 and ex < dim and ey < dim):
+                        occupancy[ey, ex] -= 1
+
+            if (d == NO_DIRECTION):
+                break
+
+            x += DX[d]
+            y += DY[d]
+
+        if (full):
+            ok[i] = False
+            return i
+
+    return len(ids)
+
+@kernel()
+def merge_rivers(matrix, snapshot, steps, occupancy, ids, ok, path, path_ends, start):
+
+    """ Replay rivers traced speculatively (see trace_rivers) against
+    snapshot, a copy of matrix taken beforehand, into matrix in order,
+    starting at index start. A river's path stays valid as long as no tile
+    within two edge steps of it, i.e. nothing its tracing depended on, has
+    changed since the snapshot; failed rivers are checked likewise. Returns
+    the index of the first river whose path is not valid (to be traced
+    again), or len(ids) when done.
+    """
+
+    dim = matrix.shape[0]
+
+    for i in range(start, len(ids)):
+        p0 = path_ends[i-1] if i > 0 else 0
+        p1 = path_ends[i]
+
+        for p in range(p0, p1):
+            y = path[p] // dim
+            x = path[p] % dim
+
+            for dy in range(-2, 3):
+                r = 2 - abs(dy)
+
+                for dx in range(-r, r + 1):
+                    nx = x + dx
+                    ny = y + dy
+
+                    if (nx >= 0 and ny >= 0 and nx < dim and ny < dim):
+                        if (matrix[ny, nx] != snapshot[ny, nx]):
+                            return i
+
+        if (not ok[i]):
+            continue
+
+        for p in range(p0, p1):
+            y = path[p] // dim
+            x = path[p] % dim
+
+            if (matrix[y, x] == 0):
+                for d in range(4):
+                    nx = x + DX[d]
+                    ny = y + DY[d]
+
+                    if (nx >= 0 and ny >= 0 and nx < dim and ny < dim):
+                        occupancy[ny, nx] += 1
+
+            matrix[y, x] = ids[i]
+
+            if (p + 1 < p1):
+                delta = path[p+1] - path[p]
+
+                for d in range(4):
+                    if (delta == DY[d] * dim + DX[d]):
+                        steps[y, x] = d
+
+    return len(ids)
+
+@kernel()
+def priority_flood(hmatrix, fractions, seeds, filled, order):
+
+    """ Fill depressions in hmatrix (of heights 0 .. 255) by priority-flood,
+    starting from the tiles set in seeds (outlets, e.g. the sea). Tiles are
+    visited lowest first; a tile reached from a higher filled tile is raised
+    to its height and visited before moving on to higher tiles (Barnes et
+    al., "Priority-flood: an optimal depression-filling and watershed-
+    labeling algorithm"). As heights are bytes, the priority queue is a set
+    of FIFO buckets, FLOOD_SUBLEVELS per height, the sublevel chosen by
+    fractions (values in [0, 1)) for random tie-breaking.
+
+    The raised heights are written to filled (which must be initialized to
+    -1), the visiting sequence number of each tile to order. Every tile is
+    thus reached from a neighbor with a lower order, i.e. following the
+    lowest order downhill always leads to an outlet. Seeds not adjacent to
+    another tile get an order of -1. Returns the number of tiles visited.
+    """
+
+    (dim_y, dim_x) = hmatrix.shape
+    n_buckets = 256 * FLOOD_SUBLEVELS
+
+    # Buckets are linked lists of tile indices
+
+    heads = np.full(n_buckets, -1, dtype=np.int64)
+    tails = np.full(n_buckets, -1, dtype=np.int64)
+    links = np.empty(dim_y * dim_x, dtype=np.int64)
+    bucket = 0
+    n = 0
+
+    for y in range(dim_y):
+        for x in range(dim_x):
+            if (seeds[y, x]):
+                filled[y, x] = hmatrix[y, x]
+                order[y, x] = -1
+
+    for y in range(dim_y):
+        for x in range(dim_x):
+            if (not seeds[y, x]):
+                continue
+
+            for d in range(4):
+                nx = x + DX[d]
+                ny = y + DY[d]
+
+                if (nx >= 0 and ny >= 0 and nx < dim_x and ny < dim_y and not seeds[ny, nx]):
+                    b = hmatrix[y, x] * FLOOD_SUBLEVELS + int(fractions[y, x] * FLOOD_SUBLEVELS)
+                    i = y * dim_x + x
+
+                    links[i] = -1
+
+                    if (tails[b] >= 0):
+                        links[tails[b]] = i
+                    else:
+                        heads[b] = i
+                    tails[b] = i
+                    break
+
+    while (bucket < n_buckets):
+        if (heads[bucket] < 0):
+            bucket += 1
+            continue
+
+        i = heads[bucket]
+        heads[bucket] = links[i]
+
+        if (heads[bucket] < 0):
+            tails[bucket] = -1
+
+        y = i // dim_x
+        x = i % dim_x
+
+        order[y, x] = n
+        n += 1
+
+        for d in range(4):
+            nx = x + DX[d]
+            ny = y + DY[d]
+
+            if (nx < 0 or ny < 0 or nx >= dim_x or ny >= dim_y):
+                continue
+            elif (filled[ny, nx] >= 0):
+                continue
+
+            # Tiles in a depression go to the current bucket, others to the
+            # bucket of their height
+
+            if (hmatrix[ny, nx] <= filled[y, x]):
+                filled[ny, nx] = filled[y, x]
+                b = bucket
+            else:
+                filled[ny, nx] = hmatrix[ny, nx]
+                b = hmatrix[ny, nx] * FLOOD_SUBLEVELS + int(fractions[ny, nx] * FLOOD_SUBLEVELS)
+
+            j = ny * dim_x + nx
+            links[j] = -1
+
+            if (tails[b] >= 0):
+                links[tails[b]] = j
+            else:
+                heads[b] = j
+            tails[b] = j
+
+    return n
+
+@kernel()
+def poisson_disk(xs, ys, order, d, n_max, dim):
+
+    """ Visit candidate tiles (xs[i], ys[i]) on a dim x dim map in the given
+    order, accepting each one farther than d from all tiles accepted so far,
+    until n_max are accepted. Accepted tiles are kept in a background grid
+    of cells of side d / sqrt(2), holding at most one tile each, so that
+    only the cells within d of a candidate need to be checked. Returns the
+    indices of the accepted candidates.
+    """
+
+    cell = max(d / math.sqrt(2.0), 1.0)
+    reach = int(math.ceil(d / cell))
+    gdim = int(dim / cell) + 1
+    grid = np.full((gdim, gdim), -1, dtype=np.int64)
+    accepted = np.zeros(n_max, dtype=np.int64)
+    n = 0
+
+    for k in range(len(order)):
+        if (n >= n_max):
+            break
+
+        i = order[k]
+        gx = int(xs[i] / cell)
+        gy = int(ys[i] / cell)
+        free = True
+
+        for cy in range(max(gy - reach, 0), min(gy + reach + 1, gdim)):
+            for cx in range(max(gx - reach, 0), min(gx + reach + 1, gdim)):
+                j = grid[cy, cx]
+
+                if (j >= 0 and (xs[j] - xs[i]) ** 2 + (ys[j] - ys[i]) ** 2 <= d * d):
+                    free = False
+
+        if (free):
+            grid[gy, gx] = i
+            accepted[n] = i
+            n += 1
+
+    return accepted[:n]
+
+@helper
+def heap_grow(keys, values):
+
+    """ Return copies of the arrays of a heap (see heap_push) with twice the
+    room.
+    """
+
+    n = len(keys)
+    grown_keys = np.empty(2 * n, dtype=keys.dtype)
+    grown_values = np.empty(2 * n, dtype=values.dtype)
+    grown_keys[:n] = keys
+    grown_values[:n] = values
+
+    return (grown_keys, grown_values)
+
+@helper
+def heap_push(keys, values, n, key, value):
+
+    """ Push onto a binary min-heap of n (key, value) pairs stored in arrays,
+    which must have room for another pair (see heap_grow). Returns n + 1.
+    """
+
+    i = n
+
+    while (i > 0):
+        parent = (i - 1) // 2
+
+        if (keys[parent] <= key):
+            break
+
+        keys[i] = keys[parent]
+        values[i] = values[parent]
+        i = parent
+
+    keys[i] = key
+    values[i] = value
+
+    return n + 1
+
+@helper
+def heap_pop(keys, values, n):
+
+    """ Pop the pair with the lowest key off a heap built by heap_push.
+    Returns (key, value, n).
+    """
+
+    key = keys[0]
+    value = values[0]
+    n -= 1
+    last_key = keys[n]
+    last_value = values[n]
+    i = 0
+
+    while (True):
+        child = 2 * i + 1
+
+        if (child >= n):
+            break
+        elif (child + 1 < n and keys[child+1] < keys[child]):
+            child += 1
+
+        if (last_key <= keys[child]):
+            break
+
+        keys[i] = keys[child]
+        values[i] = values[child]
+        i = child
+
+    keys[i] = last_key
+    values[i] = last_value
+
+    return (key, value, n)
+
+@kernel()
+def astar(weights, elev_deltas, roads, road_dist, distm, preds, touched, path,
+        sx, sy, ex, ey, mp_road, mp_elev, min_weight):
+
+    """ Run A* over the tile grid from (sx, sy) to (ex, ey) with costs as in
+    dijkstra. Distances are written to distm (which must be initialized to
+    infinity) and, for every tile reached, the direction to its predecessor
+    to preds. The flat indices of tiles whose distance was set are recorded
+    in touched (of dim * dim elements), so that distm can be reset
+    selectively. If the endpoint is reached, the road is traced back along
+    preds and its flat indices, from the endpoint to the start, are written
+    to path (of dim * dim elements; see add_road). Returns (found, number of
+    touched tiles, length of the road).
+
+    The heuristic is a lower bound on the cost of any path to the endpoint:
+    every move costs at least the lower of min_weight (the lowest weight)
+    and mp_road, and moves onto non-road tiles at least min_weight. road_dist
+    holds the Manhattan distance of every tile to the nearest road; a path
+    can only take the road discount after leaving the vicinity of its start
+    and before approaching the endpoint.
+    """
+
+    dim = distm.shape[0]
+    lo = min(min_weight, mp_road)
+    keys = np.empty(1024, dtype=np.float64)
+    values = np.empty(1024, dtype=np.int64)
+    n = 0
+
+    distm[sy, sx] = 0.0
+    preds[sy, sx] = NO_DIRECTION
+    touched[0] = sy * dim + sx
+    n_touched = 1
+
+    m = abs(ex - sx) + abs(ey - sy)
+    off_road = min(m, max(road_dist[sy, sx] - 1 + road_dist[ey, ex], 0))
+    n = heap_push(keys, values, n, lo * m + (min_weight - lo) * off_road, sy * dim + sx)
+
+    while (n > 0):
+        (key, i, n) = heap_pop(keys, values, n)
+        cy = i // dim
+        cx = i % dim
+        curr_d = distm[cy, cx]
+
+        # Skip outdated entries
+
+        m = abs(ex - cx) + abs(ey - cy)
+        off_road = min(m, max(road_dist[cy, cx] - 1 + road_dist[ey, ex], 0))
+
+        if (key > curr_d + lo * m + (min_weight - lo) * off_road):
+            continue
+
+        if (cx == ex and cy == ey):
+            break
+
+        for d in range(4):
+            nx = cx + DX[d]
+            ny = cy + DY[d]
+
+            if (nx < 0 or ny < 0 or nx >= dim or ny >= dim):
+                continue
+
+            if (roads[ny, nx] > 0):
+                nd = curr_d + mp_road
+            else:
+                nd = curr_d + weights[ny, nx] + elev_deltas[d, cy, cx] * mp_elev
+
+            if (nd < distm[ny, nx]):
+                if (distm[ny, nx] == np.inf):
+                    touched[n_touched] = ny * dim + nx
+                    n_touched += 1
+
+                m = abs(ex - nx) + abs(ey - ny)
+                off_road = min(m, max(road_dist[ny, nx] - 1 + road_dist[ey, ex], 0))
+
+                distm[ny, nx] = nd
+                preds[ny, nx] = (d + 2) % 4
+
+                if (n == len(keys)):
+                    (keys, values) = heap_grow(keys, values)
+
+                n = heap_push(keys, values, n, nd + lo * m + (min_weight - lo) * off_road, ny * dim + nx)
+
+    if (distm[ey, ex] == np.inf):
+        return (False, n_touched, 0)
+
+    # Trace the road back
+
+    cx = ex
+    cy = ey
+    n_path = 0
+
+    while (True):
+        path[n_path] = cy * dim + cx
+        n_path += 1
+
+        d = preds[cy, cx]
+
+        if (d == NO_DIRECTION):
+            break
+
+        cx += DX[d]
+        cy += DY[d]
+
+    return (True, n_touched, n_path)
+
+@kernel()
+def add_road(roads, road_dist, queue, n_path):
+
+    """ Set the road whose flat indices are held in queue[:n_path] (as
+    written by astar) in roads, and update road_dist, the Manhattan distance
+    of every tile to the nearest road, by a breadth-first pass from the new
+    road tiles. queue (of dim * dim elements) is reused for the pass, and on
+    return holds the new road tiles followed by all other tiles whose road
+    distance changed. Returns (number of new road tiles, number of changed
+    tiles).
+    """
+
+    dim = roads.shape[0]
+    q_end = 0
+
+    # Queue new road tiles, compacting the path in place
+
+    for i in range(n_path):
+        t = queue[i]
+        cy = t // dim
+        cx = t % dim
+        roads[cy, cx] = 1
+
+        if (road_dist[cy, cx] > 0):
+            road_dist[cy, cx] = 0
+            queue[q_end] = t
+            q_end += 1
+
+    n_new = q_end
+
+    # Update road distances
+
+    q = 0
+
+    while (q < q_end):
+        cy = queue[q] // dim
+        cx = queue[q] % dim
+        q += 1
+
+        for d in range(4):
+            nx = cx + DX[d]
+            ny = cy + DY[d]
+
+            if (nx >= 0 and ny >= 0 and nx < dim and ny < dim):
+                if (road_dist[ny, nx] > road_dist[cy, cx] + 1):
+                    road_dist[ny, nx] = road_dist[cy, cx] + 1
+                    queue[q_end] = ny * dim + nx
+                    q_end += 1
+
+    return (n_new, q_end)
+
+@kernel()
+def dijkstra(weights, elev_deltas, roads, distm, sx, sy, ex, ey, mp_road, mp_elev):
+
+    """ Run Dijkstra's algorithm over the tile grid from (sx, sy) until
+    (ex, ey) is reached, filling distm (which must be initialized to
+    infinity). Moving onto a tile costs its weight plus an elevation
+    penalty, or a fixed mp_road if the tile is already a road. Returns True
+    if the endpoint was reached.
+    """
+
+    dim = distm.shape[0]
+    cx = sx
+    cy = sy
+    to_visit = [(0.0, sx, sy)]
+
+    to_visit.pop()
+    distm[sy, sx] = 0.0
+
+    while (True):
+        curr_d = distm[cy, cx]
+
+        for i in range(4):
+            nx = cx + DX[i]
+            ny = cy + DY[i]
+
+            if (nx < 0 or ny < 0 or nx >= dim or ny >= dim):
+                continue
+
+            if (roads[ny, nx] > 0):
+                d = curr_d + mp_road
+            else:
+                d = curr_d + weights[ny, nx] + elev_deltas[i, cy, cx] * mp_elev
+
+            if (d < distm[ny, nx]):
+                distm[ny, nx] = d
+                heapq.heappush(to_visit, (d, nx, ny))
+
+        if (not len(to_visit)):
+            return False
+
+        (d, cx, cy) = heapq.heappop(to_visit)
+
+        if (d == np.inf):
+            return False
+        elif (cx == ex and cy == ey):
+            return True
+
+@kernel()
+def trace_distances(distm, ex, ey, path):
+
+    """ Trace a path back from (ex, ey) to the start of a search which
+    filled distm (see dijkstra), stepping to the edge neighbor of least
+    distance, the first in the order N, E, S, W among equals, until the
+    distance is 0. Writes the flat indices of the path, from (ex, ey), to
+    path and returns their number.
+    """
+
+    dim = distm.shape[0]
+    cx = ex
+    cy = ey
+    d = distm[cy, cx]
+    path[0] = cy * dim + cx
+    n = 1
+
+    while (d > 0):
+        x = cx
+        y = cy
+
+        for i in range(4):
+            nx = x + DX[i]
+            ny = y + DY[i]
+
+            if (nx >= 0 and ny >= 0 and nx < dim and ny < dim and distm[ny, nx] < d):
+                d = distm[ny, nx]
+                cx = nx
+                cy = ny
+
+        path[n] = cy * dim + cx
+        n += 1
+
+    return n
+
+@helper
+def dijkstra_window_steps(weights, elev_deltas, roads, x0, y0, reverse, mp_road, mp_elev,
+        wanted, remaining, distm, preds, keys, values, n):
+
+    """ Run the search of dijkstra_window on, until the heap of n pairs is
+    empty, the remaining wanted tiles are settled or the heap may have no
+    room for the neighbors of the next tile. Returns (n, remaining).
+    """
+
+    (h, w) = distm.shape
+
+    while (n > 0 and remaining > 0 and n + 3 <= len(keys)):
+        (key, i, n) = heap_pop(keys, values, n)
+        cy = i // w
+        cx = i % w
+        curr_d = distm[cy, cx]
+
+        if (key > curr_d):
+            continue
+
+        if (wanted[i]):
+            wanted[i] = False
+            remaining -= 1
+
+        for d in range(4):
+            nx = cx + DX[d]
+            ny = cy + DY[d]
+
+            if (nx < 0 or ny < 0 or nx >= w or ny >= h):
+                continue
+
+            # Moving from the current tile to the neighbor or, in reverse,
+            # from the neighbor to the current tile
+
+            if (reverse):
+                (tx, ty, fx, fy, fd) = (cx, cy, nx, ny, (d + 2) % 4)
+            else:
+                (tx, ty, fx, fy, fd) = (nx, ny, cx, cy, d)
+
+            if (roads[y0 + ty, x0 + tx] > 0):
+                nd = curr_d + mp_road
+            else:
+                nd = curr_d + weights[y0 + ty, x0 + tx] + elev_deltas[fd, y0 + fy, x0 + fx] * mp_elev
+
+            if (nd < distm[ny, nx]):
+                distm[ny, nx] = nd
+                preds[ny, nx] = (d + 2) % 4
+                n = heap_push(keys, values, n, nd, ny * w + nx)
+
+    return (n, remaining)
+
+@kernel()
+def dijkstra_window(weights, elev_deltas, roads, x0, y0, sx, sy, reverse, mp_road, mp_elev,
+        targets, distm, preds):
+
+    """ Run Dijkstra's algorithm from (sx, sy) over the window of tiles
+    starting at (x0, y0) with the shape of distm, with costs as in dijkstra,
+    filling distm and preds (the direction to each tile's predecessor, as in
+    astar). If reverse is set, distances are those to (sx, sy) instead, and
+    preds point to the successors. The search ends once the tiles at the
+    flat window indices targets are settled; distances of other tiles may
+    be left too high.
+    """
+
+    # The heap grows with the tiles pushed, between runs of the search (see
+    # dijkstra_window_steps) rather than within, which compiles to a faster
+    # loop
+
+    (h, w) = distm.shape
+    keys = np.empty(1024, dtype=np.float64)
+    values = np.empty(1024, dtype=np.int64)
+    n = 0
+
+    wanted = np.zeros(h * w, dtype=np.bool_)
+    remaining = 0
+
+    for i in targets:
+        if (not wanted[i]):
+            wanted[i] = True
+            remaining += 1
+
+    distm[:, :] = np.inf
+    distm[sy - y0, sx - x0] = 0.0
+    preds[sy - y0, sx - x0] = NO_DIRECTION
+    n = heap_push(keys, values, n, 0.0, (sy - y0) * w + (sx - x0))
+
+    while (True):
+        (n, remaining) = dijkstra_window_steps(
+            weights, elev_deltas, roads, x0, y0, reverse, mp_road, mp_elev,
+            wanted, remaining, distm, preds, keys, values, n)
+
+        if (n == 0 or remaining == 0):
+            return
+
+        (keys, values) = heap_grow(keys, values)
+
+@kernel()
+def integrate_costs(weights, elev_deltas, roads, mp_road, mp_elev, targets, costs, dirs):
+
+    """ Run Dijkstra's algorithm backwards from the flat tile indices
+    targets, with costs as in dijkstra, filling costs with the cost of the
+    cheapest path from every tile to the nearest target (infinity where
+    there is none) and dirs with the direction of the first step along it
+    (NO_DIRECTION at targets and unreachable tiles).
+    """
+
+    (dim_y, dim_x) = costs.shape
+    keys = np.empty(1024, dtype=np.float64)
+    values = np.empty(1024, dtype=np.int64)
+    n = 0
+
+    costs[:, :] = np.inf
+    dirs[:, :] = NO_DIRECTION
+
+    for i in targets:
+        if (costs[i // dim_x, i % dim_x] > 0.0):
+            costs[i // dim_x, i % dim_x] = 0.0
+
+            if (n == len(keys)):
+                (keys, values) = heap_grow(keys, values)
+
+            n = heap_push(keys, values, n, 0.0, i)
+
+    while (n > 0):
+        (key, i, n) = heap_pop(keys, values, n)
+        cy = i // dim_x
+        cx = i % dim_x
+
+        if (key > costs[cy, cx]):
+            continue
+
+        # Relax the neighbors moving onto the current tile
+
+        on_road = roads[cy, cx] > 0
+        weight = weights[cy, cx]
+
+        if (weight == np.inf and not on_road):
+            continue
+
+        for d in range(4):
+            nx = cx + DX[d]
+            ny = cy + DY[d]
+
+            if (nx < 0 or ny < 0 or nx >= dim_x or ny >= dim_y or costs[ny, nx] <= key):
+                continue
+
+            back = (d + 2) % 4
+
+            if (on_road):
+                nd = key + mp_road
+            else:
+                nd = key + weight + elev_deltas[back, ny, nx] * mp_elev
+
+            if (nd < costs[ny, nx]):
+                costs[ny, nx] = nd
+                dirs[ny, nx] = back
+
+                if (n == len(keys)):
+                    (keys, values) = heap_grow(keys, values)
+
+                n = heap_push(keys, values, n, nd, ny * dim_x + nx)
+
+@helper
+def abstract_bound(node_x, node_y, node_road_dist, gx, gy, goal_road_dist, lo, min_weight,
+        lm_from, lm_to, lm_goal_from, lm_goal_to, u):
+
+    """ Return the heuristic of astar_abstract for node u. """
+
+    m = abs(gx - node_x[u]) + abs(gy - node_y[u])
+    off_road = min(m, max(node_road_dist[u] - 1 + goal_road_dist, 0))
+    h = lo * m + (min_weight - lo) * off_road
+
+    for k in range(lm_from.shape[1]):
+        if (lm_from[u, k] < np.inf):
+            h = max(h, lm_goal_from[k] - lm_from[u, k])
+        if (lm_to[u, k] < np.inf):
+            h = max(h, lm_to[u, k] - lm_goal_to[k])
+
+    return h
+
+@kernel()
+def astar_abstract(indptr, indices, costs, node_x, node_y, node_road_dist,
+        starts, start_costs, goals, goal_costs, gx, gy, goal_road_dist,
+        lo, min_weight, lm_from, lm_to, lm_goal_from, lm_goal_to,
+        best, dist, preds, heur, touched):
+
+    """ Run A* over an abstract graph of tiles given in CSR form (indptr,
+    indices, costs), with node coordinates node_x, node_y. The search starts
+    from nodes starts at costs start_costs and ends at nodes goals, from
+    which the goal tile (gx, gy) is goal_costs away. best is the cost of a
+    path known beforehand (or infinity).
+
+    The heuristic is the higher of that of astar, with the distances to the
+    nearest road in node_road_dist and goal_road_dist and lo the lowest cost
+    of any move, and the landmark (ALT) bounds: lm_from[u, k] and lm_to[u, k]
+    are the distances from and to landmark k, and lm_goal_from[k] and
+    lm_goal_to[k] the lowest distance from the landmark to the goal tile and
+    the highest distance from a goal node to the landmark less its goal cost,
+    so that by the triangle inequality the cost from u to the goal tile is
+    at least both lm_goal_from[k] - lm_from[u, k] and lm_to[u, k] -
+    lm_goal_to[k].
+
+    dist (initialized to infinity), preds (the preceding node, -1 for
+    starts) and heur (the heuristic) are filled for visited nodes, whose
+    indices are recorded in touched. Returns (best cost, last node of the best path or -1 if it
+    is not better than best, number of touched nodes).
+    """
+
+    keys = np.empty(1024, dtype=np.float64)
+    values = np.empty(1024, dtype=np.int64)
+    n = 0
+    n_touched = 0
+    best_node = -1
+
+    for i in range(len(starts)):
+        u = starts[i]
+
+        if (start_costs[i] < dist[u]):
+            if (dist[u] == np.inf):
+                touched[n_touched] = u
+                n_touched += 1
+                heur[u] = abstract_bound(node_x, node_y, node_road_dist, gx, gy, goal_road_dist,
+                    lo, min_weight, lm_from, lm_to, lm_goal_from, lm_goal_to, u)
+
+            dist[u] = start_costs[i]
+            preds[u] = -1
+
+            if (n == len(keys)):
+                (keys, values) = heap_grow(keys, values)
+
+            n = heap_push(keys, values, n, dist[u] + heur[u], u)
+
+    while (n > 0):
+        (key, u, n) = heap_pop(keys, values, n)
+
+        if (key >= best):
+            break
+
+        if (key > dist[u] + heur[u]):
+            continue
+
+        for g in range(len(goals)):
+            if (goals[g] == u and dist[u] + goal_costs[g] < best):
+                best = dist[u] + goal_costs[g]
+                best_node = u
+
+        for e in range(indptr[u], indptr[u+1]):
+            v = indices[e]
+            nd = dist[u] + costs[e]
+
+            if (nd < dist[v]):
+                if (dist[v] == np.inf):
+                    touched[n_touched] = v
+                    n_touched += 1
+                    heur[v] = abstract_bound(node_x, node_y, node_road_dist, gx, gy, goal_road_dist,
+                        lo, min_weight, lm_from, lm_to, lm_goal_from, lm_goal_to, v)
+
+                dist[v] = nd
+                preds[v] = u
+
+                if (n == len(keys)):
+                    (keys, values) = heap_grow(keys, values)
+
+                n = heap_push(keys, values, n, nd + heur[v], v)
+
+    return (best, best_node, n_touched)
+
+@kernel()
+def trace_predecessors(preds, end, roads):
+
+    """ Mark the path ending at flat tile index end as road tiles, following
+    a predecessor row as returned by scipy.sparse.csgraph.dijkstra (negative
+    at the source). Returns the number of tiles on the path.
+    """
+
+    dim = roads.shape[1]
+    i = end
+    n = 0
+
+    while (i >= 0):
+        roads[i // dim, i % dim] = 1
+        n += 1
+        i = preds[i]
+
+    return n
+
+@kernel()
+def trace_road_edges(roads, node_ids, node_tiles, edges, path):
+
+    """ Trace the edges of the graph of a road matrix (nonzero at road
+    tiles): from every node i, at flat index node_tiles[i], along each edge
+    neighbor which is a road, through tiles which are not nodes (node_ids
+    -1, and exactly two road edge neighbors each) up to the next node
+    (node_ids holding its index). Every edge is traced from both ends, but
+    kept only from the lower node index or, for loops, the lower direction.
+    The flat indices of its tiles, including both nodes, are appended to
+    path, and (start node, end node, end of the tiles in path) to edges.
+    Returns (number of edges, length of path).
+    """
+
+    (dim_y, dim_x) = roads.shape
+    n_edges = 0
+    n_path = 0
+
+    for u in range(len(node_tiles)):
+        sy = node_tiles[u] // dim_x
+        sx = node_tiles[u] % dim_x
+
+        for d in range(4):
+            cx = sx + DX[d]
+            cy = sy + DY[d]
+
+            if (cx < 0 or cy < 0 or cx >= dim_x or cy >= dim_y or roads[cy, cx] == 0):
+                continue
+
+            start = n_path
+            path[n_path] = node_tiles[u]
+            n_path += 1
+            back = (d + 2) % 4
+
+            while (node_ids[cy, cx] < 0):
+                path[n_path] = cy * dim_x + cx
+                n_path += 1
+
+                # Continue to the other road neighbor
+
+                (nx, ny, e) = (cx, cy, back)
+
+                for e in range(4):
+                    nx = cx + DX[e]
+                    ny = cy + DY[e]
+
+                    if (e != back and nx >= 0 and ny >= 0 and nx < dim_x and ny < dim_y and
+                            roads[ny, nx] != 0):
+                        break
+
+                cx = nx
+                cy = ny
+                back = (e + 2) % 4
+
+            path[n_path] = cy * dim_x + cx
+            n_path += 1
+            v = node_ids[cy, cx]
+
+            if (u < v or (u == v and d < back)):
+                edges[n_edges, 0] = u
+                edges[n_edges, 1] = v
+                edges[n_edges, 2] = n_path
+                n_edges += 1
+            else:
+                n_path = start
+
+    return (n_edges, n_path)
+
+def _classify_tiles_numpy(ext, m, removed, lut):
+
+    """ Vectorized equivalent of classify_tiles: the neighborhood codes of
+    the whole matrix are packed from shifted views of ext and looked up at
+    once.
+    """
+
+    dim = m.shape[0]
+    codes = np.zeros(m.shape, dtype=np.int16)
+
+    for j in range(9):
+        codes |= ext[j//3:j//3+dim, j%3:j%3+dim].astype(np.int16) << j
+
+    interesting = ext[1:-1, 1:-1]
+    tts = lut[codes]
+    np.copyto(m, tts, where=interesting & (tts >= 0), casting="unsafe")
+    removed[:] = interesting & (tts == TT_ILLEGAL)
+    m[removed] = 0
+
+    return int(np.count_nonzero(removed))
+
+@kernel(fallback=_classify_tiles_numpy)
+def classify_tiles(ext, m, removed, lut):
+
+    """ Run a single classification pass. ext is the boolean "interesting"
+    matrix extended by one over each edge. Every interesting tile is looked
+    up in lut by the code of its 3x3 neighborhood in ext (bit 3 * dy + dx
+    set for an interesting tile at (dx, dy) from the top left corner), and
+    set to the tile type found, left as is for TT_KEEP, or cleared and
+    marked in removed for TT_ILLEGAL. Returns the number of removed tiles.
+    """
+
+    dim = m.shape[0]
+    n_removed = 0
+
+    for y in range(dim):
+        for x in range(dim):
+            if (not ext[y+1, x+1]):
+                continue
+
+            code = 0
+
+            for j in range(9):
+                if (ext[y + j // 3, x + j % 3]):
+                    code |= 1 << j
+
+            tt = lut[code]
+
+            if (tt >= 0):
+                m[y, x] = tt
+            elif (tt == TT_ILLEGAL):
+                removed[y, x] = True
+                m[y, x] = 0
+                n_removed += 1
+
+    return n_removed
+
+def _classify_cells_numpy(m, lut, extend, cells, removed):
+
+    """ Vectorized equivalent of classify_cells, gathering the neighborhoods
+    of all cells at once.
+    """
+
+    (dim_y, dim_x) = m.shape
+    (ys, xs) = (cells // dim_x, cells % dim_x)
+    codes = np.zeros(len(cells), dtype=np.int16)
+
+    for j in range(9):
+        (nx, ny) = (xs + j % 3 - 1, ys + j // 3 - 1)
+        inside = (nx >= 0) & (ny >= 0) & (nx < dim_x) & (ny < dim_y)
+        (nx, ny) = (np.clip(nx, 0, dim_x - 1), np.clip(ny, 0, dim_y - 1))
+        codes |= ((m[ny, nx] != 0) & (inside | extend)).astype(np.int16) << j
+
+    tts = np.where(m[ys, xs] != 0, lut[codes], TT_KEEP)
+    legal = tts >= 0
+    illegal = tts == TT_ILLEGAL
+    m[ys[legal], xs[legal]] = tts[legal]
+    m[ys[illegal], xs[illegal]] = 0
+
+    n_removed = int(np.count_nonzero(illegal))
+    removed[:n_removed] = cells[illegal]
+
+    return n_removed
+
+@kernel(fallback=_classify_cells_numpy)
+def classify_cells(m, lut, extend, cells, removed):
+
+    """ Run a single classification pass (see classify_tiles) over the
+    cells (flat indices) of m only, reading neighborhoods from m itself:
+    beyond the edge, tiles continue the edge tiles if extend is true and are
+    uninteresting otherwise. All cells are looked up before any is changed,
+    as in a full pass. Removed cells are written to removed; returns their
+    number.
+    """
+
+    (dim_y, dim_x) = m.shape
+    n = cells.shape[0]
+    tts = np.empty(n, dtype=np.int16)
+
+    for i in range(n):
+        y = cells[i] // dim_x
+        x = cells[i] % dim_x
+        tts[i] = TT_KEEP
+
+        if (m[y, x] == 0):
+            continue
+
+        code = 0
+
+        for j in range(9):
+            nx = x + j % 3 - 1
+            ny = y + j // 3 - 1
+
+            if (nx < 0 or ny < 0 or nx >= dim_x or ny >= dim_y):
+                if (not extend):
+                    continue
+                nx = min(max(nx, 0), dim_x - 1)
+                ny = min(max(ny, 0), dim_y - 1)
+
+            if (m[ny, nx] != 0):
+                code |= 1 << j
+
+        tts[i] = lut[code]
+
+    n_removed = 0
+
+    for i in range(n):
+        y = cells[i] // dim_x
+        x = cells[i] % dim_x
+
+        if (tts[i] >= 0):
+            m[y, x] = tts[i]
+        elif (tts[i] == TT_ILLEGAL):
+            m[y, x] = 0
+            removed[n_removed] = cells[i]
+            n_removed += 1
+
+    return n_removed
@@ -0,0 +1,346 @@
+
+from logging import debug, info, warning, error
+
+import numpy as np
+
+class LayerIndex:
+
+    """ An aggregate query index over a GameFieldLayer, answering questions
+    like "how many forest tiles are in this rectangle?" or "is there any
+    river in this chunk?" without scanning the matrix. Usually created
+    through GameFieldLayer.build_index.
+
+    Counts and sums are served from summed-area tables. The tables are not
+    rewritten on every change: changed cells are kept as pending corrections,
+    which queries add in (a vectorized scan). Once more than PENDING_LIMIT
+    corrections are pending, the next query folds them into the tables at
+    once, recomputing only the part of each table below and to the right of
+    the least x and y of the corrected tiles, i.e. O(dim**2) at worst for a
+    whole batch of changes, but much less for changes towards the bottom
+    right. A
+    brush edit of thousands of tiles thus costs one partial recomputation.
+    Any / none tests are served from an occupancy pyramid (counts of nonzero
+    tiles in blocks of 2**k x 2**k tiles for every level k) which is updated
+    exactly on each change and can also be used for culling whole blocks.
+
+    Changes made through GameFieldLayer's [] operator are tracked
+    automatically; after writing into the layer's matrix directly, call
+    refresh() for the affected rectangle. Replacing the layer's matrix
+    altogether triggers a full rebuild on next use.
+
+    Rectangles are given in game coordinates as (x, y, w, h) and are
+    truncated to the matrix.
+    """
+
+    PENDING_LIMIT = 256
+
+    def __init__(self, flayer, values=()):
+
+        """ Construct an index over flayer. Nonzero counts and sums are always
+        available; values lists the tile values for which separate counts
+        should be kept.
+        """
+
+        self.values = tuple(values)
+
+        self._flayer = flayer
+        self._build()
+
+    def count(self, x, y, w, h, value=None):
+
+        """ Count the tiles in a rectangle which are nonzero or, if value is
+        passed, equal to value (which must be one of self.values).
+        """
+
+        key = self._count_key(value)
+        return int(self._query(key, x, y, w, h))
+
+    def sum(self, x, y, w, h):
+
+        """ Sum the tile values in a rectangle. """
+
+        return int(self._query("sum", x, y, w, h))
+
+    def any(self, x, y, w, h):
+
+        """ Return true if any tile in a rectangle is nonzero. Descends the
+        occupancy pyramid, skipping empty blocks and stopping at the first
+        occupied block fully inside the rectangle.
+        """
+
+        self._check_matrix()
+
+        (x0, y0, x1, y1) = self._clip(x, y, w, h)
+        pyramid = self._pyramid
+        stack = [(len(pyramid) - 1, 0, 0)]
+
+        if (x0 >= x1 or y0 >= y1):
+            return False
+
+        while (stack):
+            (level, bx, by) = stack.pop()
+            bdim = 1 << level
+            (bx0, by0) = (bx * bdim, by * bdim)
+            (bx1, by1) = (bx0 + bdim, by0 + bdim)
+
+            if (pyramid[level][by, bx] == 0):
+                continue
+            elif (bx0 >= x0 and by0 >= y0 and bx1 <= x1 and by1 <= y1):
+                return True
+            elif (level == 0):
+                continue
+
+            # Descend into the child blocks intersecting the rectangle
+
+            children = pyramid[level-1]
+            cdim = bdim // 2
+
+            for cby in (by * 2, by * 2 + 1):
+                for cbx in (bx * 2, bx * 2 + 1):
+                    (cx0, cy0) = (cbx * cdim, cby * cdim)
+
+                    if (cby >= children.shape[0] or cbx >= children.shape[1]):
+                        continue
+                    elif (cx0 < x1 and cy0 < y1 and cx0 + cdim > x0 and cy0 + cdim > y0):
+                        stack.append((level - 1, cbx, cby))
+
+        return False
+
+    def get_occupied_blocks(self, level):
+
+        """ Return a boolean matrix (numpy order) telling which blocks of 2**level
+        x 2**level tiles contain at least one nonzero tile. Meant for culling.
+        """
+
+        self._check_matrix()
+        return self._pyramid[level] > 0
+
+    def refresh(self, x=0, y=0, w=None, h=None):
+
+        """ Bring the index up to date with the layer's matrix in a rectangle
+        (by default, everywhere) after direct writes into the matrix.
+        """
+
+        if (self._check_matrix()):
+            return
+
+        m = self._flayer.matrix
+        (dim_y, dim_x) = m.shape
+        w = dim_x - x if w is None else w
+        h = dim_y - y if h is None else h
+
+        (x0, y0, x1, y1) = self._clip(x, y, w, h)
+        (ys, xs) = np.nonzero(m[y0:y1, x0:x1] != self._shadow[y0:y1, x0:x1])
+
+        self._record(xs + x0, ys + y0)
+
+    def update(self, x, y):
+
+        """ Bring the index up to date with the layer's matrix at a single
+        tile. Called by GameFieldLayer upon assignment.
+        """
+
+        if (self._check_matrix()):
+            return
+
+        old = int(self._shadow[y, x])
+        new = int(self._flayer.matrix[y, x])
+
+        if (old == new):
+            return
+
+        deltas = [int(new != 0) - int(old != 0), new - old]
+        deltas.extend(int(new == v) - int(old == v) for v in self.values)
+
+        self._shadow[y, x] = new
+        self._append(x, y, deltas)
+
+        if (deltas[0]):
+            for (level, counts) in enumerate(self._pyramid):
+                counts[y >> level, x >> level] += deltas[0]
+
+    def _record(self, xs, ys):
+
+        """ Bulk variant of update for the tiles xs, ys (arrays), which must
+        be distinct.
+        """
+
+        old = self._shadow[ys, xs].astype(np.int64)
+        new = self._flayer.matrix[ys, xs].astype(np.int64)
+        deltas = np.empty((len(xs), len(self._keys)), dtype=np.int64)
+
+        deltas[:, 0] = (new != 0).astype(np.int64) - (old != 0)
+        deltas[:, 1] = new - old
+
+        for (i, v) in enumerate(self.values, 2):
+            deltas[:, i] = (new == v).astype(np.int64) - (old == v)
+
+        self._shadow[ys, xs] = new
+        self._append(xs, ys, deltas)
+
+        occupied = deltas[:, 0] != 0
+
+        for (level, counts) in enumerate(self._pyramid):
+            np.add.at(counts, (ys[occupied] >> level, xs[occupied] >> level), deltas[occupied, 0])
+
+    def _append(self, xs, ys, deltas):
+
+        """ Append pending corrections (a row of deltas per key in _keys) for
+        a tile or arrays of tiles, growing the buffers as needed.
+        """
+
+        n = self._n_pending
+        k = np.size(xs)
+
+        if (n + k > len(self._pending_xs)):
+            size = max(2 * len(self._pending_xs), n + k)
+            self._pending_xs = np.resize(self._pending_xs, size)
+            self._pending_ys = np.resize(self._pending_ys, size)
+            self._pending_deltas = np.resize(self._pending_deltas, (size, len(self._keys)))
+
+        self._pending_xs[n:n+k] = xs
+        self._pending_ys[n:n+k] = ys
+        self._pending_deltas[n:n+k] = deltas
+        self._n_pending = n + k
+
+    def _build(self):
+
+        """ (Re)build all tables from the layer's matrix. """
+
+        m = self._flayer.matrix
+        nonzero = m != 0
+
+        debug("Building LayerIndex over a {} matrix".format(m.shape))
+
+        self._matrix = m
+        self._shadow = m.copy()
+        self._keys = [None, "sum"] + list(self.values)
+        self._tables = {}
+        self._rebuild_tables()
+
+        # Build the occupancy pyramid by summing 2x2 blocks until a single
+        # block remains, padding odd dimensions
+
+        counts = nonzero.astype(np.int32)
+        self._pyramid = [counts]
+
+        while (counts.shape[0] > 1 or counts.shape[1] > 1):
+            padded = np.pad(counts, ((0, counts.shape[0] % 2), (0, counts.shape[1] % 2)))
+            counts = \
+                padded[0::2, 0::2] + padded[1::2, 0::2] + \
+                padded[0::2, 1::2] + padded[1::2, 1::2]
+            self._pyramid.append(counts)
+
+    def _rebuild_tables(self):
+
+        """ (Re)build the summed-area tables from the shadow copy, dropping
+        pending corrections.
+        """
+
+        for key in self._keys:
+            self._tables[key] = self._make_table(self._get_cells(key, self._shadow), self._dtype(key))
+
+        self._pending_xs = np.empty(64, dtype=np.int64)
+        self._pending_ys = np.empty(64, dtype=np.int64)
+        self._pending_deltas = np.empty((64, len(self._keys)), dtype=np.int64)
+        self._n_pending = 0
+
+    def _flush(self):
+
+        """ Fold the pending corrections into the summed-area tables. Only
+        the entries t[y, x] with y > y0, x > x0 change, x0 and y0 being the
+        least x and y of the corrected tiles: they are the sum of those of
+        the unchanged row y0 and column x0 and of a table over
+        shadow[y0:, x0:].
+        """
+
+        n = self._n_pending
+        y0 = int(self._pending_ys[:n].min())
+        x0 = int(self._pending_xs[:n].min())
+
+        for key in self._keys:
+            t = self._tables[key]
+            cells = self._get_cells(key, self._shadow[y0:, x0:])
+            block = self._make_table(cells, t.dtype)[1:, 1:]
+            block += t[y0+1:, x0:x0+1] + t[y0:y0+1, x0+1:] - t[y0, x0]
+            t[y0+1:, x0+1:] = block
+
+        self._n_pending = 0
+
+    def _query(self, key, x, y, w, h):
+        self._check_matrix()
+
+        (x0, y0, x1, y1) = self._clip(x, y, w, h)
+        t = self._tables[key]
+
+        if (x0 >= x1 or y0 >= y1):
+            return 0
+
+        if (self._n_pending > self.PENDING_LIMIT):
+            self._flush()
+
+        r = t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0]
+        n = self._n_pending
+
+        if (n):
+            (xs, ys) = (self._pending_xs[:n], self._pending_ys[:n])
+            inside = (xs >= x0) & (ys >= y0) & (xs < x1) & (ys < y1)
+            r += self._pending_deltas[:n, self._keys.index(key)][inside].sum()
+
+        return r
+
+    def _count_key(self, value):
+        if (value is None or value in self.values):
+            return value
+        raise LookupError("LayerIndex keeps no counts for value {}".format(value))
+
+    def _check_matrix(self):
+
+        """ Rebuild if the layer's matrix has been replaced. Returns true if
+        a rebuild took place.
+        """
+
+        if (self._flayer.matrix is not self._matrix):
+            self._build()
+            return True
+        return False
+
+    def _clip(self, x, y, w, h):
+
+        """ Return a rectangle as truncated (x0, y0, x1, y1), exclusive at
+        x1, y1.
+        """
+
+        (dim_y, dim_x) = self._shadow.shape
+
+        return (
+            min(max(x, 0), dim_x), min(max(y, 0), dim_y),
+            min(max(x + w, 0), dim_x), min(max(y + h, 0), dim_y)
+        )
+
+    def _get_cells(self, key, m):
+
+        """ Return the values summed by the table of key over matrix m. """
+
+        if (key is None):
+            return m != 0
+        elif (key == "sum"):
+            return m
+        return m == key
+
+    @staticmethod
+    def _dtype(key):
+        return np.int64 if key == "sum" else np.int32
+
+    @staticmethod
+    def _make_table(m, dtype):
+
+        """ Create a summed-area table with a leading row and column of
+        zeroes, i.e. t[y, x] is the sum of m[:y, :x].
+        """
+
+        t = np.zeros((m.shape[0] + 1, m.shape[1] + 1), dtype=dtype)
+        np.cumsum(m, axis=0, dtype=dtype, out=t[1:, 1:])
+        np.cumsum(t[1:, 1:], axis=1, out=t[1:, 1:])
+
+        return t
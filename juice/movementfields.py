@@ -0,0 +1,117 @@
+
+import collections
+
+from logging import debug, info, warning, error
+
+import numpy as np
+
+from juice import kernels
+from juice.kernels import DX, DY, NO_DIRECTION
+
+class MovementField:
+
+    """ The flow field of a set of target tiles over the movement costs of
+    a RoadLayer: `costs` holds the cost of the cheapest path from every tile
+    to the nearest target (the integration field, infinity where there is
+    none) and `directions` the direction (N, E, S, W as in
+    TerrainFields.DIRECTIONS) of the first step along it, NO_DIRECTION at
+    the targets and where unreachable. Units moving towards the targets
+    look up their next step in constant time.
+    """
+
+    def __init__(self, targets, costs, directions):
+        self.targets = targets
+        self.costs = costs
+        self.directions = directions
+
+    def next_step(self, x, y):
+
+        """ Return the (x, y) tile to move to from (x, y), or None at a
+        target or if no target can be reached.
+        """
+
+        d = self.directions[y, x]
+
+        if (d == NO_DIRECTION):
+            return None
+
+        return (x + DX[d], y + DY[d])
+
+    def next_steps(self, xs, ys):
+
+        """ Return arrays (xs, ys) of the tiles to move to from tiles xs,
+        ys; units at a target or unable to reach one stay in place.
+        """
+
+        d = self.directions[ys, xs]
+        moving = d != NO_DIRECTION
+        dx = np.where(moving, np.take(DX, d, mode="clip"), 0)
+        dy = np.where(moving, np.take(DY, d, mode="clip"), 0)
+
+        return (xs + dx, ys + dy)
+
+class MovementFields:
+
+    """ A cache of MovementFields over the movement costs of a RoadLayer
+    (tile weights, elevation penalties and the road discount, as in road
+    generation). A field is computed for a set of targets in a single pass
+    of Dijkstra's algorithm from all targets at once (see
+    kernels.integrate_costs), and kept, keyed by the set of targets, until
+    more than `capacity` fields are held, the least recently used being
+    dropped first.
+
+    Fields are dropped when the road matrix or weightmap of the layer is
+    replaced (e.g. by regeneration); RoadLayer invalidates them on changes
+    in place (see RoadLayer.connect_city and update_terrain).
+    """
+
+    def __init__(self, rlayer, capacity=16):
+        self.rlayer = rlayer
+        self.capacity = capacity
+
+        self._cache = collections.OrderedDict()
+        self._sources = None
+
+    def get(self, targets):
+
+        """ Return the MovementField towards a sequence of (x, y) target
+        tiles, computing it if absent.
+        """
+
+        rlayer = self.rlayer
+        dim = rlayer.terrain.dim
+        key = tuple(sorted(set((int(x), int(y)) for (x, y) in targets)))
+        sources = (rlayer.matrix, rlayer.get_weightmap())
+
+        if (self._sources is None or any(a is not b for (a, b) in zip(self._sources, sources))):
+            self.invalidate()
+            self._sources = sources
+
+        field = self._cache.get(key)
+
+        if (field is not None):
+            self._cache.move_to_end(key)
+            return field
+
+        debug("Computing movement field to {} target(s)".format(len(key)))
+
+        terrain = rlayer.terrain
+        costs = np.empty((dim, dim), dtype=np.float64)
+        directions = np.empty((dim, dim), dtype=np.uint8)
+        flat = np.array([y * dim + x for (x, y) in key], dtype=np.int64)
+
+        kernels.integrate_costs(
+            rlayer.get_weightmap(), terrain.fields.elev_deltas, rlayer.matrix,
+            terrain.MP_ROAD, terrain.MP_PENALTY_ELEV, flat, costs, directions
+        )
+
+        field = MovementField(np.array(key, dtype=np.int64).reshape(-1, 2), costs, directions)
+        self._cache[key] = field
+
+        while (len(self._cache) > self.capacity):
+            self._cache.popitem(last=False)
+
+        return field
+
+    def invalidate(self):
+        self._cache.clear()
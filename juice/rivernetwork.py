@@ -0,0 +1,227 @@
+
+from logging import debug, info, warning, error
+
+import numpy as np
+
+from juice.kernels import DX, DY
+
+class RiverNetwork:
+
+    """ A topology index of a river system, built by RiverLayer from the
+    traced river paths. Rivers are identified by their IDs in the river
+    layer (1 .. n); per-river data is held in arrays indexed by ID, with
+    index 0 and failed rivers unused.
+
+    A river ends either at the sea, in which case it is a mouth and its end
+    tile (a sea tile, see DeltaLayer) is its delta, or by converging with
+    another, earlier river, its parent. The confluence is the parent's tile
+    the river joins at. Rivers thus form a forest of tributary trees rooted
+    at their mouths.
+
+    Attributes:
+
+    coords     - (x, y) coordinates of all river tiles, river by river, in
+                 order from the source downstream. Sea tiles are excluded.
+    offsets    - The polyline of river i is coords[offsets[i]:offsets[i+1]].
+    parent     - ID of the river each river flows into, 0 for mouths.
+    confluence - (x, y) of the confluence, a tile of the parent's polyline,
+                 (-1, -1) for mouths.
+    strahler   - Strahler order of each river at its end, counting its own
+                 headwater as a stream of order 1 and tributaries in the
+                 order they join along its course.
+    mouth      - ID of the mouth each river finally drains to.
+    delta      - Index into deltas of the delta each river drains to, -1 if
+                 none.
+    deltas     - (x, y) coordinates of the deltas.
+
+    Tributaries are kept in a preorder of every tree, so that the rivers
+    upstream of a river form a contiguous range; see get_upstream.
+    """
+
+    def __init__(self, smatrix, path, path_ends, ok):
+
+        """ Build the index from the outcome of RiverLayer._trace_rivers over
+        sea layer matrix smatrix.
+        """
+
+        (dim_y, dim_x) = smatrix.shape
+        n = len(ok)
+        ids = np.arange(n + 1)
+        starts = np.concatenate(([0], path_ends[:-1])).astype(np.int64)
+        lengths = np.where(ok, path_ends - starts, 0)
+
+        # Tiles of successful rivers in river order, along with their IDs
+        # and ends
+
+        if (n):
+            tiles = path[:path_ends[-1]][np.repeat(ok, path_ends - starts)]
+        else:
+            tiles = np.zeros(0, dtype=np.int64)
+
+        tile_ids = np.repeat(ids[1:], lengths)
+        ends = np.where(ok, path_ends - 1, 0)
+        end_tiles = path[ends] if n else tiles
+        at_sea = np.zeros(n + 1, dtype=bool)
+        at_sea[1:] = ok & (smatrix.flat[end_tiles] > 0)
+
+        # Polylines
+
+        on_land = smatrix.flat[tiles] == 0
+        self.coords = np.stack((tiles[on_land] % dim_x, tiles[on_land] // dim_x), axis=1)
+        self.offsets = np.zeros(n + 2, dtype=np.int64)
+        np.cumsum(np.bincount(tile_ids[on_land], minlength=n + 1), out=self.offsets[1:])
+
+        # Find parents and confluences: the first river to have visited the
+        # end tile or, failing that, an edge neighbor of it, earlier than
+        # the river itself. first_ids and first_pos tell the first river
+        # visiting each of the (sorted) tiles in visited, and where.
+
+        self.parent = np.zeros(n + 1, dtype=np.int64)
+        self.confluence = np.full((n + 1, 2), -1, dtype=np.int64)
+        conf_pos = np.zeros(n + 1, dtype=np.int64)
+
+        by_tile = np.lexsort((tile_ids, tiles))
+        (visited, first) = np.unique(tiles[by_tile], return_index=True)
+        first_ids = tile_ids[by_tile][first]
+        first_pos = by_tile[first]
+
+        converged = np.flatnonzero(ok & ~at_sea[1:]) + 1
+        cx = end_tiles[converged - 1] % dim_x
+        cy = end_tiles[converged - 1] // dim_x
+        pending = np.ones(len(converged), dtype=bool)
+
+        for (dx, dy) in ((0, 0),) + tuple(zip(DX, DY)):
+            (nx, ny) = (cx + dx, cy + dy)
+            valid = pending & (nx >= 0) & (ny >= 0) & (nx < dim_x) & (ny < dim_y)
+            t = np.where(valid, ny * dim_x + nx, -1)
+            i = np.minimum(np.searchsorted(visited, t), len(visited) - 1)
+            found = valid & (visited[i] == t) & (first_ids[i] < converged)
+
+            self.parent[converged[found]] = first_ids[i[found]]
+            self.confluence[converged[found]] = np.stack((nx[found], ny[found]), axis=1)
+            conf_pos[converged[found]] = first_pos[i[found]]
+            pending &= ~found
+
+        if (pending.any()):
+            warning("{} rivers without a confluence".format(np.count_nonzero(pending)))
+
+        # A river may join another at its end tile, a sea tile excluded from
+        # polylines: move such confluences to the last tile of the polyline
+
+        joined = converged[~pending]
+        (jx, jy) = self.confluence[joined].T
+        at_end = joined[smatrix[jy, jx] > 0]
+        last = self.offsets[self.parent[at_end] + 1] - 1
+
+        self.confluence[at_end] = self.coords[last]
+        conf_pos[at_end] -= 1
+
+        # Children, ordered by where they join along their parent
+
+        tributaries = np.flatnonzero(self.parent)
+        self._children = tributaries[np.lexsort((conf_pos[tributaries], self.parent[tributaries]))]
+        self._child_offsets = np.zeros(n + 2, dtype=np.int64)
+        np.cumsum(np.bincount(self.parent[tributaries], minlength=n + 1), out=self._child_offsets[1:])
+
+        # Mouths and deltas, by pointer jumping up the trees
+
+        mouth = np.where(self.parent > 0, self.parent, ids)
+
+        while (True):
+            jumped = mouth[mouth]
+            if ((jumped == mouth).all()):
+                break
+            mouth = jumped
+
+        self.mouth = np.where(np.concatenate(([False], ok)), mouth, 0)
+
+        mouths = np.flatnonzero(at_sea)
+        self._mouths = mouths
+        self.deltas = np.stack((end_tiles[mouths - 1] % dim_x, end_tiles[mouths - 1] // dim_x), axis=1)
+        delta_of_mouth = np.full(n + 1, -1, dtype=np.int64)
+        delta_of_mouth[mouths] = np.arange(len(mouths))
+        self.delta = np.where(self.mouth > 0, delta_of_mouth[self.mouth], -1)
+        self._delta_at = {tuple(c): i for (i, c) in enumerate(self.deltas.tolist())}
+
+        self._build_orders(np.flatnonzero(ok) + 1)
+
+        debug("River network: {} rivers, {} mouths, max Strahler order {}".format(
+            np.count_nonzero(ok), len(mouths), self.strahler.max(initial=0)))
+
+    def get_polyline(self, river_id):
+
+        """ Return the (x, y) coordinates of a river's tiles from its source
+        downstream, as an array view.
+        """
+
+        return self.coords[self.offsets[river_id]:self.offsets[river_id+1]]
+
+    def get_length(self, river_id):
+        return int(self.offsets[river_id+1] - self.offsets[river_id])
+
+    def get_children(self, river_id):
+
+        """ Return the IDs of a river's direct tributaries, in the order they
+        join from its source downstream.
+        """
+
+        return self._children[self._child_offsets[river_id]:self._child_offsets[river_id+1]]
+
+    def get_upstream(self, river_id):
+
+        """ Return the IDs of all rivers draining into a river, directly or
+        through other tributaries.
+        """
+
+        i = self._preorder_index[river_id]
+        return self._preorder[i+1:i+self._subtree_size[river_id]]
+
+    def get_delta(self, river_id):
+
+        """ Return the (x, y) of the delta a river drains to, or None. """
+
+        i = self.delta[river_id]
+        return tuple(self.deltas[i]) if i >= 0 else None
+
+    def get_delta_mouth(self, x, y):
+
+        """ Return the ID of the mouth with the delta at (x, y), or 0. """
+
+        i = self._delta_at.get((x, y))
+        return 0 if i is None else self._mouths[i]
+
+    def _build_orders(self, river_ids):
+
+        """ Compute Strahler orders and the preorder of the trees. Parents
+        have lower IDs than their tributaries, so visiting rivers by
+        descending ID handles tributaries first.
+        """
+
+        n = len(self.parent) - 1
+        self.strahler = np.zeros(n + 1, dtype=np.int64)
+        self._subtree_size = np.zeros(n + 1, dtype=np.int64)
+        self._subtree_size[river_ids] = 1
+
+        for r in river_ids[::-1].tolist():
+            order = 1
+
+            for c in self.get_children(r).tolist():
+                order = order + 1 if self.strahler[c] == order else max(order, self.strahler[c])
+
+            self.strahler[r] = order
+            self._subtree_size[self.parent[r]] += self._subtree_size[r]
+
+        # Preorder: every root followed by its tributaries
+
+        roots = river_ids[self.parent[river_ids] == 0]
+        self._preorder = np.zeros(len(river_ids), dtype=np.int64)
+        self._preorder_index = np.zeros(n + 1, dtype=np.int64)
+        stack = roots[::-1].tolist()
+        i = 0
+
+        while (stack):
+            r = stack.pop()
+            self._preorder[i] = r
+            self._preorder_index[r] = i
+            i += 1
+            stack.extend(self.get_children(r)[::-1].tolist())
@@ -0,0 +1,243 @@
+
+from logging import debug, info, warning, error
+
+import numpy as np
+import scipy.ndimage as ndi
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from juice import kernels
+from juice.kernels import DX, DY
+from juice.tileclassifier import TileClassifierLine
+
+class RoadNetwork:
+
+    """ A graph of the roads of a RoadLayer, built from its (classified)
+    matrix, so that routes along existing roads need not search the tile
+    grid.
+
+    Nodes are the road junctions and endpoints, i.e. the T-bone, four-way
+    and source tiles of TileClassifierLine, along with road tiles which do
+    not have two road edge neighbors within the map (roads reaching the map
+    edge are classified as continuing beyond) and road tiles with a city. A
+    loop of road without any of these gets a node at its first tile in
+    matrix order. Edges follow the roads between nodes, through tiles with
+    two road neighbors; their length is their number of steps. Nodes may be
+    joined by several edges, and an edge may be a loop.
+
+    Attributes:
+
+    node_coords - (x, y) coordinates of the nodes, in matrix order.
+    node_types  - Tile type of each node in the classification.
+    edges       - (start, end) nodes of each edge.
+    lengths     - Length of each edge, in tiles moved.
+    coords      - (x, y) coordinates of all edge tiles, edge by edge, from
+                  the start node to the end node, both included.
+    offsets     - The polyline of edge i is coords[offsets[i]:offsets[i+1]].
+    city_node   - Node of every city of the CitySet passed, -1 for cities
+                  off the roads.
+    component   - Connected component of each node.
+
+    Shortest paths (see get_shortest_path) are searched over the graph by
+    A* (see kernels.astar_abstract), edges being no shorter than the
+    Manhattan distance of their nodes.
+    """
+
+    # Classified road tiles which are always nodes
+
+    NODE_TYPES = (
+        TileClassifierLine.TT_SOURCE_N, TileClassifierLine.TT_SOURCE_E,
+        TileClassifierLine.TT_SOURCE_S, TileClassifierLine.TT_SOURCE_W,
+        TileClassifierLine.TT_TBONE_N, TileClassifierLine.TT_TBONE_E,
+        TileClassifierLine.TT_TBONE_S, TileClassifierLine.TT_TBONE_W,
+        TileClassifierLine.TT_FOURWAY
+    )
+
+    def __init__(self, matrix, classification, cities):
+
+        """ Build the graph of road layer matrix matrix, with its
+        LayerClassification classification and the CitySet cities.
+        """
+
+        (dim_y, dim_x) = matrix.shape
+        roads = matrix != 0
+        types = classification.matrix
+
+        # Nodes
+
+        padded = np.pad(roads, 1)
+        degree = (padded[:-2, 1:-1].astype(np.int64) + padded[2:, 1:-1] +
+            padded[1:-1, :-2] + padded[1:-1, 2:])
+        is_node = roads & ((degree != 2) | np.isin(types, self.NODE_TYPES))
+        is_node[cities.ys, cities.xs] |= roads[cities.ys, cities.xs]
+        is_node.flat[self._find_loops(roads, is_node)] = True
+
+        node_tiles = np.flatnonzero(is_node)
+        node_ids = np.full(matrix.shape, -1, dtype=np.int64)
+        node_ids.flat[node_tiles] = np.arange(len(node_tiles))
+
+        self.node_coords = np.stack((node_tiles % dim_x, node_tiles // dim_x), axis=1)
+        self.node_types = types.flat[node_tiles]
+        self.city_node = node_ids[cities.ys, cities.xs]
+        self._dim_x = dim_x
+        self._node_keys = node_tiles
+
+        # Edges
+
+        n_roads = np.count_nonzero(roads)
+        edges = np.zeros((2 * len(node_tiles), 3), dtype=np.int64)
+        path = np.zeros(2 * n_roads + 4 * len(node_tiles), dtype=np.int64)
+        (n_edges, n_path) = kernels.trace_road_edges(matrix, node_ids, node_tiles, edges, path)
+
+        self.edges = edges[:n_edges, :2].copy()
+        self.offsets = np.concatenate(([0], edges[:n_edges, 2]))
+        self.lengths = np.diff(self.offsets) - 1
+        self.coords = np.stack((path[:n_path] % dim_x, path[:n_path] // dim_x), axis=1)
+
+        self._build_graph()
+
+        debug("Road network: {} nodes, {} edges, {} components".format(
+            len(node_tiles), n_edges, self.component.max(initial=-1) + 1))
+
+    def get_node(self, x, y):
+
+        """ Return the node at (x, y), or -1. """
+
+        if (x < 0 or x >= self._dim_x):
+            return -1
+
+        key = y * self._dim_x + x
+        i = int(np.searchsorted(self._node_keys, key))
+
+        if (i < len(self._node_keys) and self._node_keys[i] == key):
+            return i
+        return -1
+
+    def get_polyline(self, edge):
+
+        """ Return the (x, y) coordinates of an edge's tiles from its start
+        node to its end node, as an array view.
+        """
+
+        return self.coords[self.offsets[edge]:self.offsets[edge+1]]
+
+    def get_edges(self, node):
+
+        """ Return the edges incident to a node, other than loops, along
+        with the neighbor each leads to.
+        """
+
+        (i0, i1) = (self._indptr[node], self._indptr[node+1])
+        return (self._edge_ids[i0:i1], self._indices[i0:i1])
+
+    def is_connected(self, u, v):
+
+        """ Return True if nodes u and v are connected by roads. """
+
+        return bool(self.component[u] == self.component[v])
+
+    def get_shortest_path(self, u, v):
+
+        """ Return (length, nodes) of the shortest path along the roads from
+        node u to node v, where nodes are the nodes along it from u to v, or
+        (inf, None) if they are not connected.
+        """
+
+        if (not self.is_connected(u, v)):
+            return (float("inf"), None)
+
+        n = len(self.node_coords)
+        no_landmarks = np.zeros((n, 0), dtype=np.float64)
+
+        (length, last, n_touched) = kernels.astar_abstract(
+            self._indptr, self._indices, self._costs,
+            self.node_coords[:, 0], self.node_coords[:, 1], np.zeros(n, dtype=np.int64),
+            np.array([u], dtype=np.int64), np.zeros(1), np.array([v], dtype=np.int64), np.zeros(1),
+            int(self.node_coords[v, 0]), int(self.node_coords[v, 1]), 0, 1.0, 1.0,
+            no_landmarks, no_landmarks, np.zeros(0), np.zeros(0),
+            float("inf"), self._dist, self._preds, self._heur, self._touched
+        )
+
+        nodes = []
+        w = last
+
+        while (w >= 0):
+            nodes.append(w)
+            w = self._preds[w]
+
+        self._dist[self._touched[:n_touched]] = float("inf")
+
+        return (length, np.array(nodes[::-1], dtype=np.int64))
+
+    def get_path_coords(self, nodes):
+
+        """ Return the (x, y) coordinates of the tiles along a path of
+        successive nodes (see get_shortest_path), taking the shortest edge
+        between each pair.
+        """
+
+        parts = [self.node_coords[nodes[:1]]]
+
+        for (u, v) in zip(nodes[:-1].tolist(), nodes[1:].tolist()):
+            (i0, i1) = (self._indptr[u], self._indptr[u+1])
+            edge = self._edge_ids[i0 + np.searchsorted(self._indices[i0:i1], v)]
+            polyline = self.get_polyline(edge)
+            parts.append((polyline if self.edges[edge, 0] == u else polyline[::-1])[1:])
+
+        return np.concatenate(parts)
+
+    def _build_graph(self):
+
+        """ Build the symmetric CSR adjacency of the nodes (without loops,
+        and only the shortest edge between any two nodes), the edge behind
+        every entry, the connected components and the search buffers.
+        """
+
+        n = len(self.node_coords)
+        (lo, hi) = (self.edges.min(axis=1), self.edges.max(axis=1))
+        order = np.lexsort((self.lengths, hi, lo))
+        order = order[lo[order] != hi[order]]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (lo[order][1:] != lo[order][:-1]) | (hi[order][1:] != hi[order][:-1])
+        kept = order[first]
+
+        src = np.concatenate((lo[kept], hi[kept]))
+        dst = np.concatenate((hi[kept], lo[kept]))
+        ids = np.concatenate((kept, kept))
+        order = np.lexsort((dst, src))
+
+        self._indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=self._indptr[1:])
+        self._indices = dst[order]
+        self._edge_ids = ids[order]
+        self._costs = self.lengths[self._edge_ids].astype(np.float64)
+
+        graph = scipy.sparse.csr_matrix((self._costs, self._indices, self._indptr), shape=(n, n))
+        self.component = scipy.sparse.csgraph.connected_components(graph, directed=False)[1]
+
+        self._dist = np.full(n, float("inf"), dtype=np.float64)
+        self._preds = np.full(n, -1, dtype=np.int64)
+        self._heur = np.zeros(n, dtype=np.float64)
+        self._touched = np.zeros(n, dtype=np.int64)
+
+    @staticmethod
+    def _find_loops(roads, is_node):
+
+        """ Return the flat indices of the first tile (in matrix order) of
+        every road loop without nodes.
+        """
+
+        (labels, n) = ndi.label(roads & ~is_node)
+        (dim_y, dim_x) = roads.shape
+        attached = np.zeros(n + 1, dtype=bool)
+        (ys, xs) = np.nonzero(is_node)
+
+        for (dx, dy) in zip(DX, DY):
+            (nx, ny) = (xs + dx, ys + dy)
+            valid = (nx >= 0) & (ny >= 0) & (nx < dim_x) & (ny < dim_y)
+            attached[labels[ny[valid], nx[valid]]] = True
+
+        tiles = np.flatnonzero(labels)
+        (found, first) = np.unique(labels.flat[tiles], return_index=True)
+
+        return tiles[first[~attached[found]]]
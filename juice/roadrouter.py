@@ -0,0 +1,120 @@
+from logging import debug, info, warning, error
+
+import numpy as np
+
+from juice import backend
+from juice import kernels
+
+class RoadRouter:
+
+    """ Road searches between pairs of tiles over the state of a RoadLayer:
+    the weights of tiles, the elevation deltas and the road matrix and, for
+    A*, the distances to the nearest road (see RoadLayer._generate_road).
+    The state is read only, and may be shared with routers in other
+    processes (see backend.SharedArrays); the search buffers are private to
+    the router.
+
+    Routes are returned as (found, path, window, reached): the flat indices
+    of the road tiles, and the tiles reached by the search (whose distance
+    was set), as a window (x0, y0, w, h) of the map and a mask over the
+    window packed by np.packbits, which is compact to pass between
+    processes (see get_reached).
+    """
+
+    def __init__(self, weights, elev_deltas, roads, road_dist, mp_road, mp_elev, min_weight):
+        dim = roads.shape[0]
+
+        self.weights = weights
+        self.elev_deltas = elev_deltas
+        self.roads = roads
+        self.road_dist = road_dist
+        self.mp_road = mp_road
+        self.mp_elev = mp_elev
+        self.min_weight = min_weight
+
+        self._distm = np.full((dim, dim), float("inf"), dtype=np.float64)
+        self._path = np.empty(dim * dim, dtype=np.int64)
+
+        if (road_dist is not None):
+            self._preds = np.full((dim, dim), kernels.NO_DIRECTION, dtype=np.uint8)
+            self._touched = np.zeros(dim * dim, dtype=np.int64)
+
+    def route(self, sx, sy, ex, ey):
+
+        """ Search a road from (sx, sy) to (ex, ey), by A* if the router
+        has road distances and by Dijkstra's algorithm otherwise. Returns
+        (found, path, window, reached) as described above.
+        """
+
+        distm = self._distm
+        dim = distm.shape[0]
+
+        if (self.road_dist is not None):
+            (found, n_touched, n_path) = kernels.astar(
+                self.weights, self.elev_deltas, self.roads, self.road_dist,
+                distm, self._preds, self._touched, self._path,
+                sx, sy, ex, ey, self.mp_road, self.mp_elev, self.min_weight
+            )
+
+            (ys, xs) = np.divmod(self._touched[:n_touched], dim)
+            window = (xs.min(), ys.min(), xs.max() - xs.min() + 1, ys.max() - ys.min() + 1)
+        else:
+            found = kernels.dijkstra(
+                self.weights, self.elev_deltas, self.roads, distm,
+                sx, sy, ex, ey, self.mp_road, self.mp_elev
+            )
+            n_path = kernels.trace_distances(distm, ex, ey, self._path) if found else 0
+
+            rows = np.flatnonzero(np.isfinite(distm).any(axis=1))
+            cols = np.flatnonzero(np.isfinite(distm[rows[0]:rows[-1] + 1]).any(axis=0))
+            window = (cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+
+        (x0, y0, w, h) = (int(v) for v in window)
+        box = distm[y0:y0 + h, x0:x0 + w]
+        reached = np.packbits(np.isfinite(box))
+        box[...] = float("inf")
+
+        return (bool(found), self._path[:n_path].copy(), (x0, y0, w, h), reached)
+
+    def route_pairs(self, coords):
+
+        """ Route between each (sx, sy, ex, ey) of coords in turn, returning
+        the list of routes.
+        """
+
+        return [self.route(*c) for c in coords]
+
+    @staticmethod
+    def get_reached(window, reached):
+
+        """ Return the mask of tiles reached by a route over its window, as
+        a boolean array of h by w.
+        """
+
+        (x0, y0, w, h) = window
+        return np.unpackbits(reached, count=w * h).view(np.bool_).reshape(h, w)
+
+# The router of a worker process and its shared state (see init_worker)
+
+_router = None
+_shared = None
+
+def init_worker(specs, mp_road, mp_elev, min_weight):
+
+    """ Initialize a worker process of a backend.process_pool: attach to the
+    state of a road layer in shared memory, given by the specs of
+    (weights, elevation deltas, roads) and, for A*, road distances.
+    """
+
+    global _router, _shared
+
+    _shared = backend.SharedArrays(specs=specs)
+    (weights, elev_deltas, roads) = _shared.arrays[:3]
+    road_dist = _shared.arrays[3] if len(specs) > 3 else None
+    _router = RoadRouter(weights, elev_deltas, roads, road_dist, mp_road, mp_elev, min_weight)
+
+def route_pairs(coords):
+
+    """ Route in a worker process, see RoadRouter.route_pairs. """
+
+    return _router.route_pairs(coords)
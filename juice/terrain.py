@@ -12,13 +12,18 @@ import pyglet
 from PIL import Image
 
 from juice.heightmap import Heightmap
+from juice.terrainfields import TerrainFields
+from juice.viewshed import Viewshed
 from juice.terrainlayer import \
     TerrainLayer, RiverLayer, DeltaLayer, SeaLayer, BiomeLayer, CityLayer, RoadLayer
 
 class Terrain:
 
     """ Terrain is a compositor class consisting of an underlying Heightmap
-    and several TerrainLayers. Note on threshold constants: the condition is
+    and several TerrainLayers. Derived fields (slopes, distances etc.) shared
+    by the layers are available through the `fields` attribute, see
+    TerrainFields, and line-of-sight queries through the `viewshed`
+    attribute, see Viewshed. Note on threshold constants: the condition is
     ruled to apply _at_ threshold as well as above or below. Note on
     nomenclature: "height" means self.heightmap.matrix value at a given
     coordinate.
@@ -86,6 +91,8 @@ class Terrain:
             #min_cell_size=4, noise_range=75, blur_sigma=0.65
         )
         self.dim = dim
+        self.fields = TerrainFields(self)
+        self.viewshed = Viewshed(self)
 
         self._layers = []
         self._colormap = {}
@@ -94,6 +101,7 @@ class Terrain:
 
     def generate(self, post_generate_cb=None):
         self.heightmap.generate()
+        self.fields.invalidate()
 
         if (callable(post_generate_cb)):
             post_generate_cb(self.heightmap)
@@ -101,6 +109,11 @@ class Terrain:
         for layer in (self._layers):
             layer.generate()
 
+            # Layers may modify other layers' matrices in place (e.g.
+            # DeltaLayer), so drop all derived fields
+
+            self.fields.invalidate()
+
             if (callable(post_generate_cb)):
                 post_generate_cb(layer)
     
@@ -216,6 +229,11 @@ class Terrain:
             lambda x: (255, 0, 0) if (x == 1) else (0, 255, 0)
         layer_colorers[RoadLayer] = debug_colorer((127, 0, 0))
 
+        # Colors are resolved once per distinct layer value and painted onto
+        # a pixel array in bulk
+
+        pixels = np.array(img)
+
         for layer in self.get_layers():
             try:
                 colorer = layer_colorers[type(layer)]
@@ -223,6 +241,13 @@ class Terrain:
                 debug("No colorer for {} found".format(layer.__class__.__name__))
                 continue
 
-            for (x, y, v) in layer.get_points():
-                color = colorer(v) if callable(colorer) else colorer
-                img.putpixel((x, y), color)
+            (xs, ys, vs) = layer.get_point_arrays()
+            (values, value_is) = np.unique(vs, return_inverse=True)
+            colors = np.array(
+                [colorer(v) if callable(colorer) else colorer for v in values.tolist()],
+                dtype=np.uint8
+            ).reshape(-1, 3)
+
+            pixels[ys, xs] = colors[value_is]
+
+        img.paste(Image.fromarray(pixels, "RGB"))
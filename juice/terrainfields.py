@@ -0,0 +1,181 @@
+
+import collections
+import functools
+
+from logging import debug, info, warning, error
+
+import numpy as np
+import scipy.ndimage as ndi
+import scipy.signal
+
+from juice.terrainlayer import SeaLayer, RiverLayer
+
+_CacheEntry = collections.namedtuple("_CacheEntry", ["value", "sources"])
+
+def _field(*sources):
+
+    """ Decorator turning a compute method of TerrainFields into a cached,
+    read-only property. sources lists what the field is derived from: the
+    string "heightmap" or TerrainLayer subclasses.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapped(self):
+            return self._get(fn.__name__, fn, sources)
+
+        wrapped.sources = sources
+        return property(wrapped)
+
+    return decorator
+
+class TerrainFields:
+
+    """ A cache of fields derived from a Terrain's heightmap and layers,
+    shared by the layers themselves and by gameplay queries. Each field is
+    computed (with vectorized operations) on first access and kept until
+    one of its sources changes. A source is considered changed if the
+    matrix object it refers to has been replaced (e.g. by regeneration);
+    in-place edits of a source matrix must be announced by calling
+    invalidate().
+
+    Fields (all matrices in numpy order, i.e. [y, x]):
+
+    elev_deltas    - Absolute height difference to the edge neighbor in
+                     each of DIRECTIONS, shape (4, dim, dim). Undefined (0)
+                     where the neighbor would be off the map.
+    slope          - Maximum of elev_deltas over all directions.
+    sea_distance   - Euclidean distance to the nearest sea tile.
+    river_distance - Euclidean distance to the nearest river tile.
+    sea_adjacent   - Boolean, true where any (edge or corner) neighbor is sea.
+    river_adjacent - Boolean, true where any (edge or corner) neighbor is
+                     a river.
+    """
+
+    # Edge neighbor offsets (dx, dy) in the order used by
+    # GameFieldLayer.foreach_matrix_edge_neighbor: N, E, S, W.
+
+    DIRECTIONS = ((0, -1), (1, 0), (0, 1), (-1, 0))
+
+    HEIGHTMAP = "heightmap"
+
+    def __init__(self, terrain):
+        self.terrain = terrain
+        self._cache = {}
+
+    def invalidate(self, *sources):
+
+        """ Drop cached fields derived from any of the given sources (the
+        string "heightmap" or TerrainLayer subclasses). Without arguments, drop
+        all fields.
+        """
+
+        if (not sources):
+            self._cache.clear()
+            return
+
+        for (name, field_sources) in self._sources_by_name().items():
+            if (any(s in field_sources for s in sources)):
+                self._cache.pop(name, None)
+
+    @_field(HEIGHTMAP)
+    def elev_deltas(self):
+        h = self.terrain.heightmap.matrix.astype(np.int16)
+        deltas = np.zeros((len(self.DIRECTIONS),) + h.shape, dtype=np.uint8)
+
+        for (i, (dx, dy)) in enumerate(self.DIRECTIONS):
+            (src, dst) = self._shifted_slices(dx, dy)
+            deltas[i][src] = np.abs(h[src] - h[dst])
+
+        return deltas
+
+    @_field(HEIGHTMAP)
+    def slope(self):
+        return np.max(self.elev_deltas, axis=0)
+
+    @_field(SeaLayer)
+    def sea_distance(self):
+        return self._distance_to(self._layer_matrix(SeaLayer) != 0)
+
+    @_field(RiverLayer)
+    def river_distance(self):
+        return self._distance_to(self._layer_matrix(RiverLayer) != 0)
+
+    @_field(SeaLayer)
+    def sea_adjacent(self):
+        return self._count_neighbors(self._layer_matrix(SeaLayer) != 0) > 0
+
+    @_field(RiverLayer)
+    def river_adjacent(self):
+        return self._count_neighbors(self._layer_matrix(RiverLayer) != 0) > 0
+
+    def _get(self, name, fn, sources):
+
+        """ Return a cached field, (re)computing it if absent or stale. """
+
+        current = tuple(self._source_matrix(s) for s in sources)
+        entry = self._cache.get(name)
+
+        if (entry and all(a is b for (a, b) in zip(entry.sources, current))):
+            return entry.value
+
+        debug("Computing terrain field {}".format(name))
+        value = fn(self)
+        self._cache[name] = _CacheEntry(value, current)
+
+        return value
+
+    def _source_matrix(self, source):
+        if (source == self.HEIGHTMAP):
+            return self.terrain.heightmap.matrix
+        return self._layer_matrix(source)
+
+    def _layer_matrix(self, ltype):
+        return self.terrain.get_layer_by_type(ltype).matrix
+
+    @classmethod
+    def _sources_by_name(cls):
+
+        """ Return a dict mapping field names to their sources. """
+
+        return {
+            k: v.fget.sources for (k, v) in vars(cls).items()
+            if (isinstance(v, property) and hasattr(v.fget, "sources"))
+        }
+
+    @staticmethod
+    def _shifted_slices(dx, dy):
+
+        """ Return a pair of slice tuples (src, dst) such that m[dst] are the
+        neighbors at offset (dx, dy) of m[src].
+        """
+
+        def axis_slices(d):
+            if (d > 0):
+                return (slice(0, -d), slice(d, None))
+            elif (d < 0):
+                return (slice(-d, None), slice(0, d))
+            return (slice(None), slice(None))
+
+        (src_x, dst_x) = axis_slices(dx)
+        (src_y, dst_y) = axis_slices(dy)
+
+        return ((src_y, src_x), (dst_y, dst_x))
+
+    @staticmethod
+    def _count_neighbors(mask):
+
+        """ Count the (edge and corner) neighbors of each tile set in a boolean
+        matrix.
+        """
+
+        kernel = np.ones((3, 3), dtype=np.uint8)
+        kernel[1, 1] = 0
+
+        return scipy.signal.convolve2d(mask.astype(np.uint8), kernel, mode="same")
+
+    @staticmethod
+    def _distance_to(mask):
+        if (not mask.any()):
+            return np.full(mask.shape, float("inf"))
+        return ndi.distance_transform_edt(~mask)
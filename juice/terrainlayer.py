@@ -1,5 +1,8 @@
 
 import abc
+import collections
+import concurrent.futures
+import contextlib
 import heapq
 import math
 import random
@@ -9,10 +12,23 @@ import functools
 from logging import debug, info, warning, error
 
 import numpy as np
+import scipy.ndimage as ndi
 import scipy.signal
-
-from juice.city             import City
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from juice                  import backend
+from juice                  import kernels
+from juice                  import roadrouter
+from juice.city             import CitySet
+from juice.cityfields       import CityFields, FieldSpec
+from juice.flowfield        import FlowField
 from juice.heightmap        import Heightmap
+from juice.movementfields   import MovementFields
+from juice.rivernetwork     import RiverNetwork
+from juice.roadnetwork      import RoadNetwork
+from juice.roadrouter       import RoadRouter
+from juice.routeservice     import RouteService
 from juice.gamefieldlayer   import GameFieldLayer
 from juice.tileclassifier   import \
     TileClassifierSolid, TileClassifierLine, TileClassifierDelta, TileClassifierSimple
@@ -50,11 +66,11 @@ class TerrainLayer(GameFieldLayer, metaclass=abc.ABCMeta):
     def generate(self):
         pass
 
-    def _init_matrix(self):
+    def _init_matrix(self, dtype=np.uint8):
 
         """ Init the matrix and return it. """
 
-        self.matrix = np.zeros(np.shape(self.terrain.heightmap.matrix), dtype=np.uint8)
+        self.matrix = np.zeros(np.shape(self.terrain.heightmap.matrix), dtype=dtype)
         return self.matrix
 
     def _check_requirements(self):
@@ -93,25 +109,59 @@ class TerrainLayer(GameFieldLayer, metaclass=abc.ABCMeta):
 
         @functools.wraps(fn)
         def wrapped(tlayer):
-            cfier_args = {}
-            
-            for (k, v) in vars(tlayer).items():
-                m = re.match(r"classify_(.*)", k)
-                if (not m):
-                    continue
-                cfier_args[m.group(1)] = v
-
-            try:
-                cfier = tlayer.classifier
-            except AttributeError:
-                cfier = TileClassifierSolid
-
             fn(tlayer)
-            cx = cfier(tlayer, **cfier_args).classify()
+            cx = tlayer._make_classifier().classify()
             tlayer.classification = cx
 
         return wrapped
         
+    def reclassify(self, xs, ys):
+
+        """ Classify anew, in place, around the (x, y) tiles xs, ys after the
+        matrix was changed there, e.g. by editing, instead of classifying the
+        whole layer again (see TileClassifier.reclassify); illegal tiles are
+        removed from the matrix, as are tiles turned illegal in turn. Returns
+        arrays (xs, ys) of the tiles whose classification changed, e.g. for
+        redrawing.
+        """
+
+        return self._make_classifier().reclassify(self.classification, xs, ys)
+
+    def reclassify_rect(self, x, y, w, h):
+
+        """ Classify anew around the rectangle of w x h tiles at (x, y), clipped
+        to the map (see reclassify).
+        """
+
+        (dim_y, dim_x) = self.matrix.shape
+        (x0, y0) = (max(x, 0), max(y, 0))
+        (x1, y1) = (min(x + w, dim_x), min(y + h, dim_y))
+        (ys, xs) = np.mgrid[y0:max(y1, y0), x0:max(x1, x0)]
+
+        return self.reclassify(xs.ravel(), ys.ravel())
+
+    def _make_classifier(self):
+
+        """ Return a classifier of the layer: an instance of the classifier
+        attribute, by default TileClassifierSolid, with the options of the
+        classify_X attributes.
+        """
+
+        cfier_args = {}
+        
+        for (k, v) in vars(self).items():
+            m = re.match(r"classify_(.*)", k)
+            if (not m):
+                continue
+            cfier_args[m.group(1)] = v
+
+        try:
+            cfier = self.classifier
+        except AttributeError:
+            cfier = TileClassifierSolid
+
+        return cfier(self, **cfier_args)
+
     @staticmethod
     def defer_classified(fn):
         
@@ -153,136 +203,267 @@ class RiverLayer(TerrainLayer):
         self.classifier = TileClassifierLine
         self.classify_extend = False
 
+        self.fill_depressions = True
+        self.conditioned = None
+        self.flowfield = None
+        self.parallel_batch = 4096
+        self.network = None
+
     @TerrainLayer.classified
     def generate(self):
 
         """ Generate the river system based on terrain's heightmap. Rivers flow
         from mountains (highest locations on the heighmap) towards the sea.
-        Rivers that fail (e.g. run into itself) are removed.
+        Rivers that fail (e.g. run into itself) are removed. If
+        fill_depressions is true, rivers are routed over a conditioned copy
+        of the heightmap (see _condition_heightmap) where every tile drains
+        to the sea, so rivers no longer fail by ending up in a pit. The
+        topology of the river system is indexed in the `network` attribute
+        (a RiverNetwork).
+
+        With several workers configured (see backend.set_workers), rivers
+        are traced in parallel (see _trace_rivers_parallel), with results
+        identical to serial tracing.
         """
 
         terrain = self.terrain
-        mthr = terrain.MOUNTAIN_THRESHOLD
-        matrix = self._init_matrix()
         hmatrix = terrain.heightmap.matrix
-        mtn_coords = np.array([])
-        rvr_source_coords = mtn_coords
 
-        # Extract all coordinates above mountain threshold from
-        # terrain's heightmap
+        # Pick river sources among mountain tiles; river IDs are stored in the
+        # narrowest type able to hold them
 
-        try:
-            mtn_coords = np.dstack(np.where(hmatrix >= mthr))[0]
-        except KeyError as e:
-            pass
-
-        # Shuffle mountain coordinates and pick river sources
+        rvr_source_coords = self._sample_sources()
+        self._init_matrix(dtype=np.min_scalar_type(len(rvr_source_coords)))
 
-        if (len(mtn_coords)):
-            n_river_tiles = int(len(mtn_coords) * terrain.RIVER_DENSITY)
+        # Rivers follow the lowest suitable neighbor as ranked by a flow field
+        # over the (conditioned) heightmap; a random fractional part added to
+        # the heights breaks ties
 
-            if (n_river_tiles < terrain.MIN_RIVER_SOURCES):
-                n_river_tiles = min(len(mtn_coords), terrain.MIN_RIVER_SOURCES)
+        fractions = np.random.random(hmatrix.shape)
 
-            np.random.shuffle(mtn_coords)
-            rvr_source_coords = mtn_coords[0:n_river_tiles]
+        if (self.fill_depressions):
+            self.flowfield = FlowField(self._condition_heightmap(fractions))
         else:
-            rvr_source_coords = mtn_coords
+            self.flowfield = FlowField(hmatrix + fractions)
 
-        # For each river source, generate a river
+        (ok, path, path_ends) = self._trace_rivers(rvr_source_coords)
+        debug("{} of {} rivers generated".format(np.count_nonzero(ok), len(ok)))
 
-        for (i, p) in enumerate(rvr_source_coords, start=1):
-            if (i > 255):
-                break
-            self._generate_river(p[1], p[0], i)
+        smatrix = terrain.get_layer_by_type(SeaLayer).matrix
+        self.network = RiverNetwork(smatrix, path, path_ends, ok)
 
-    def _generate_river(self, x, y, river_id):
+    def _sample_sources(self):
 
-        """ Generate a river starting from (x, y). Returns True on success,
-        False otherwise.
+        """ Pick a random sample of distinct tiles at or above the mountain
+        threshold, sized according to RIVER_DENSITY, as an array of (y, x).
+        Mountain coordinates are never materialized as a whole: random ranks
+        among mountain tiles are drawn and resolved to coordinates through
+        per-row counts of a single mountain mask, visiting only the rows
+        sampled from.
         """
 
-        hmatrix = self.terrain.heightmap.matrix
-        smatrix = self.terrain.get_layer_by_type(SeaLayer).matrix
-        matrix = self.matrix
+        terrain = self.terrain
+        mthr = terrain.MOUNTAIN_THRESHOLD
+        hmatrix = terrain.heightmap.matrix
 
-        if (not self._confirm_square_ok(x, y, river_id, [], 0, False)):
-            return False
-        if (river_id >= 2 ** (matrix.dtype.itemsize * 8)):
-            raise ValueError(
-                "River ID {} is larger than can be held by {}".format(river_id, matrix.dtype))
+        mountains = hmatrix >= mthr
+        row_counts = np.count_nonzero(mountains, axis=1)
+        row_ends = np.cumsum(row_counts)
+        n_mtn = int(row_ends[-1]) if len(row_ends) else 0
+        n = max(int(n_mtn * terrain.RIVER_DENSITY), min(n_mtn, terrain.MIN_RIVER_SOURCES))
+        coords = np.zeros((n, 2), dtype=np.int64)
 
-        while True:
-            ok_neighbors = []
+        if (not n):
+            return coords
 
-            if (smatrix[y, x] > 0):
-                matrix[y, x] = river_id # For DeltaLayer generation, removed therein
-                return True
-            elif (self._is_square_converging(x, y, river_id)):
-                matrix[y, x] = river_id
-                return True
-            matrix[y, x] = river_id
+        # Draw distinct ranks in random order: by rejection if sparse,
+        # otherwise by permutation
 
-            # Pick all suitable edge-neighbors for current position, sort by height
-            # and use the lowest suitable neighbor point for continuing. Delete river
-            # and fail if no suitabe neighbors.
+        if (n * 2 > n_mtn):
+            ranks = np.random.permutation(n_mtn)[:n]
+        else:
+            ranks = np.array([], dtype=np.int64)
 
-            self.foreach_edge_neighbor(
-                self._confirm_square_ok, x, y, river_id, ok_neighbors, 1, True)
-            random.shuffle(ok_neighbors)
-            ok_neighbors.sort(key=lambda p: hmatrix[p[1], p[0]])
+            while (len(ranks) < n):
+                ranks = np.concatenate((ranks, np.random.randint(0, n_mtn, size=n)))
+                first_is = np.unique(ranks, return_index=True)[1]
+                ranks = ranks[np.sort(first_is)][:n]
 
-            if (len(ok_neighbors)):
-                p = ok_neighbors[0]
-                x = p[0]
-                y = p[1]
-            else:
-                matrix[matrix == river_id] = 0
-                return False
+        # Resolve ranks to coordinates row by row
+
+        rows = np.searchsorted(row_ends, ranks, side="right")
+        offsets = ranks - (row_ends[rows] - row_counts[rows])
+        by_row = np.argsort(rows, kind="stable")
+        row_starts = np.flatnonzero(np.diff(rows[by_row], prepend=-1))
+
+        for group in np.split(by_row, row_starts[1:]):
+            y = rows[group[0]]
+            coords[group, 0] = y
+            coords[group, 1] = np.flatnonzero(mountains[y])[offsets[group]]
 
-        raise RuntimeError("Should never execute this line")
+        return coords
 
-    def _confirm_square_ok(
-        self, x, y, river_id, ok_neighbors, neigh_rivers_threshold, allow_others):
+    def _condition_heightmap(self, fractions):
 
-        """ Helper routine to confirm that a position is OK for a river. A
-        position is suitable if itself or not more than neigh_rivers_threshold
-        of its edge neighbors are a river square. If allow_others is true, other
-        river IDs are ignored.
+        """ Fill the depressions of a working copy of the heightmap by
+        priority-flood from the sea (kernels.priority_flood, O(N)),
+        stored in the `conditioned` attribute. Returns the flood order as
+        flow field keys: the order increases with the conditioned height and
+        every land tile has a neighbor of lower order, ties being broken by
+        fractions. Without any sea, returns the heightmap plus fractions.
+        """
+
+        hmatrix = self.terrain.heightmap.matrix
+        smatrix = self.terrain.get_layer_by_type(SeaLayer).matrix
+        filled = np.full(hmatrix.shape, -1, dtype=np.int16)
+        order = np.zeros(hmatrix.shape, dtype=np.int32)
+
+        if (not smatrix.any()):
+            self.conditioned = hmatrix.copy()
+            return hmatrix + fractions
+
+        kernels.priority_flood(hmatrix, fractions, smatrix > 0, filled, order)
+        self.conditioned = filled.astype(np.uint8)
+
+        return order
+
+    def _trace_rivers(self, source_coords):
+
+        """ Generate rivers from an array of (y, x) source coordinates, with
+        successive river IDs starting from 1. Returns (ok, path, path_ends):
+        a boolean array of successes and the flat indices (y * dim + x) of
+        the tiles visited by river i, ending at path_ends[i] (see
+        kernels.trace_rivers; failed rivers included).
+
+        A river source must be free of rivers along with its edge neighbors.
+        A river ends upon reaching the sea or converging with another river,
+        otherwise continues to the lowest-ranked edge neighbor in the flow
+        field which is not part of the river and not adjacent to another of
+        its tiles. Rivers failing to find such a neighbor are removed, in
+        O(path) by following the recorded steps. The tracing itself is done
+        by kernels.trace_rivers.
         """
 
         matrix = self.matrix
-        predicate = None
-        n_river_nbrs = 0
+        n = len(source_coords)
 
-        if (allow_others):
-            predicate = (lambda x, y: matrix[y, x] != river_id)
-        else:
-            predicate = (lambda x, y: matrix[y, x] == 0)
+        if (n >= 2 ** (matrix.dtype.itemsize * 8)):
+            raise ValueError(
+                "River ID {} is larger than can be held by {}".format(n, matrix.dtype))
 
-        def confirm_nbrs_not_river(x, y):
-            nonlocal n_river_nbrs
-            if (not predicate(x, y)):
-                n_river_nbrs += 1
+        steps = np.full(matrix.shape, FlowField.NO_DIRECTION, dtype=np.uint8)
+        occupancy = np.zeros(matrix.shape, dtype=np.uint8)
+        coords = np.reshape(source_coords, (-1, 2)).astype(np.int64)
+        sources = (coords[:, 1].copy(), coords[:, 0].copy(), np.arange(1, n + 1, dtype=np.int64))
 
-        self.foreach_edge_neighbor(confirm_nbrs_not_river, x, y)
+        if (backend.get_workers() > 1 and n > 1):
+            return self._trace_rivers_parallel(steps, occupancy, *sources)
 
-        if (predicate(x, y) and n_river_nbrs <= neigh_rivers_threshold): #*
-            ok_neighbors.append((x, y))
-            return True
+        return self._trace(matrix, steps, occupancy, *sources, keep=True)
+
+    def _trace_rivers_parallel(self, steps, occupancy, xs, ys, ids):
+
+        """ Trace rivers speculatively in parallel, in batches of
+        parallel_batch rivers. Each batch is split among the workers, which
+        trace their rivers independently against a snapshot of the matrix
+        (on private copies), each river being removed again after tracing.
+        The paths are then merged in source order by kernels.merge_rivers;
+        rivers whose path depends on a tile changed by an earlier river of
+        the batch are traced again. The result is thus identical to serial
+        tracing. steps and occupancy are the working matrices of
+        _trace_rivers. Returns (ok, path, path_ends) as _trace_rivers.
+        """
 
-    def _is_square_converging(self, x, y, river_id):
         matrix = self.matrix
-        is_converging = False
+        n_workers = backend.get_workers()
+        ok = np.zeros(len(ids), dtype=np.bool_)
+        paths = []
+        ends = []
+        n_tiles = 0
+        copies = [(np.empty_like(matrix), np.empty_like(occupancy), steps.copy())
+            for i in range(n_workers)]
+
+        def trace_speculative(copy, chunk):
+            (wmatrix, woccupancy, wsteps) = copy
+            return self._trace(
+                wmatrix, wsteps, woccupancy, xs[chunk], ys[chunk], ids[chunk], keep=False)
+
+        with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+            for b0 in range(0, len(ids), self.parallel_batch):
+                b1 = min(b0 + self.parallel_batch, len(ids))
+                snapshot = matrix.copy()
+
+                for (wmatrix, woccupancy, wsteps) in copies:
+                    np.copyto(wmatrix, matrix)
+                    np.copyto(woccupancy, occupancy)
+
+                chunks = np.array_split(np.arange(b0, b1), n_workers)
+                results = list(executor.map(trace_speculative, copies, chunks))
+
+                # Join the workers' paths, then merge
+
+                lengths = [r[2][-1] if len(r[2]) else 0 for r in results]
+                offsets = np.cumsum([0] + lengths[:-1])
+                bok = np.concatenate([r[0] for r in results])
+                path = np.concatenate([r[1][:l] for (r, l) in zip(results, lengths)])
+                path_ends = np.concatenate([r[2] + o for (r, o) in zip(results, offsets)])
+                retraced = {}
+                i = 0
+
+                while (i < b1 - b0):
+                    i = kernels.merge_rivers(
+                        matrix, snapshot, steps, occupancy, ids[b0:b1], bok, path, path_ends, i)
+
+                    if (i < b1 - b0):
+                        j = b0 + i
+                        (rok, rpath, rpath_ends) = self._trace(
+                            matrix, steps, occupancy,
+                            xs[j:j+1], ys[j:j+1], ids[j:j+1], keep=True)
+                        bok[i] = rok[0]
+                        retraced[i] = rpath[:rpath_ends[0]]
+                        i += 1
+
+                debug("Rivers {} .. {}: {} traced again".format(b0, b1 - 1, len(retraced)))
+
+                # Substitute the paths of rivers traced again
+
+                if (retraced):
+                    starts = np.concatenate(([0], path_ends[:-1]))
+                    path = np.concatenate([
+                        retraced[i] if i in retraced else path[starts[i]:path_ends[i]]
+                        for i in range(b1 - b0)
+                    ])
+                    path_ends = np.cumsum([len(retraced[i]) if i in retraced
+                        else path_ends[i] - starts[i] for i in range(b1 - b0)])
+
+                ok[b0:b1] = bok
+                paths.append(path[:path_ends[-1]])
+                ends.append(path_ends + n_tiles)
+                n_tiles += path_ends[-1]
+
+        return (ok, np.concatenate(paths), np.concatenate(ends))
+
+    def _trace(self, matrix, steps, occupancy, xs, ys, ids, keep):
+
+        """ Run kernels.trace_rivers on a matrix, growing the path buffer as
+        needed. Returns (ok, path, path_ends).
+        """
 
-        def have_other_river_nbrs(x, y):
-            nonlocal is_converging
-            if (matrix[y, x] > 0 and matrix[y, x] != river_id):
-                is_converging = True
-                return False
+        smatrix = self.terrain.get_layer_by_type(SeaLayer).matrix
+        ok = np.zeros(len(ids), dtype=np.bool_)
+        path = np.empty(max(len(ids) * 64, 1024), dtype=np.int64)
+        path_ends = np.zeros(len(ids), dtype=np.int64)
+        i = 0
+
+        while (True):
+            i = kernels.trace_rivers(
+                matrix, smatrix, self.flowfield.order, steps, occupancy,
+                xs, ys, ids, ok, keep, path, path_ends, i)
 
-        self.foreach_edge_neighbor(have_other_river_nbrs, x, y)
-        return is_converging
+            if (i == len(ids)):
+                return (ok, path, path_ends)
+
+            path = np.resize(path, len(path) * 2)
 
 class DeltaLayer(TerrainLayer):
 
@@ -296,6 +477,7 @@ class DeltaLayer(TerrainLayer):
         self._require = (RiverLayer,)        
         self.classifier = TileClassifierDelta
         self.classify_terrain = self.terrain
+        self.network = None
     
     @TerrainLayer.classified
     def generate(self):
@@ -307,7 +489,8 @@ class DeltaLayer(TerrainLayer):
         
         Note that this method is tightly coupled to RiverLayer: river tiles
         extending into the sea and used solely for delta construction are
-        removed from its matrix and classification.
+        removed from its matrix and classification. The deltas are those of
+        RiverLayer's network, which is also exposed as `network`.
         """
         
         matrix = self._init_matrix()
@@ -329,6 +512,32 @@ class DeltaLayer(TerrainLayer):
         matrix[rdelta_coords] = terrain.DELTA_RIVER
         
         self._matrix = matrix
+        self.network = rlayer.network
+
+    def get_mouth(self, x, y):
+
+        """ Return the ID of the river mouth at a delta tile (DELTA_SEA or
+        DELTA_RIVER, the latter belonging to the delta of an adjacent
+        DELTA_SEA tile), or 0. Upstream rivers can then be found through the
+        river network.
+        """
+
+        dim = self.matrix.shape[0]
+
+        for (dx, dy) in ((0, 0),) + tuple(zip(kernels.DX, kernels.DY)):
+            (nx, ny) = (x + dx, y + dy)
+
+            if (nx < 0 or ny < 0 or nx >= dim or ny >= dim):
+                continue
+            elif (self[nx, ny] != self.terrain.DELTA_SEA):
+                continue
+
+            mouth = self.network.get_delta_mouth(nx, ny)
+
+            if (mouth or (dx, dy) == (0, 0)):
+                return mouth
+
+        return 0
 
 class BiomeLayer(TerrainLayer):
     def __init__(self, *args, **kwargs):
@@ -357,13 +566,11 @@ class BiomeLayer(TerrainLayer):
             hmatrix < terrain.MOUNTAIN_THRESHOLD - terrain.BIOME_H_DELTA
         ), 1, 0)
 
-        # Unset areas under rivers and next to the sea. Use a 3x3 convolution
-        # filter on the sea matrix to find beach tiles.
-
-        sconv = scipy.signal.convolve2d(smatrix, np.ones((3, 3)), mode="same")
+        # Unset areas under rivers and next to the sea (beach tiles)
 
         self.matrix = np.where(
-            np.logical_and(np.logical_and(rmatrix == 0, smatrix == 0), sconv == 0),
+            np.logical_and(np.logical_and(rmatrix == 0, smatrix == 0),
+                np.logical_not(terrain.fields.sea_adjacent)),
             self.matrix, 0
         )
 
@@ -385,8 +592,21 @@ class CityLayer(TerrainLayer):
         self._require = (SeaLayer, RiverLayer, BiomeLayer)
         self.classifier = TileClassifierSimple
         
-        self.cities = []
-        self._cityindex = {}
+        self.cities = CitySet()
+        self.placement = self.PLACEMENT_SAMPLE
+
+        # Fields around cities, see CityFields
+
+        self.field_specs = {
+            "influence":    FieldSpec(CityFields.linear_kernel(16), ()),
+            "population":   FieldSpec(CityFields.gaussian_kernel(4), (SeaLayer, RiverLayer))
+        }
+        self.fields = CityFields(self)
+
+    # City placement modes (see generate)
+
+    PLACEMENT_SAMPLE    = "sample"
+    PLACEMENT_POISSON   = "poisson"
         
     @TerrainLayer.classified
     def generate(self):
@@ -394,6 +614,13 @@ class CityLayer(TerrainLayer):
         """ Generate city layer by assigning a score to each allowed land square
         (e.g. by biome and proximity to water), then picking n_cities weighed by
         score.
+
+        With the PLACEMENT_SAMPLE placement, n_cities squares are sampled with
+        replacement and cities too close to each other removed afterwards, so
+        the final number of cities varies. With PLACEMENT_POISSON, cities are
+        placed by score-weighted Poisson-disk sampling (see _place_poisson),
+        which honors the minimum distance directly and places n_cities cities
+        unless the land is full.
         """
 
         terrain = self.terrain
@@ -404,155 +631,293 @@ class CityLayer(TerrainLayer):
         rmatrix = terrain.get_layer_by_type(RiverLayer).matrix
         bmatrix = terrain.get_layer_by_type(BiomeLayer).matrix
 
+        self.fields.invalidate()
+
         landmatrix = self.label_matrix_segments(
             np.where(smatrix == 0, 1, 0), terrain.MIN_POPSUPPORT_SIZE)[0]
         landmatrix = \
             np.where(np.logical_and(landmatrix != 0, rmatrix == 0), 1, 0)
 
-        n_coords = len(np.nonzero(landmatrix)[0])
+        # Score land tiles as a whole: a base score of 1, raised next to
+        # rivers and the sea (see TerrainFields) and lowered in biomes
+
+        (ys, xs) = np.nonzero(landmatrix)
+        n_coords = len(xs)
         n_cities = int(n_coords * terrain.CITY_DENSITY)
-        coord_i = 0
-        coords = []
-        score_vec = np.empty([n_coords])
-        coord_i_vec = np.arange(n_coords)
 
-        def check_river_adjacency(x, y):
-            if (rmatrix[y, x] != 0):
-                return False
+        river_adjacent = terrain.fields.river_adjacent[ys, xs]
+        sea_adjacent = terrain.fields.sea_adjacent[ys, xs]
+        biomes = bmatrix[ys, xs]
 
-        def check_sea_adjacency(x, y):
-            if (smatrix[y, x] != 0):
-                return False
+        score_vec = 1 + 3 * river_adjacent.astype(np.int64) + 3 * sea_adjacent.astype(np.int64)
+        score_vec = score_vec - np.select(
+            (biomes == terrain.BIOME_DESERT, biomes == terrain.BIOME_FOREST), (0.9, 0.5), 0)
 
-        it = np.nditer(matrix, flags=["multi_index"])
+        if (self.placement == self.PLACEMENT_POISSON):
+            self._place_poisson(xs, ys, score_vec, n_cities)
+        else:
+            score_vec /= np.sum(score_vec)
+            city_coord_is = \
+                np.random.choice(np.arange(n_coords), size=n_cities, p=score_vec)
 
-        while (not it.finished):
-            p = it.multi_index
-            x = p[1]; y = p[0]
-            score = 1
+            self.matrix[ys[city_coord_is], xs[city_coord_is]] = 1
+            self._remove_close_cities()
 
-            if (landmatrix[y, x] == 0):
-                it.iternext()
-                continue
+        self._create_objects()
 
-            if (self.foreach_neighbor(check_river_adjacency, x, y) == False):
-                score += 3
-            if (self.foreach_neighbor(check_sea_adjacency, x, y) == False):
-                score += 3
+    def get_field(self, name):
 
-            if (bmatrix[y, x] == terrain.BIOME_DESERT):
-                score -= 0.9
-            elif (bmatrix[y, x] == terrain.BIOME_FOREST):
-                score -= 0.5
+        """ Return a field around the cities (e.g. "influence" or
+        "population") as defined in field_specs; see CityFields.
+        """
 
-            score_vec[coord_i] = score
-            coords.append((x, y))
-            coord_i += 1
-            it.iternext()
+        return self.fields.get(name)
 
-        assert(coord_i == n_coords == len(coords))
+    def add_city(self, x, y):
 
-        score_vec /= np.sum(score_vec)
-        city_coord_is = \
-            np.random.choice(coord_i_vec, size=n_cities, p=score_vec)
+        """ Add a city at (x, y), updating the city set, classification and
+        cached fields. As in generate, cities can only be placed on land
+        off rivers; raises ValueError for tiles off the map, in the sea or on
+        a river.
+        """
 
-        for i in np.nditer(city_coord_is):
-            p = coords[i]; x = p[0]; y = p[1]
-            self.matrix[p[1], p[0]] = 1
+        terrain = self.terrain
+        slayer = terrain.get_layer_by_type(SeaLayer)
+        rlayer = terrain.get_layer_by_type(RiverLayer)
 
-        self._remove_close_cities()
-        self._create_objects()
+        if (x < 0 or y < 0 or x >= terrain.dim or y >= terrain.dim):
+            raise ValueError("Cannot place a city off the map at ({}, {})".format(x, y))
+        elif (slayer[x, y] or rlayer[x, y]):
+            raise ValueError("Cannot place a city on water at ({}, {})".format(x, y))
 
-    def _remove_close_cities(self):
+        if (self[x, y]):
+            return
 
-        """ After layer generation, iterate over cities pair-wise and remove one
-        in every pair whose distance is lower than a threshold.
+        self[x, y] = 1
+        self.cities.add(x, y)
+        self._update_city(x, y, 1)
 
-        TODO: possibly use convolution for a massive speedup.
+    def remove_city(self, x, y):
+
+        """ Remove the city at (x, y), updating the city set, classification
+        and cached fields.
         """
 
-        matrix = self.matrix
+        if (not self[x, y]):
+            return
+
+        self[x, y] = 0
+        self.cities.remove(x, y)
+        self._update_city(x, y, -1)
+
+    def _update_city(self, x, y, sign):
+        self.fields.update(x, y, sign)
+
+        if (self.classification is not None):
+            self.classification.matrix[y, x] = \
+                TileClassifierSimple.TT_NA if sign > 0 else TileClassifierSimple.TT_EMPTY
+
+    def _place_poisson(self, xs, ys, scores, n_cities):
+
+        """ Place up to n_cities cities among the candidate squares (xs[i],
+        ys[i]) by dart throwing in the manner of Bridson's algorithm: the
+        candidates are visited in a random order weighted by score, each one
+        becoming a city unless a city lies within the minimum distance,
+        checked against a background grid (see kernels.poisson_disk).
+
+        The weighted order is that of exponential keys -log(U) / score
+        (Efraimidis-Spirakis), mapped monotonically to 16 bit buckets and
+        radix-sorted, so that placement takes time linear in the number of
+        candidates. Candidates are shuffled before sorting, so that ties
+        within a bucket are broken at random rather than in matrix order.
+        """
+
+        keys = -np.log1p(-np.random.random(len(scores))) / scores
+        buckets = (-np.expm1(-keys) * 0x10000).astype(np.uint16)
+        shuffled = np.random.permutation(len(scores))
+        order = shuffled[np.argsort(buckets[shuffled], kind="stable")]
+
+        city_coord_is = kernels.poisson_disk(
+            xs, ys, order, float(self._get_min_distance()), n_cities, self.terrain.dim)
+
+        if (len(city_coord_is) < n_cities):
+            debug("Placed {} of {} cities".format(len(city_coord_is), n_cities))
+
+        self.matrix[ys[city_coord_is], xs[city_coord_is]] = 1
+
+    def _get_min_distance(self):
+
+        """ Return the distance at or below which cities are too close. """
+
         terrain = self.terrain
-        coords = np.dstack(np.nonzero(self.matrix))[0]
-        d_threshold = min(
+
+        return min(
             terrain.dim // terrain.CITY_CLOSENESS_FACTOR,
             terrain.MAX_CITY_DISALLOW_RADIUS
         )
 
-        def foreach_coord(coords, cb, *extra):
-            x = 0
-            y = 0
+    def _remove_close_cities(self):
 
-            for (i, c) in enumerate(np.nditer(coords, order="C")):
-                if (i % 2 == 0):
-                    y = c
-                else:
-                    x = c
-                    cb(x, y, *extra)
-
-        def remove_close_dests(src_x, src_y, coords, matrix):
-            def check_and_remove(dst_x, dst_y):
-                if (src_x == dst_x and src_y == dst_y):
-                    return
-                elif (matrix[dst_y, dst_x] == 0 or matrix[src_y, src_x] == 0):
-                    return
-                elif (abs(src_x - dst_x) > d_threshold or abs(src_y - dst_y) > d_threshold):
-                    return
-                elif (math.sqrt((src_x - dst_x)**2 + (src_y - dst_y)**2) > d_threshold):
-                    return
-
-                matrix[dst_y, dst_x] = 0
-
-            foreach_coord(coords, check_and_remove)
-
-        foreach_coord(coords, remove_close_dests, coords, matrix)
-        self.matrix = matrix
+        """ After layer generation, remove cities closer to each other than a
+        threshold, keeping the first of them in matrix order. Close pairs are
+        found through the spatial index of a CitySet.
+        """
+
+        cities = CitySet.from_matrix(self.matrix)
+        removed = ~cities.thin(self._get_min_distance())
+        self.matrix[cities.ys[removed], cities.xs[removed]] = 0
     
     def _create_objects(self):
         
-        """ Create the City objects. """
-        
-        i = 0        
-        m = self.matrix
-        coords = np.transpose(np.nonzero(m))
+        """ Create the CitySet of cities. """
         
-        self.cities = []
-        
-        for c in coords:
-            x = c[1]
-            y = c[0]
-            
-            self.cities.append(City(x, y))
-            
-            try:
-                self._cityindex[x]
-            except KeyError:
-                self._cityindex[x] = {}
-            
-            self._cityindex[x][y] = i
-            i += 1
+        self.cities = CitySet.from_matrix(self.matrix)
 
 class RoadLayer(TerrainLayer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._require = (CityLayer,)
         self.classifier = TileClassifierLine
+        self.search = self.SEARCH_DIJKSTRA
+        self.planner = self.PLANNER_RANDOM
+        self.shortcuts = 0.1
+        self.graph_round = 4
+        self.graph_memory = 1 << 28
+        self.parallel_batch = 8
+        self.parallel_reroute = self.REROUTE_EXACT
+        self.local_radius = 32
+        self.local_max_radius = 512
+        self.route_cluster_size = 32
+        self.routes = None
+        self.network = None
+        self.movement_capacity = 16
+        self.movement = None
         
         self._weightmap = None
+        self._min_weight = None
+        self._buffers = None
+        self._graph = None
+
+    # Road search algorithms (see _generate_road and _generate_roads_graph).
+    # All find shortest roads, but break ties differently, so the layouts
+    # differ; SEARCH_DIJKSTRA is the default for the original layouts.
+
+    SEARCH_DIJKSTRA = "dijkstra"
+    SEARCH_ASTAR    = "astar"
+    SEARCH_GRAPH    = "graph"
+
+    # When to route again roads routed in parallel (see
+    # _generate_roads_parallel)
+
+    REROUTE_EXACT   = "exact"
+    REROUTE_COSTS   = "costs"
+    REROUTE_NONE    = "none"
+
+    # Road network planners (see _plan_roads)
+
+    PLANNER_RANDOM  = "random"
+    PLANNER_NETWORK = "network"
         
-    @TerrainLayer.classified
     def generate(self):
+
+        """ Route the roads, classify them and build their RoadNetwork (see
+        get_network).
+        """
+
+        self._generate_roads()
+        self._build_network()
+
+    @TerrainLayer.classified
+    def _generate_roads(self):
         terrain = self.terrain
         cities = terrain.get_layer_by_type(CityLayer).cities
-        n_roads = len(cities) // 2
         
         self._init_matrix()
         self._init_weightmap()
+        self.routes = None
+        self.network = None
+        self.movement = None
         
-        debug("Generating {} roads between {} cities".format(n_roads, len(cities)))
-        
-        for i in range(n_roads):
-            self._generate_road(*random.sample(cities, 2))
+        pairs = self._plan_roads(cities)
+
+        debug("Generating {} roads between {} cities".format(len(pairs), len(cities)))
+
+        if (self.search == self.SEARCH_GRAPH):
+            self._init_graph()
+            self._generate_roads_graph(pairs)
+        elif (len(pairs) > 1 and
+                (backend.get_workers() > 1 or self.parallel_reroute != self.REROUTE_EXACT)):
+            self._generate_roads_parallel(pairs)
+        else:
+            if (self.search == self.SEARCH_ASTAR):
+                self._init_buffers()
+
+            for (start_city, end_city) in pairs:
+                self._generate_road(start_city, end_city)
+
+        self._buffers = None
+        self._graph = None
+
+    def _plan_roads(self, cities):
+
+        """ Return the pairs of Cities to connect by roads, in the order to
+        route them. PLANNER_RANDOM picks len(cities) // 2 random pairs.
+
+        PLANNER_NETWORK plans a connected network instead: candidate edges
+        are those of the Delaunay triangulation of the cities, of which the
+        minimum spanning tree (by distance) is routed, followed by the
+        shortcuts * len(cities) candidate edges with the longest detour over
+        the tree relative to their length, shortest first. Tree edges are
+        ordered breadth-first from the city nearest the centroid, each
+        routed from the city already connected, so that routes can reuse
+        the roads before them.
+        """
+
+        if (self.planner == self.PLANNER_RANDOM):
+            return [random.sample(cities, 2) for i in range(len(cities) // 2)]
+
+        n = len(cities)
+        edges = cities.delaunay_edges()
+
+        if (not len(edges)):
+            return []
+
+        coords = cities.get_coords().astype(np.float64)
+        lengths = np.hypot(*(coords[edges[:, 0]] - coords[edges[:, 1]]).T)
+        candidates = scipy.sparse.coo_matrix((lengths, (edges[:, 0], edges[:, 1])), shape=(n, n))
+        tree = scipy.sparse.csgraph.minimum_spanning_tree(candidates)
+
+        # Tree edges breadth-first from the most central city
+
+        root = int(cities.nearest(*coords.mean(axis=0))[0])
+        (nodes, preds) = scipy.sparse.csgraph.breadth_first_order(tree, root, directed=False)
+        pairs = [(cities[preds[i]], cities[i]) for i in nodes[1:].tolist()]
+
+        # Shortcuts, by detour: tree distance over straight distance
+
+        n_shortcuts = int(self.shortcuts * n)
+        (ti, tj) = tree.nonzero()
+        tree_keys = np.minimum(ti, tj) * n + np.maximum(ti, tj)
+        rest = np.flatnonzero(~np.isin(edges[:, 0] * n + edges[:, 1], tree_keys))
+
+        if (n_shortcuts and len(rest)):
+            detours = np.zeros(len(rest))
+            sources = np.unique(edges[rest, 0])
+
+            # Tree distances from a few sources at a time, to bound memory
+
+            for k in range(0, len(sources), 256):
+                chunk = sources[k:k+256]
+                tree_dist = scipy.sparse.csgraph.shortest_path(tree, directed=False, indices=chunk)
+                sel = np.flatnonzero(np.isin(edges[rest, 0], chunk))
+                rows = np.searchsorted(chunk, edges[rest[sel], 0])
+                detours[sel] = tree_dist[rows, edges[rest[sel], 1]] / lengths[rest[sel]]
+
+            best = rest[np.argsort(-detours, kind="stable")[:n_shortcuts]]
+            best = best[np.argsort(lengths[best], kind="stable")]
+            pairs.extend((cities[i], cities[j]) for (i, j) in edges[best].tolist())
+
+        return pairs
 
     def _init_weightmap(self):
         
@@ -560,15 +925,23 @@ class RoadLayer(TerrainLayer):
         used in pathfinding.
         """
         
+        window = (slice(None), slice(None))
+
+        self._weightmap = self._compute_weights(window)
+        self._min_weight = float(np.min(self._weightmap))
+
+    def _compute_weights(self, window):
+
+        """ Return the weights of the tiles within a window (a tuple of
+        slices) of the map.
+        """
+
         terrain = self.terrain
-        smatrix = terrain.get_layer_by_type(SeaLayer).matrix        
-        bmatrix = terrain.get_layer_by_type(BiomeLayer).matrix
+        smatrix = terrain.get_layer_by_type(SeaLayer).matrix[window]
+        bmatrix = terrain.get_layer_by_type(BiomeLayer).matrix[window]
         
         rlayer = terrain.get_layer_by_type(RiverLayer)
-        rmatrix = terrain.get_layer_by_type(RiverLayer).matrix
-        rcxion_matrix = rlayer.classification.matrix
-        
-        wm = np.zeros((terrain.dim, terrain.dim), dtype=np.floating)
+        rcxion_matrix = rlayer.classification.matrix[window]
         
         # Sea is impassable
         
@@ -591,90 +964,631 @@ class RoadLayer(TerrainLayer):
                 rcxion_matrix == TileClassifierLine.TT_STRAIGHT_NS
             ), terrain.MP_BRIDGE, wm)
         
-        self._weightmap = wm
+        return wm
+
+    def _init_buffers(self):
+
+        """ Allocate the search buffers reused by all roads: distances to the
+        nearest road, search distances (kept at infinity between searches),
+        predecessors, touched tiles and a queue.
+        """
+
+        self._buffers = (self.get_road_distances(),) + self._alloc_search_buffers()
+
+    def _alloc_search_buffers(self):
+
+        """ Return new A* search buffers (distm, preds, touched, queue). """
+
+        dim = self.terrain.dim
+
+        return (
+            np.full((dim, dim), float("inf"), dtype=np.float64),
+            np.full((dim, dim), FlowField.NO_DIRECTION, dtype=np.uint8),
+            np.zeros(dim * dim, dtype=np.int64),
+            np.zeros(dim * dim, dtype=np.int64)
+        )
+
+    def get_grid_edges(self, x0=0, y0=0, w=None, h=None):
+
+        """ Return the edges of the movement graph over the window of w by h
+        tiles at (x0, y0), by default the whole map, as arrays (sources,
+        targets, costs) of flat indices into the window and costs. An edge
+        leads from every tile to each passable edge neighbor, costing the
+        neighbor's weight plus the elevation penalty, as in _generate_road;
+        impassable tiles get no incoming edges unless they are roads. Costs
+        do not include the road discount.
+        """
+
+        terrain = self.terrain
+        dim = terrain.dim
+        w = dim - x0 if w is None else w
+        h = dim - y0 if h is None else h
+        window = (slice(y0, y0 + h), slice(x0, x0 + w))
+
+        weights = self.get_weightmap()[window]
+        roads = self.matrix[window]
+        elev_deltas = terrain.fields.elev_deltas[(slice(None),) + window]
+        (ys, xs) = np.divmod(np.arange(w * h), w)
+        (sources, targets, costs) = ([], [], [])
+
+        for i in range(len(kernels.DX)):
+            nx = xs + kernels.DX[i]
+            ny = ys + kernels.DY[i]
+            valid = (nx >= 0) & (ny >= 0) & (nx < w) & (ny < h)
+            src = np.flatnonzero(valid)
+            dst = ny[valid] * w + nx[valid]
+            cost = weights.flat[dst] + elev_deltas[i].flat[src] * terrain.MP_PENALTY_ELEV
+            passable = np.isfinite(cost) | (roads.flat[dst] > 0)
+
+            sources.append(src[passable])
+            targets.append(dst[passable])
+            costs.append(cost[passable])
+
+        return (np.concatenate(sources), np.concatenate(targets), np.concatenate(costs))
+
+    def get_weightmap(self):
+
+        """ Return the matrix of movement costs of tiles used in road search
+        (see _init_weightmap).
+        """
+
+        if (self._weightmap is None):
+            self._init_weightmap()
+
+        return self._weightmap
+
+    def get_road_distances(self):
+
+        """ Return the Manhattan distance of every tile to the nearest road,
+        or 2 * dim everywhere if there are no roads.
+        """
+
+        dim = self.terrain.dim
+
+        if (not self.matrix.any()):
+            return np.full((dim, dim), 2 * dim, dtype=np.int64)
+
+        return ndi.distance_transform_cdt(self.matrix == 0, metric="taxicab").astype(np.int64)
+
+    def get_routes(self):
+
+        """ Return the RouteService answering route queries over the layer,
+        building it on first use.
+        """
+
+        if (self.routes is None):
+            self.routes = RouteService(self, self.route_cluster_size)
+
+        return self.routes
+
+    def get_network(self):
+
+        """ Return the RoadNetwork of the classified roads. It is built at
+        the end of generate and again whenever roads are changed (see
+        _update_roads); layers without one, e.g. loaded from older saves,
+        build it on first use.
+        """
+
+        if (self.network is None):
+            self._build_network()
+
+        return self.network
+
+    def _build_network(self):
+
+        """ Build the RoadNetwork of the roads as classified. """
+
+        cities = self.terrain.get_layer_by_type(CityLayer).cities
+        self.network = RoadNetwork(self.matrix, self.classification, cities)
+
+    def get_movement_fields(self):
+
+        """ Return the MovementFields cache of flow fields for unit movement
+        over the layer, creating it on first use.
+        """
+
+        if (self.movement is None):
+            self.movement = MovementFields(self, self.movement_capacity)
+
+        return self.movement
+
+    def connect_city(self, x, y):
+
+        """ Connect a city at (x, y) to the existing roads by the cheapest
+        road to any of them, found by a local search (see _local_windows).
+        Returns True if the city is on the roads afterwards, False if no
+        road is within reach.
+        """
+
+        if (self.matrix[y, x]):
+            return True
+
+        if (not self.matrix.any()):
+            return False
+
+        for (x0, y0, x1, y1) in self._local_windows([x], [y]):
+            targets = np.flatnonzero(self.matrix[y0:y1, x0:x1])
+
+            if (not len(targets)):
+                continue
+
+            (distm, preds) = self._search_window(x0, y0, x1, y1, x, y, targets)
+            best = targets[np.argmin(distm.flat[targets])]
+
+            if (distm.flat[best] < float("inf")):
+                tiles = self._trace_window(preds, x0, y0, x0 + best % (x1 - x0), y0 + best // (x1 - x0))
+                self._update_roads(tiles, [])
+                debug("Connected city ({}, {}) by a road of {} tiles".format(x, y, len(tiles)))
+                return True
+
+        warning("No road to connect city ({}, {}) within {} tiles".format(x, y, self.local_max_radius))
+        return False
+
+    def update_terrain(self, x, y, w, h):
+
+        """ Apply changes to the layers below (e.g. the sea, rivers or
+        biomes) within the rectangle (x, y, w, h): recompute the weights
+        there, including river crossings, and their minimum from those of
+        the rectangle (over the whole map only when the minimum was there
+        and increased), then remove the road tiles which became impassable
+        and reconnect the roads ending at every such gap by local searches
+        (see _local_windows), from the first end to all others; ends out of
+        reach stay unconnected. Returns the number of road tiles removed.
+
+        The route service is dropped, as changes to passability require a
+        new one (see get_routes).
+        """
+
+        dim = self.terrain.dim
+        (x0, y0, x1, y1) = (max(x, 0), max(y, 0), min(x + w, dim), min(y + h, dim))
+        window = (slice(y0, y1), slice(x0, x1))
+        weightmap = self.get_weightmap()
+
+        old_min = float(np.min(weightmap[window], initial=np.inf))
+        weightmap[window] = self._compute_weights(window)
+        new_min = float(np.min(weightmap[window], initial=np.inf))
+
+        if (new_min > old_min and old_min <= self._min_weight):
+            self._min_weight = float(np.min(weightmap))
+        else:
+            self._min_weight = min(self._min_weight, new_min)
+        self.routes = None
+
+        if (self.movement is not None):
+            self.movement.invalidate()
+
+        broken = (self.matrix[window] != 0) & ~np.isfinite(weightmap[window])
+        (ys, xs) = np.nonzero(broken)
+        removed = list(zip((xs + x0).tolist(), (ys + y0).tolist()))
+
+        if (not removed):
+            return 0
+
+        self._update_roads([], removed)
+        labels = ndi.label(broken)[0]
+        added = []
+
+        for (i, gap) in enumerate(ndi.find_objects(labels)):
+            # Roads ending at the gap, i.e. edge neighbors of its tiles
+
+            (gys, gxs) = np.nonzero(labels[gap] == i + 1)
+            (gxs, gys) = (gxs + gap[1].start + x0, gys + gap[0].start + y0)
+            ends = set()
+
+            for (dx, dy) in zip(kernels.DX, kernels.DY):
+                (nx, ny) = (gxs + dx, gys + dy)
+                valid = (nx >= 0) & (ny >= 0) & (nx < dim) & (ny < dim)
+                valid[valid] = self.matrix[ny[valid], nx[valid]] != 0
+                ends.update(zip(nx[valid].tolist(), ny[valid].tolist()))
+
+            if (len(ends) >= 2):
+                added.extend(self._reconnect(sorted(ends)))
+
+        debug("Removed {} impassable road tiles, added {}".format(len(removed), len(added)))
+        self._update_roads(added, [])
+
+        return len(removed)
+
+    def _reconnect(self, ends):
+
+        """ Search roads from the first of a list of (x, y) road tiles to all
+        others, widening the search window until all are reached (see
+        _local_windows). Returns the tiles of the roads, which are not set.
+        """
+
+        (sx, sy) = ends[0]
+        (xs, ys) = ([e[0] for e in ends], [e[1] for e in ends])
+        tiles = []
+
+        for (x0, y0, x1, y1) in self._local_windows(xs, ys):
+            w = x1 - x0
+            targets = (np.array(ys[1:]) - y0) * w + np.array(xs[1:]) - x0
+            (distm, preds) = self._search_window(x0, y0, x1, y1, sx, sy, targets)
+
+            if (np.isfinite(distm.flat[targets]).all()):
+                break
+
+        for (x, y) in ends[1:]:
+            if (distm[y - y0, x - x0] < float("inf")):
+                tiles.extend(self._trace_window(preds, x0, y0, x, y))
+            else:
+                warning("No road from ({}, {}) to road end ({}, {}) within {} tiles".format(
+                    sx, sy, x, y, self.local_max_radius))
+
+        return tiles
+
+    def _local_windows(self, xs, ys):
+
+        """ Yield the windows (x0, y0, x1, y1) for local searches around
+        tiles xs, ys: their bounding box widened by local_radius, doubling
+        up to local_max_radius or until the window covers the map. Searches
+        give up beyond, rather than searching ever larger parts of large
+        maps.
+        """
+
+        dim = self.terrain.dim
+        r = self.local_radius
+
+        while (True):
+            window = (
+                max(min(xs) - r, 0), max(min(ys) - r, 0),
+                min(max(xs) + r + 1, dim), min(max(ys) + r + 1, dim)
+            )
+            yield window
+
+            if (window == (0, 0, dim, dim) or r >= self.local_max_radius):
+                return
+
+            r = min(2 * r, self.local_max_radius)
+
+    def _search_window(self, x0, y0, x1, y1, sx, sy, targets):
+
+        """ Run kernels.dijkstra_window from (sx, sy) over a window, until
+        the tiles at the flat window indices targets are settled. Returns
+        (distm, preds).
+        """
+
+        terrain = self.terrain
+        distm = np.empty((y1 - y0, x1 - x0), dtype=np.float64)
+        preds = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+
+        kernels.dijkstra_window(
+            self.get_weightmap(), terrain.fields.elev_deltas, self.matrix, x0, y0, sx, sy, False,
+            terrain.MP_ROAD, terrain.MP_PENALTY_ELEV, np.asarray(targets, dtype=np.int64), distm, preds
+        )
+
+        return (distm, preds)
+
+    @staticmethod
+    def _trace_window(preds, x0, y0, x, y):
+
+        """ Follow the predecessors of a window search (see _search_window)
+        from (x, y) back to its start, returning the (x, y) tiles visited.
+        """
+
+        tiles = [(int(x), int(y))]
+        (x, y) = (int(x) - x0, int(y) - y0)
+
+        while (preds[y, x] != kernels.NO_DIRECTION):
+            d = preds[y, x]
+            (x, y) = (x + kernels.DX[d], y + kernels.DY[d])
+            tiles.append((x + x0, y + y0))
+
+        return tiles
+
+    def _update_roads(self, added, removed):
+
+        """ Set the (x, y) tiles added as roads and clear those removed,
+        then reclassify around them (see reclassify) and build the road
+        network anew. Added tiles are passed on to the route service; the
+        movement fields are invalidated.
+        """
+
+        for (x, y) in added:
+            self[x, y] = 1
+        for (x, y) in removed:
+            self[x, y] = 0
+
+        tiles = list(added) + list(removed)
+
+        if (not tiles):
+            return
+
+        self.reclassify(*zip(*tiles))
+        self._build_network()
+
+        if (self.movement is not None):
+            self.movement.invalidate()
+
+        if (self.routes is not None and added):
+            self.routes.update(*(np.array(c, dtype=np.int64) for c in zip(*added)))
+
+    def _init_graph(self):
+
+        """ Build the weighted grid graph used by SEARCH_GRAPH, as a CSR
+        sparse matrix over flat tile indices (see get_grid_edges). The costs
+        without roads are kept in _graph_costs and the target of every edge
+        in _graph_targets, so that road costs can be applied by re-weighting
+        (see _reweight_graph).
+        """
+
+        dim = self.terrain.dim
+        (sources, targets, costs) = self.get_grid_edges()
+
+        order = np.lexsort((targets, sources))
+        indptr = np.zeros(dim * dim + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=dim * dim), out=indptr[1:])
+
+        self._graph_targets = targets[order]
+        self._graph_costs = costs[order]
+        self._graph = scipy.sparse.csr_matrix(
+            (self._graph_costs.copy(), self._graph_targets, indptr),
+            shape=(dim * dim, dim * dim)
+        )
+        self._reweight_graph()
+
+    def _reweight_graph(self):
+
+        """ Set the cost of all edges leading onto road tiles to MP_ROAD. """
+
+        on_road = self.matrix.flat[self._graph_targets] > 0
+        self._graph.data[:] = np.where(on_road, self.terrain.MP_ROAD, self._graph_costs)
+
+    def _generate_roads_graph(self, pairs):
+
+        """ Generate roads between pairs of Cities over the sparse grid graph
+        (see _init_graph). Every pair is routed from its endpoint shared with
+        the most other pairs, so that pairs sharing an endpoint share a
+        single search: scipy.sparse.csgraph.dijkstra runs once per distinct
+        source, and all routes from it are read from its predecessors.
+
+        Sources are searched in rounds of graph_round (fewer if the distance
+        and predecessor rows would exceed graph_memory bytes), in the order
+        their pairs come. Roads found within a round do not discount each
+        other; the graph is re-weighted for the road cost MP_ROAD between
+        rounds. Route costs differ by direction only through the endpoints
+        and elevation penalties next to roads, so routes are still (nearly)
+        the shortest paths of _generate_road. This pays off over A* when
+        many pairs share endpoints.
+        """
+
+        dim = self.terrain.dim
+        n_sources = max(1, min(self.graph_round, self.graph_memory // (dim * dim * 12)))
+
+        routes = [
+            (start_city.y * dim + start_city.x, end_city.y * dim + end_city.x)
+            for (start_city, end_city) in pairs
+        ]
+        shared = collections.Counter(t for route in routes for t in route)
+        by_source = collections.defaultdict(list)
+
+        for (s, e) in routes:
+            if (shared[s] < shared[e]):
+                (s, e) = (e, s)
+            by_source[s].append(e)
+
+        sources = list(by_source)
+
+        debug("Routing {} roads from {} sources".format(len(routes), len(sources)))
+
+        for i in range(0, len(sources), n_sources):
+            chunk = sources[i:i+n_sources]
+
+            (distances, preds) = scipy.sparse.csgraph.dijkstra(
+                self._graph, indices=chunk, return_predecessors=True)
+
+            for (row, s) in enumerate(chunk):
+                for e in by_source[s]:
+                    if (np.isfinite(distances[row, e])):
+                        kernels.trace_predecessors(preds[row], e, self.matrix)
+                        debug("\troute ({}, {}) -> ({}, {}) found, distance {}".format(
+                            s % dim, s // dim, e % dim, e // dim, distances[row, e]))
+                    else:
+                        debug("\tno route ({}, {}) -> ({}, {})".format(
+                            s % dim, s // dim, e % dim, e // dim))
+
+            self._reweight_graph()
 
     def _generate_road(self, start_city, end_city):
         
-        """ Generate a road between two Cities using Dijkstra's algorithm. """
+        """ Generate a road between two Cities using Dijkstra's algorithm
+        (see kernels.dijkstra) or, if search is SEARCH_ASTAR, A* (see
+        kernels.astar). Moving onto a tile costs its weight in the
+        weightmap plus an elevation penalty. If a road already exists, there
+        is a low, fixed movement cost instead to encourage re-using existing
+        roads.
+
+        The A* heuristic is a lower bound on the remaining cost, from the
+        Manhattan distance and the distances to the nearest road (see
+        kernels.astar), so roads are still shortest paths. A* traces the road
+        back along recorded predecessors and resets only the touched tiles of
+        the distance buffer; Dijkstra's algorithm traces it back along the
+        least distances (see kernels.trace_distances).
+        """
         
         cx = start_city.x
         cy = start_city.y
         ex = end_city.x
         ey = end_city.y
         
-        inf = float("inf")
         terrain = self.terrain
         dim = terrain.dim                
-        distm = np.full((dim, dim), inf, dtype=np.floating)        
-        hmatrix = terrain.heightmap.matrix
-        wm = self._weightmap
-        m = self.matrix
-        to_visit = []
         
-        distm[cy, cx] = 0
         debug("Generating road from ({}, {}) -> ({}, {})".format(cx, cy, ex, ey))        
 
-        while (True):
-            curr_d = distm[cy, cx]
-            
-            def neighbor_callback(nx, ny):
-                
-                # Consider every edge neighbor of current position: if distance is smaller
-                # than stored in the distance matrix, update distance and add position to
-                # the priority queue of unvisited positions. A dynamic pqueue works as
-                # long as there are no negative penalties in the weight matrix. Elevation
-                # penalties are added to the underlying weightmap here. If a road already
-                # exists, there is a low, fixed movement cost instead to encourage re-
-                # using existing roads.
-                
-                if (m[ny, nx] > 0):
-                    d = curr_d + terrain.MP_ROAD
-                else:
-                    elev_penalty = abs(int(hmatrix[cy, cx]) - int(hmatrix[ny, nx]))
-                    elev_penalty *= terrain.MP_PENALTY_ELEV
-                    d = curr_d + wm[ny, nx] + elev_penalty
-                
-                if (d < distm[ny, nx]):
-                    distm[ny, nx] = d
-                    heapq.heappush(to_visit, (d, nx, ny))
-            
-            GameFieldLayer.foreach_matrix_edge_neighbor(wm, neighbor_callback, cx, cy)
-                
-            try:
-                (d, cx, cy) = heapq.heappop(to_visit)
-            except IndexError:
-                d = inf
-            
-            if (d == inf):
-                debug("\tno route to endpoint")
-                break
-            if (cx == ex and cy == ey):
-                self._traceback_road(end_city, distm)
+        if (self.search == self.SEARCH_ASTAR):
+            (road_dist, distm, preds, touched, queue) = self._buffers
+
+            (found, n_touched, n_path) = kernels.astar(
+                self._weightmap, terrain.fields.elev_deltas, self.matrix, road_dist,
+                distm, preds, touched, queue, int(cx), int(cy), int(ex), int(ey),
+                terrain.MP_ROAD, terrain.MP_PENALTY_ELEV, self._min_weight
+            )
+
+            if (found):
+                kernels.add_road(self.matrix, road_dist, queue, n_path)
                 debug("\troute to endpoint found, distance {}".format(distm[ey, ex]))
-                break
+            else:
+                debug("\tno route to endpoint")
+
+            distm.flat[touched[:n_touched]] = float("inf")
+            return
+
+        distm = np.full((dim, dim), float("inf"), dtype=np.float64)
+
+        found = kernels.dijkstra(
+            self._weightmap, terrain.fields.elev_deltas, self.matrix, distm,
+            int(cx), int(cy), int(ex), int(ey),
+            terrain.MP_ROAD, terrain.MP_PENALTY_ELEV
+        )
         
-    def _traceback_road(self, end_city, distm):
+        if (found):
+            path = np.empty(dim * dim, dtype=np.int64)
+            n_path = kernels.trace_distances(distm, int(ex), int(ey), path)
+            self.matrix.flat[path[:n_path]] = 1
+            debug("\troute to endpoint found, distance {}".format(distm[ey, ex]))
+        else:
+            debug("\tno route to endpoint")
         
-        """ After running Dijkstra, trace back road from endpoint to start point
-        and store it in the layer matrix.
+    def _generate_roads_parallel(self, pairs):
+
+        """ Route roads speculatively in parallel, in batches of
+        parallel_batch pairs of Cities, by Dijkstra's algorithm or, if search
+        is SEARCH_ASTAR, A*. The weightmap, the elevation deltas of the
+        heightmap, the road matrix and, for A*, the road distances are
+        placed in shared memory (see backend.SharedArrays), and each batch is
+        split among this process and a pool of worker processes, one less
+        than the number of workers, which search their roads one by one
+        against the state of the layer before the batch (see RoadRouter).
+        The roads are then set in pair order, routing roads again in this
+        process according to parallel_reroute:
+
+        REROUTE_EXACT - Roads whose search reached a tile whose cost was
+                        changed by an earlier road of the batch or, for A*,
+                        for which an earlier road of the batch changed the
+                        heuristic at a reached tile (see _changes_heuristic).
+                        The result is identical to serial routing. Costs
+                        change only on new road tiles, so searches by
+                        Dijkstra's algorithm which reached none of them ran
+                        exactly as they would have after the earlier roads;
+                        A* also marks their edge neighbors, and as new roads
+                        change the heuristic widely, routes many roads
+                        again.
+        REROUTE_COSTS - Only roads whose search reached a tile whose cost was
+                        changed, so that roads still join earlier roads they
+                        come across. The same as REROUTE_EXACT for
+                        Dijkstra's algorithm; roads routed in parallel by A*
+                        may miss a cheaper way over a road of the same batch.
+        REROUTE_NONE  - Never; the roads of a batch are routed independently.
+
+        Other than with REROUTE_EXACT, the result depends on parallel_batch,
+        though not on the number of workers.
         """
-        
-        distl = GameFieldLayer(distm)
-        cx = end_city.x
-        cy = end_city.y
-        d = distl[cx, cy]
-        m = self.matrix
-        
-        m[cy, cx] = 1
 
-        while(d > 0):
-            def find_min_d_neighbor(nx, ny):
-                nonlocal d, cx, cy
-                
-                if (distl[nx, ny] < d):
-                    d = distl[nx, ny]
-                    cx = nx
-                    cy = ny            
-            
-            distl.foreach_edge_neighbor(find_min_d_neighbor, cx, cy)
-            m[cy, cx] = 1
+        terrain = self.terrain
+        n_workers = backend.get_workers()
+        state = [self._weightmap, terrain.fields.elev_deltas, self.matrix]
+        params = (terrain.MP_ROAD, terrain.MP_PENALTY_ELEV, self._min_weight)
+
+        if (self.search == self.SEARCH_ASTAR):
+            state.append(self.get_road_distances())
+
+        with backend.SharedArrays(state) as shared:
+            if (n_workers > 1):
+                pool = backend.process_pool(
+                    n_workers - 1, roadrouter.init_worker, (shared.get_specs(),) + params)
+            else:
+                pool = contextlib.nullcontext()
+
+            with pool as executor:
+                self._route_batches(pairs, shared.arrays, params, executor)
+
+            np.copyto(self.matrix, shared.arrays[2])
+
+    def _route_batches(self, pairs, state, params, executor):
+
+        """ Route and set the roads of _generate_roads_parallel over the
+        shared state (weights, elevation deltas, roads and, for A*, road
+        distances), given the search parameters (road cost, elevation
+        penalty and lowest weight) and the pool of worker processes, if any.
+        """
+
+        dim = self.terrain.dim
+        n_workers = backend.get_workers()
+        mode = self.parallel_reroute
+        astar = len(state) > 3
+        (roads, road_dist) = (state[2], state[3] if astar else None)
+        router = RoadRouter(*state[:3], road_dist, *params)
+        coords = [(a.x, a.y, b.x, b.y) for (a, b) in pairs]
+        queue = np.zeros(dim * dim, dtype=np.int64)
+        changed = np.zeros((dim, dim), dtype=np.bool_)
+
+        for b0 in range(0, len(pairs), self.parallel_batch):
+            b1 = min(b0 + self.parallel_batch, len(pairs))
+            chunks = np.array_split(np.arange(b0, b1), n_workers)
+            futures = [executor.submit(roadrouter.route_pairs, [coords[i] for i in chunk])
+                for chunk in chunks[1:]]
+            results = router.route_pairs([coords[i] for i in chunks[0]])
+            results += [r for f in futures for r in f.result()]
+            snapshot = road_dist.copy() if astar else None
+            rerouted = 0
+
+            # Merge in pair order, routing again where an earlier road of the
+            # batch may have changed the outcome
+
+            for (i, (found, path, window, reached)) in enumerate(results):
+                (sx, sy, ex, ey) = coords[b0 + i]
+                (x0, y0, w, h) = window
+                (ys, xs) = np.nonzero(RoadRouter.get_reached(window, reached))
+
+                debug("Generating road from ({}, {}) -> ({}, {})".format(sx, sy, ex, ey))
+
+                if ((mode != self.REROUTE_NONE and changed[ys + y0, xs + x0].any()) or
+                        (astar and mode == self.REROUTE_EXACT and self._changes_heuristic(
+                            (ys + y0) * dim + xs + x0, pairs[b0 + i][1], snapshot, road_dist))):
+                    (found, path, window, reached) = router.route(sx, sy, ex, ey)
+                    rerouted += 1
+
+                if (not found):
+                    debug("\tno route to endpoint")
+                    continue
+
+                # Costs change on new road tiles, and for A* the heuristic
+                # around them
+
+                if (astar):
+                    queue[:len(path)] = path
+                    n_new = kernels.add_road(roads, road_dist, queue, len(path))[0]
+                    (ys, xs) = np.divmod(queue[:n_new], dim)
+                    changed[ys, xs] = True
+
+                    for d in range(len(kernels.DX)):
+                        nx = xs + kernels.DX[d]
+                        ny = ys + kernels.DY[d]
+                        valid = (nx >= 0) & (ny >= 0) & (nx < dim) & (ny < dim)
+                        changed[ny[valid], nx[valid]] = True
+                else:
+                    changed.flat[path[roads.flat[path] == 0]] = True
+                    roads.flat[path] = 1
+
+                debug("\troute to endpoint found, length {}".format(len(path)))
+
+            debug("Roads {} .. {}: {} routed again".format(b0, b1 - 1, rerouted))
+            changed[:] = False
+
+    @staticmethod
+    def _changes_heuristic(touched, end_city, before, after):
+
+        """ Return True if the A* heuristic (see kernels.astar) towards a City
+        differs between the road distances before and after at any of the
+        touched flat indices.
+        """
+
+        dim = before.shape[1]
+        (ex, ey) = (end_city.x, end_city.y)
+        (ys, xs) = np.divmod(touched, dim)
+        m = np.abs(ex - xs) + np.abs(ey - ys)
+        off_before = np.minimum(m, np.maximum(before.flat[touched] - 1 + before[ey, ex], 0))
+        off_after = np.minimum(m, np.maximum(after.flat[touched] - 1 + after[ey, ex], 0))
+
+        return bool((off_before != off_after).any())
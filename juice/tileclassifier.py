@@ -8,6 +8,7 @@ import numpy as np
 
 from logging import debug, info, warning, error
 from juice.gamefieldlayer import GameFieldLayer
+from juice import kernels
 
 _TileSpec = collections.namedtuple("TileSpec", ["array", "initial_tt", "rotations"])
 
@@ -37,24 +38,46 @@ class TileClassifier(metaclass=abc.ABCMeta):
     TT_EMPTY        = 0
     TT_NA           = 1
 
-    def __init__(self, flayer, rev=False, extend=True):
+    # Lists of tilespecs applied in turn by classify (see reclassify)
 
-        """ Constructor. cls_matrix is a matrix representing "interesting" (the
-        terrain) and "uninteresting" tiles at first (a boolean matrix), later
-        filled with tile type IDs. By default, all nonzero values are considered
-        interesting. Passing true for rev reverses this condition. If extend is
-        true, the layer will seemingly extend beyond the edge, otherwise the
-        tile just beyond the edge will be considered empty (whatever its
-        semantics for the given layer).
+    TILESPECS       = None
+
+    # Convergence of classify: passes over the whole matrix until none
+    # removes a tile, or, after the first, over the neighborhoods of the
+    # tiles removed since (the frontier) only, with identical results
+
+    MODE_FULL       = "full"
+    MODE_FRONTIER   = "frontier"
+
+    # Cost of examining a frontier cell relative to a cell of a full pass
+
+    FRONTIER_COST   = 8
+
+    def __init__(self, flayer, rev=False, extend=True, mode=MODE_FRONTIER):
+
+        """ Constructor. The classification matrix, built by classify,
+        represents "interesting" (the terrain) and "uninteresting" tiles at
+        first (a boolean matrix), later filled with tile type IDs. By default,
+        all nonzero values are considered interesting. Passing true for rev
+        reverses this condition. If extend is true, the layer will seemingly
+        extend beyond the edge, otherwise the tile just beyond the edge will
+        be considered empty (whatever its semantics for the given layer).
+        mode is one of the MODE_* constants. After classify, passes and
+        cells_touched hold the number of passes and of cells examined.
         """
 
         assert(self.TT_EMPTY == 0)
 
-        self._cls_matrix = self._init_matrix(flayer, rev=rev)
+        self._cls_matrix = None
         self._flayer = flayer
         self._dim = flayer.matrix.shape[0]
         self._rev = rev
         self._extend = extend
+        self.mode = mode
+        self.passes = 0
+        self.cells_touched = 0
+
+        self._history = None
 
     @abc.abstractmethod
     def classify(self, tilespec_lists):
@@ -63,20 +86,51 @@ class TileClassifier(metaclass=abc.ABCMeta):
         label the rest as a tiletype. Repeat until convergence.
         """
         
-        m = self._cls_matrix
-        
-        while (True):
-            n = 0
-            
-            for tsl in tilespec_lists:
-                n += self._apply_tilespecs(m, *tsl)
-            debug("Classification pass: %d tiles removed", n)
-            
-            if (n <= 0):
-                break
+        m = self._cls_matrix = self._init_matrix(self._flayer, rev=self._rev)
+        luts = [self._compile_tilespecs(tsl) for tsl in tilespec_lists]
+
+        self._converge(m, luts, [None] * len(luts))
         
         return LayerClassification(m, self.__class__)
 
+    def reclassify(self, classification, xs, ys):
+
+        """ Classify anew, in place, the LayerClassification classification
+        (by this type of classifier) of the input GameFieldLayer after
+        changes to the layer at tiles xs, ys: these become interesting or not
+        according to the layer, then the tiles around them (and around tiles
+        removed in turn) are classified until convergence, as in the passes
+        of classify after the first. Removed tiles are cleared in the layer
+        as well. Returns arrays (xs, ys) of the tiles whose classification
+        changed, including removed tiles.
+        """
+
+        if (self.TILESPECS is None):
+            raise NotImplementedError("{} does not support reclassification".format(
+                self.__class__.__name__))
+
+        m = self._cls_matrix = classification.matrix
+        dim_x = m.shape[1]
+        cells = np.unique(np.asarray(ys, dtype=np.int64) * dim_x + np.asarray(xs, dtype=np.int64))
+        self._history = [(cells, m.flat[cells].copy())]
+
+        values = self._flayer.matrix.flat[cells]
+        interesting = (values == 0) if self._rev else (values != 0)
+        m.flat[cells[~interesting]] = self.TT_EMPTY
+        m.flat[cells[interesting & (m.flat[cells] == self.TT_EMPTY)]] = self.TT_NA
+
+        luts = [self._compile_tilespecs(tsl) for tsl in self.TILESPECS]
+        self._converge(m, luts, [[cells] for lut in luts])
+
+        # Compare with the values before the first change
+
+        (tiles, before) = (np.concatenate(h) for h in zip(*self._history))
+        (tiles, first) = np.unique(tiles, return_index=True)
+        changed = tiles[m.flat[tiles] != before[first]]
+        self._history = None
+
+        return (changed % dim_x, changed // dim_x)
+
     @classmethod
     def get_tt_str(cls, tt):
         
@@ -99,91 +153,142 @@ class TileClassifier(metaclass=abc.ABCMeta):
             cm[flayer.matrix == 0 if rev else flayer.matrix != 0] = self.TT_NA
         return cm
         
-    def _apply_tilespecs(self, m, *tilespecs):
+    def _converge(self, m, luts, pending):
 
-        """ Apply a list of tilespecs, i.e. remove illegal tiles. """
+        """ Apply the compiled lists of tilespecs luts in turn until no tile
+        is removed. pending holds, per list, the arrays of tiles removed
+        since the list was last applied (or changed otherwise), or None to
+        apply it to the whole matrix.
+        """
 
-        dim = self._dim
-        ext_m = self._extend_matrix(m, self._extend)
-        mask = np.full((dim, dim), True, dtype=bool)
-        extrange = range(1, dim+1)
-        
-        for (tilespec, x, y) in itertools.product(tilespecs, extrange, extrange):
-            cls = self._classify_tile(ext_m, mask, x, y, tilespec)
-            if (type(cls) is bool):
-                mask[y-1, x-1] = cls
-            elif (type(cls) is int):
-                mask[y-1, x-1] = False
-                m[y-1, x-1] = cls
-            elif (cls is not None):
-                raise ValueError(cls)
+        self.passes = 0
+        self.cells_touched = 0
         
-        m[mask] = False
-        self._flayer.matrix[mask] = (0xFE if self._rev else 0)
+        while (True):
+            n = 0
+            
+            for (i, lut) in enumerate(luts):
+                tiles = None if pending[i] is None else np.concatenate(pending[i])
+
+                # Large frontiers are cheaper to examine by a full pass
+
+                if (self.mode == self.MODE_FULL or tiles is None or
+                        len(tiles) * 9 * self.FRONTIER_COST > m.size):
+                    removed = self._apply_tilespecs(m, lut)
+                    self.cells_touched += m.size
+                else:
+                    cells = self._get_frontier(tiles)
+                    removed = self._apply_tilespecs(m, lut, cells)
+                    self.cells_touched += len(cells)
+
+                pending[i] = []
+
+                for p in pending:
+                    if (p is not None):
+                        p.append(removed)
+
+                n += len(removed)
+
+            self.passes += 1
+            debug("Classification pass: %d tiles removed", n)
+            
+            if (n <= 0):
+                break
 
-        return np.count_nonzero(mask)
+        debug("Classification converged after %d passes, %d cells examined",
+            self.passes, self.cells_touched)
 
-    def _classify_tile(self, m, mask, x, y, tilespec):
+    def _apply_tilespecs(self, m, lut, cells=None):
 
-        """ Classify a single tile. tilespec may be a valid ternary matrix which
-        is rotated into all possible positions and compared with the tile's
-        immediate neighborhood _or_ a callable. Returns a TT _or_ a boolean
-        affecting only the mask _or_ None for no effect at all.
+        """ Apply a list of tilespecs compiled into a lookup table, i.e.
+        remove illegal tiles, over the whole matrix or the cells (flat
+        indices) passed. Returns the flat indices of the removed tiles,
+        which are cleared in the layer as well (and in its index, if any).
         """
-        
-        nhood = m[y-1:y+2, x-1:x+2]        
-        i = 0
 
-        if (not mask[y-1, x-1]):            # already classed as OK, return
-            return False
-        elif (m[y, x] == self.TT_EMPTY):    # non-interesting tile is OK, return
-            return False
-        elif (type(self) is TileClassifierSolid and nhood.all() > self.TT_EMPTY):
-            return self.TT_SOLID            # interior terrain tile is OK, return
+        if (self._history is not None):
+            self._history.append((
+                np.arange(m.size) if cells is None else cells,
+                (m if cells is None else m.flat[cells]).ravel().copy()
+            ))
+
+        if (cells is None):
+            ext_m = self._extend_matrix(m, self._extend) > self.TT_EMPTY
+            mask = np.zeros(m.shape, dtype=bool)
+            kernels.classify_tiles(ext_m, m, mask, lut)
+            removed = np.flatnonzero(mask)
+        else:
+            removed = np.empty(len(cells), dtype=np.int64)
+            n = kernels.classify_cells(m, lut, self._extend, cells, removed)
+            removed = removed[:n]
 
-        if (callable(tilespec)):
-            return tilespec(m, x, y, nhood)
+        flayer = self._flayer
+        flayer.matrix.flat[removed] = (0xFE if self._rev else 0)
 
-        # Test tilespec at 4 rotations at most
+        if (flayer.index):
+            for t in removed.tolist():
+                flayer.index.update(t % m.shape[1], t // m.shape[1])
 
-        nhood_bool  = nhood > self.TT_EMPTY
-        initial_tt  = tilespec.initial_tt
-        rotations   = tilespec.rotations or 4
-        ts_matrix   = tilespec.array
-        
-        while (i < rotations):
-            if (self._is_ternary_matrix_equal(ts_matrix, nhood_bool)):
-                return initial_tt + i
-            ts_matrix = self._rotate_matrix(ts_matrix)
-            i += 1
+        return removed
 
-    def _rotate_matrix(self, m):
-        return np.fliplr(np.transpose(m))
+    def _get_frontier(self, tiles):
 
-    def _is_ternary_matrix_equal(self, a, b):
+        """ Return the sorted flat indices of the cells within the immediate
+        neighborhood (including diagonals) of the tiles (flat indices).
+        """
 
-        """ Compare two ternary matrices for equality. None values are
-        considered equal to any value.
+        (dim_y, dim_x) = self._cls_matrix.shape
+        (ys, xs) = (tiles // dim_x, tiles % dim_x)
+        cells = []
+
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                (nx, ny) = (xs + dx, ys + dy)
+                inside = (nx >= 0) & (ny >= 0) & (nx < dim_x) & (ny < dim_y)
+                cells.append(ny[inside] * dim_x + nx[inside])
+
+        return np.unique(np.concatenate(cells))
+
+    def _compile_tilespecs(self, tilespecs):
+
+        """ Compile a list of tilespecs into a lookup table of the tile type
+        of every 3x3 neighborhood (see kernels.classify_tiles for its
+        encoding). A tile is classified by the first tilespec matching its
+        neighborhood at any rotation, or left as is if the tilespec has no
+        initial_tt (kernels.TT_KEEP); tiles matching none are illegal
+        (kernels.TT_ILLEGAL). Classifiers defining TT_SOLID classify interior
+        terrain tiles as solid beforehand.
         """
 
-        ai = a.flat
-        bi = b.flat
-        equal = True
+        codes = np.arange(512)
+        nhoods = (codes[:, np.newaxis] >> np.arange(9)) & 1 == 1
+        lut = np.full(512, kernels.TT_ILLEGAL, dtype=np.int16)
+        pending = np.ones(512, dtype=bool)
+        solid_tt = getattr(self, "TT_SOLID", self.TT_EMPTY)
+
+        if (solid_tt):
+            lut[511] = solid_tt
+            pending[511] = False
 
-        try:
-            while(True):
-                av = next(ai)
-                bv = next(bi)
+        for tilespec in tilespecs:
+            ts_matrix = tilespec.array
+            initial_tt = tilespec.initial_tt
 
-                if (av == None or bv == None):
-                    continue
-                elif (av != bv):
-                    equal = False
-                    break
-        except StopIteration:
-            pass
+            for i in range(tilespec.rotations or 4):
+                match = pending.copy()
 
-        return equal
+                for (j, v) in enumerate(ts_matrix.flat):
+                    if (v is not None):
+                        match &= nhoods[:, j] == bool(v)
+
+                lut[match] = kernels.TT_KEEP if initial_tt is None else initial_tt + i
+                pending[match] = False
+                ts_matrix = self._rotate_matrix(ts_matrix)
+
+        return lut
+
+    def _rotate_matrix(self, m):
+        return np.fliplr(np.transpose(m))
 
     def _extend_matrix(self, m, with_same):
 
@@ -248,24 +353,21 @@ class TileClassifierSolid(TileClassifier):
         [True, True, True],
         [True, True, True]]), TT_STRAIGHT_N, None))
 
-    def classify(self):
-
-        """ The solid layer type classifier removes "slivers" first for
-        efficiency, then classifies to the standard tileset.
-        """
+    # Tiles with terrain on at least one side along both axes; anything
+    # else is a "sliver", i.e. a terrain portion of width 1.
 
-        def sliver_spec(m, x, y, nhood):
+    TS_NONSLIVER = _TileSpec._make((np.array([
+        [None, True, None],
+        [True, True, None],
+        [None, None, None]]), None, None))
 
-            """ Callable tilespec defining "slivers" i.e. terrain portions of
-            width 1.
-            """
+    # Slivers are removed first for efficiency, then tiles are classified
+    # to the standard tileset
 
-            if ((not nhood[0, 1] and not nhood[2, 1]) or (not nhood[1, 0] and not nhood[1, 2])):
-                return True
-            return False
+    TILESPECS = ((TS_NONSLIVER,), (TS_CONCAVE, TS_CONVEX, TS_STRAIGHT))
 
-        return super().classify(
-            ((sliver_spec,), (self.TS_CONCAVE, self.TS_CONVEX, self.TS_STRAIGHT)))
+    def classify(self):
+        return super().classify(self.TILESPECS)
 
 class TileClassifierLine(TileClassifier):
     
@@ -310,9 +412,10 @@ class TileClassifierLine(TileClassifier):
         [True,  True,  True],
         [None,  True,  None]]), TT_FOURWAY, 1))
     
+    TILESPECS = ((TS_STRAIGHT, TS_SOURCE, TS_CORNER, TS_TBONE, TS_FOURWAY),)
+
     def classify(self):
-        return super().classify(
-            ((self.TS_STRAIGHT, self.TS_SOURCE, self.TS_CORNER, self.TS_TBONE, self.TS_FOURWAY),))        
+        return super().classify(self.TILESPECS)
 
 class TileClassifierDelta(TileClassifier):
     
@@ -322,8 +425,7 @@ class TileClassifierDelta(TileClassifier):
     TT_DELTA_W  = 74
 
     def __init__(self, flayer, terrain=None):
-        self._cls_matrix = self._init_matrix(flayer, empty=True)
-        self._flayer = flayer
+        super().__init__(flayer)
         self._terrain = terrain
     
     def classify(self):
@@ -332,7 +434,46 @@ class TileClassifierDelta(TileClassifier):
         junctions.
         """
         
-        m = self._cls_matrix
+        m = self._cls_matrix = self._init_matrix(self._flayer, empty=True)
+        
+        for (y, x) in np.argwhere(self._flayer.matrix == self._terrain.DELTA_RIVER):
+            self._classify_tile(m, x, y)
+        
+        return LayerClassification(m, self.__class__)
+
+    def reclassify(self, classification, xs, ys):
+
+        """ Classify anew, in place, the LayerClassification classification
+        of the input GameFieldLayer after changes to the layer at tiles xs,
+        ys: these and their neighbors, whose junctions may face them, are
+        classified again. Returns arrays (xs, ys) of the tiles whose
+        classification changed.
+        """
+
+        m = self._cls_matrix = classification.matrix
+        (dim_y, dim_x) = m.shape
+        (dy, dx) = np.mgrid[-1:2, -1:2]
+        nys = np.add.outer(np.asarray(ys, dtype=np.int64), dy.ravel()).ravel()
+        nxs = np.add.outer(np.asarray(xs, dtype=np.int64), dx.ravel()).ravel()
+        inside = (nxs >= 0) & (nxs < dim_x) & (nys >= 0) & (nys < dim_y)
+        cells = np.unique(nys[inside] * dim_x + nxs[inside])
+        before = m.flat[cells].copy()
+
+        m.flat[cells] = self.TT_EMPTY
+        
+        for c in cells[self._flayer.matrix.flat[cells] == self._terrain.DELTA_RIVER]:
+            self._classify_tile(m, c % dim_x, c // dim_x)
+
+        changed = cells[m.flat[cells] != before]
+
+        return (changed % dim_x, changed // dim_x)
+
+    def _classify_tile(self, m, x, y):
+
+        """ Set the tile type of the DELTA_RIVER tile at (x, y) by the
+        direction of its DELTA_SEA edge neighbor.
+        """
+
         t = self._terrain
         flayer = self._flayer
         
@@ -351,15 +492,14 @@ class TileClassifierDelta(TileClassifier):
             else:
                 raise RuntimeError("GameFieldLayer.foreach_edge_neighbor broken")            
         
-        for c in np.argwhere(flayer.matrix == t.DELTA_RIVER):
-            x = c[1]; y = c[0]
-            flayer.foreach_edge_neighbor(set_delta_dir, x, y, x, y)
-        
-        return LayerClassification(m, self.__class__)
+        flayer.foreach_edge_neighbor(set_delta_dir, x, y, x, y)
 
 class TileClassifierSimple(TileClassifier):
+
+    TILESPECS = ()
+
     def __init__(self, flayer):
         super().__init__(flayer)
 
     def classify(self):
-        return LayerClassification(self._cls_matrix, self.__class__)
+        return LayerClassification(self._init_matrix(self._flayer), self.__class__)
@@ -0,0 +1,152 @@
+
+import collections
+
+from logging import debug, info, warning, error
+
+import numpy as np
+
+_Rays = collections.namedtuple("_Rays", ["dx", "dy", "inv_dist", "inside"])
+
+class Viewshed:
+
+    """ Line-of-sight visibility over a Terrain's heightmap, e.g. for fog of
+    war. The viewshed of an observer standing height units above the ground
+    at (x, y) is the set of tiles within radius of it whose ground can be
+    seen, computed by a radial sweep in the manner of the R2 algorithm: rays
+    are cast from the observer to every tile on the square of side
+    2 * radius + 1 around it, and a tile is visible if, on any ray passing
+    it, its slope from the observer (height difference over distance) is at
+    least the steepest slope of the tiles before it. All rays are swept at
+    once with vectorized operations; the ray geometry is kept per radius.
+
+    Viewsheds are cached per observer (position, radius and height), the
+    least recently used being dropped beyond `capacity`, until the heightmap
+    matrix is replaced (e.g. by regeneration); in-place edits of the
+    heightmap must be announced by calling invalidate().
+    """
+
+    def __init__(self, terrain, capacity=1024):
+        self.terrain = terrain
+        self.capacity = capacity
+
+        self._cache = collections.OrderedDict()
+        self._rays = {}
+        self._source = None
+
+    def get(self, x, y, radius, height=0):
+
+        """ Return the viewshed of an observer at (x, y) as (x0, y0, mask), a
+        boolean matrix of the visible tiles of the window at (x0, y0) around
+        the observer, clipped to the map. The viewshed is cached.
+        """
+
+        hmatrix = self.terrain.heightmap.matrix
+        key = (int(x), int(y), int(radius), height)
+
+        if (self._source is not hmatrix):
+            self.invalidate()
+            self._source = hmatrix
+
+        entry = self._cache.get(key)
+
+        if (entry is not None):
+            self._cache.move_to_end(key)
+            return entry
+
+        entry = self._compute(hmatrix, *key)
+        self._cache[key] = entry
+
+        while (len(self._cache) > self.capacity):
+            self._cache.popitem(last=False)
+
+        return entry
+
+    def get_mask(self, observers, radius, height=0):
+
+        """ Return the boolean matrix of tiles visible to any of a sequence
+        of (x, y) observers sharing radius and height.
+        """
+
+        mask = np.zeros(self.terrain.heightmap.matrix.shape, dtype=bool)
+
+        for (x, y) in observers:
+            (x0, y0, local) = self.get(x, y, radius, height)
+            (h, w) = local.shape
+            mask[y0:y0+h, x0:x0+w] |= local
+
+        return mask
+
+    def invalidate(self):
+        self._cache.clear()
+
+    def _compute(self, hmatrix, x, y, radius, height):
+
+        """ Sweep the rays of an observer (see get). """
+
+        (dim_y, dim_x) = hmatrix.shape
+        (x0, y0) = (max(x - radius, 0), max(y - radius, 0))
+        (x1, y1) = (min(x + radius + 1, dim_x), min(y + radius + 1, dim_y))
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        mask[y - y0, x - x0] = True
+
+        if (radius < 1):
+            return (x0, y0, mask)
+
+        rays = self._get_rays(radius)
+        (xs, ys) = (rays.dx + x, rays.dy + y)
+        h0 = float(hmatrix[y, x]) + height
+
+        # Rays only leave the map once, so everything past the first tile
+        # off the map is cut off
+
+        if (x - radius >= 0 and y - radius >= 0 and x + radius < dim_x and y + radius < dim_y):
+            on_map = None
+            heights = hmatrix.ravel()[ys * dim_x + xs]
+        else:
+            on_map = np.logical_and.accumulate(
+                (xs >= 0) & (ys >= 0) & (xs < dim_x) & (ys < dim_y), axis=0)
+            heights = hmatrix[np.where(on_map, ys, y), np.where(on_map, xs, x)]
+
+        slopes = (heights - np.float32(h0)) * rays.inv_dist
+
+        if (on_map is not None):
+            slopes[~on_map] = -np.inf
+
+        steepest = np.maximum.accumulate(slopes, axis=0)
+        visible = rays.inside.copy() if on_map is None else rays.inside & on_map
+        visible[1:] &= slopes[1:] >= steepest[:-1]
+
+        mask[ys[visible] - y0, xs[visible] - x0] = True
+
+        return (x0, y0, mask)
+
+    def _get_rays(self, radius):
+
+        """ Return the _Rays of a radius: the offsets (dx, dy) of the tiles
+        along the rays from the observer to every tile on the square of the
+        radius, one step along the major axis at a time, the inverse of their
+        distances from the observer and whether they are within radius.
+        Arrays are shaped (steps, rays).
+        """
+
+        rays = self._rays.get(radius)
+
+        if (rays is not None):
+            return rays
+
+        r = radius
+        side = np.arange(-r, r)
+        ends = np.concatenate((
+            np.stack((side, np.full(2 * r, -r)), axis=1),
+            np.stack((np.full(2 * r, r), side), axis=1),
+            np.stack((-side, np.full(2 * r, r)), axis=1),
+            np.stack((np.full(2 * r, -r), -side), axis=1)
+        ))
+        steps = np.arange(1, r + 1)[:, np.newaxis] / r
+
+        dx = np.rint(steps * ends[:, 0]).astype(np.int64)
+        dy = np.rint(steps * ends[:, 1]).astype(np.int64)
+        dist = np.hypot(dx, dy)
+
+        rays = self._rays[radius] = _Rays(dx, dy, (1.0 / dist).astype(np.float32), dist <= r)
+        return rays
@@ -0,0 +1,36 @@
+""" Helpers shared by the tests. """
+
+import copy
+import functools
+
+from juice.terrain import Terrain
+from juice.terrainlayer import \
+    SeaLayer, RiverLayer, DeltaLayer, BiomeLayer, CityLayer, RoadLayer
+
+LAYERS = (SeaLayer, RiverLayer, DeltaLayer, BiomeLayer, CityLayer, RoadLayer)
+
+def make_terrain(dim, seed, layers=LAYERS):
+
+    """ Generate a terrain of dim x dim tiles with the given layer classes,
+    all seeded with seed.
+    """
+
+    terrain = Terrain(dim, randseed=seed)
+
+    for cls in layers:
+        terrain.add_layer(cls(terrain, randseed=seed))
+
+    terrain.generate()
+    return terrain
+
+@functools.lru_cache(maxsize=None)
+def _make_cached(dim, seed, layers):
+    return make_terrain(dim, seed, layers)
+
+def get_terrain(dim, seed, layers=LAYERS):
+
+    """ Return a private copy of a terrain as made by make_terrain,
+    generated only once per test session, for tests which may change it.
+    """
+
+    return copy.deepcopy(_make_cached(dim, seed, tuple(layers)))
@@ -0,0 +1,191 @@
+
+""" The compute backends (see juice.backend) must produce identical
+results: whole terrains generated under each backend are compared, as are
+single kernels run compiled, uncompiled and through their numpy fallbacks.
+"""
+
+import numpy as np
+import pytest
+
+from juice import backend, kernels
+from juice.flowfield import FlowField
+from juice.gamefieldlayer import GameFieldLayer
+from juice.tileclassifier import TileClassifierSolid, TileClassifierLine
+
+from tests.common import make_terrain
+
+BACKENDS = backend.get_backends()
+
+requires_jit = pytest.mark.skipif(
+    backend.BACKEND_JIT not in BACKENDS, reason="JIT backend not available")
+
+@pytest.fixture(autouse=True)
+def restore_backend():
+    (name, workers) = (backend.get_backend(), backend.get_workers())
+    yield
+    backend.set_backend(name)
+    backend.set_workers(workers)
+
+def generate(name, dim, seed):
+
+    """ Generate a terrain with all layers under backend name and return
+    its matrices and classifications by name.
+    """
+
+    backend.set_backend(name)
+    terrain = make_terrain(dim, seed)
+    out = {"heightmap": terrain.heightmap.matrix}
+
+    for layer in terrain.get_layers():
+        out[type(layer).__name__] = layer.matrix
+
+        if (layer.classification is not None):
+            out[type(layer).__name__ + "_classification"] = layer.classification.matrix
+
+    return out
+
+def assert_same(a, b):
+    assert a.keys() == b.keys()
+
+    for k in a:
+        np.testing.assert_array_equal(a[k], b[k], err_msg=k)
+
+@requires_jit
+@pytest.mark.parametrize("dim,seed", ((32, 3), (64, 1), (128, 7)))
+def test_terrain(dim, seed):
+    python = generate(backend.BACKEND_PYTHON, dim, seed)
+    jit = generate(backend.BACKEND_JIT, dim, seed)
+
+    for k in ("RiverLayer", "CityLayer", "RoadLayer", "RoadLayer_classification"):
+        assert k in python
+
+    assert_same(python, jit)
+
+@requires_jit
+def test_terrain_workers():
+    serial = generate(backend.BACKEND_JIT, 64, 1)
+    backend.set_workers(4)
+    assert_same(serial, generate(backend.BACKEND_JIT, 64, 1))
+    assert_same(serial, generate(backend.BACKEND_PYTHON, 64, 1))
+
+def make_luts():
+
+    """ Return the lookup tables of the Solid and Line classifiers. """
+
+    layer = GameFieldLayer(8)
+    luts = []
+
+    for cls in (TileClassifierSolid, TileClassifierLine):
+        cfier = cls(layer)
+        luts.extend(cfier._compile_tilespecs(tsl) for tsl in cls.TILESPECS)
+
+    return luts
+
+def run_variants(kern, args):
+
+    """ Run a kernel on copies of args uncompiled, through its numpy
+    fallback and compiled (if available). Returns a list of (result, args)
+    per variant.
+    """
+
+    variants = [kern.__wrapped__, kern._fallback]
+
+    if (backend.BACKEND_JIT in BACKENDS):
+        backend.set_backend(backend.BACKEND_JIT)
+        variants.append(kern)
+
+    results = []
+
+    for fn in variants:
+        copies = [np.copy(a) if isinstance(a, np.ndarray) else a for a in args]
+        results.append((fn(*copies), copies))
+
+    return results
+
+def assert_same_results(results):
+    (r0, args0) = results[0]
+
+    for (r, args) in results[1:]:
+        assert r == r0
+
+        for (a, a0) in zip(args, args0):
+            if (isinstance(a, np.ndarray)):
+                np.testing.assert_array_equal(a, a0)
+
+@pytest.mark.parametrize("density", (0.3, 0.6, 0.9))
+def test_classify_tiles(density):
+    rng = np.random.default_rng(1)
+    dim = 48
+
+    for lut in make_luts():
+        ext = rng.random((dim + 2, dim + 2)) < density
+        m = np.where(ext[1:-1, 1:-1], TileClassifierSolid.TT_NA, 0).astype(np.uint8)
+        removed = np.zeros(m.shape, dtype=bool)
+
+        assert_same_results(run_variants(kernels.classify_tiles, (ext, m, removed, lut)))
+
+@pytest.mark.parametrize("extend", (False, True))
+def test_classify_cells(extend):
+    rng = np.random.default_rng(2)
+    dim = 48
+
+    for lut in make_luts():
+        m = np.where(rng.random((dim, dim)) < 0.6, TileClassifierSolid.TT_NA, 0).astype(np.uint8)
+        cells = np.unique(rng.integers(0, dim * dim, 500))
+        removed = np.zeros(len(cells), dtype=np.int64)
+
+        assert_same_results(run_variants(kernels.classify_cells, (m, lut, extend, cells, removed)))
+
+def flood_args(dim, seed):
+    rng = np.random.default_rng(seed)
+    hmatrix = rng.integers(0, 256, (dim, dim)).astype(np.uint8)
+    fractions = rng.random((dim, dim))
+    seeds = np.zeros((dim, dim), dtype=bool)
+    seeds[:, :3] = True
+
+    return (hmatrix, fractions, seeds,
+        np.full((dim, dim), -1, dtype=np.int16), np.zeros((dim, dim), dtype=np.int32))
+
+@requires_jit
+def test_priority_flood():
+    results = []
+
+    for name in BACKENDS:
+        backend.set_backend(name)
+        args = flood_args(64, 3)
+        results.append((kernels.priority_flood(*args), args))
+
+    assert_same_results(results)
+
+@requires_jit
+@pytest.mark.parametrize("keep", (False, True))
+def test_trace_rivers(keep):
+    dim = 64
+    rng = np.random.default_rng(4)
+    args = flood_args(dim, 4)
+    kernels.priority_flood(*args)
+    order = FlowField(args[4]).order
+    smatrix = args[2].astype(np.uint8)
+    (ys, xs) = np.divmod(rng.choice(np.arange(dim * dim)[~smatrix.ravel().astype(bool)], 40,
+        replace=False), dim)
+    ids = np.arange(1, len(xs) + 1, dtype=np.int64)
+    results = []
+
+    for name in BACKENDS:
+        backend.set_backend(name)
+        out = (
+            np.zeros((dim, dim), dtype=np.uint8),
+            np.full((dim, dim), FlowField.NO_DIRECTION, dtype=np.uint8),
+            np.zeros((dim, dim), dtype=np.uint8),
+            np.zeros(len(ids), dtype=np.bool_),
+            np.zeros(dim * dim * 4, dtype=np.int64),
+            np.zeros(len(ids), dtype=np.int64)
+        )
+        (matrix, steps, occupancy, ok, path, path_ends) = out
+        i = kernels.trace_rivers(
+            matrix, smatrix, order, steps, occupancy, xs, ys, ids, ok, keep, path, path_ends, 0)
+        results.append((i, out))
+
+    assert results[0][0] == len(ids)
+    assert results[0][1][3].any()
+    assert_same_results(results)
@@ -0,0 +1,91 @@
+""" CitySet queries must equal scans over all cities (or pairs of them),
+also after cities are added and removed in place.
+"""
+
+import itertools
+
+import numpy as np
+import pytest
+
+from juice.city import CitySet
+
+def make_cityset(n, dim, seed):
+    rng = np.random.default_rng(seed)
+    cells = rng.choice(dim * dim, n, replace=False)
+
+    return CitySet(cells % dim, cells // dim)
+
+def get_distances(cityset, x, y):
+    return np.hypot(cityset.xs - x, cityset.ys - y)
+
+def thin_pairwise(cityset, d):
+    coords = cityset.get_coords()
+    keep = np.ones(len(cityset), dtype=bool)
+
+    for (i, j) in itertools.combinations(range(len(cityset)), 2):
+        if (keep[i] and np.hypot(*(coords[i] - coords[j])) <= d):
+            keep[j] = False
+
+    return keep
+
+def assert_queries(cityset, rng, dim):
+    coords = cityset.get_coords()
+    order = np.lexsort((coords[:, 0], coords[:, 1]))
+
+    np.testing.assert_array_equal(order, np.arange(len(cityset)))
+
+    for (i, (x, y)) in enumerate(coords.tolist()):
+        assert cityset.find(x, y) == i
+        assert (cityset[i].x, cityset[i].y) == (x, y)
+
+    for i in range(30):
+        (x, y) = rng.integers(-5, dim + 5, 2).tolist()
+        r = rng.random() * dim / 4
+        (w, h) = rng.integers(0, dim // 2, 2).tolist()
+        dists = get_distances(cityset, x, y)
+        inside = (coords[:, 0] >= x) & (coords[:, 0] < x + w) & (coords[:, 1] >= y) & (coords[:, 1] < y + h)
+
+        np.testing.assert_array_equal(cityset.within(x, y, r), np.flatnonzero(dists <= r))
+        np.testing.assert_array_equal(cityset.in_rect(x, y, w, h), np.flatnonzero(inside))
+        np.testing.assert_allclose(dists[cityset.nearest(x, y, 5)], np.sort(dists)[:5])
+        assert cityset.find(x, y) == (coords.tolist().index([x, y]) if [x, y] in coords.tolist() else -1)
+
+@pytest.mark.parametrize("d", (3, 7.5, 20))
+def test_thin(d):
+    cityset = make_cityset(300, 100, 1)
+    np.testing.assert_array_equal(cityset.thin(d), thin_pairwise(cityset, d))
+
+def test_queries():
+    rng = np.random.default_rng(2)
+    cityset = make_cityset(200, 80, 2)
+    assert_queries(cityset, rng, 80)
+
+def test_add_remove():
+    rng = np.random.default_rng(3)
+    cityset = make_cityset(100, 60, 3)
+    coords = set(map(tuple, cityset.get_coords().tolist()))
+
+    # Query first, so that the spatial indices exist before the changes
+
+    assert_queries(cityset, rng, 60)
+
+    for i in range(60):
+        (x, y) = rng.integers(0, 70, 2).tolist()
+
+        if ((x, y) in coords):
+            assert cityset.remove(x, y) >= 0
+            coords.remove((x, y))
+        else:
+            assert cityset.add(x, y) == cityset.find(x, y)
+            coords.add((x, y))
+
+        assert cityset.remove(-1, 0) == -1
+
+    assert set(map(tuple, cityset.get_coords().tolist())) == coords
+    assert_queries(cityset, rng, 70)
+
+def test_delaunay_collinear():
+    cityset = CitySet([0, 3, 6, 9], [2, 2, 2, 2])
+    edges = cityset.delaunay_edges()
+
+    np.testing.assert_array_equal(edges, list(itertools.combinations(range(4), 2)))
@@ -0,0 +1,88 @@
+""" City fields must equal the kernels summed around every city, masked,
+also after cities are added and removed in place.
+"""
+
+import numpy as np
+import pytest
+
+from juice.terrainlayer import SeaLayer, RiverLayer, DeltaLayer, BiomeLayer, CityLayer
+
+from tests.common import get_terrain
+
+LAYERS = (SeaLayer, RiverLayer, DeltaLayer, BiomeLayer, CityLayer)
+
+@pytest.fixture
+def terrain():
+    return get_terrain(64, 1, LAYERS)
+
+def sum_kernels(clayer, name):
+
+    """ Return a field by adding its kernel around each city in turn. """
+
+    terrain = clayer.terrain
+    spec = clayer.field_specs[name]
+    r = spec.kernel.shape[0] // 2
+    field = np.zeros((terrain.dim + 2 * r, terrain.dim + 2 * r))
+
+    for (y, x) in np.argwhere(clayer.matrix):
+        field[y:y + 2 * r + 1, x:x + 2 * r + 1] += spec.kernel
+
+    field = field[r:-r, r:-r]
+
+    for ltype in spec.masks:
+        field[terrain.get_layer_by_type(ltype).matrix != 0] = 0.0
+
+    return field
+
+def assert_fields(clayer):
+    for name in clayer.field_specs:
+        np.testing.assert_allclose(clayer.get_field(name), sum_kernels(clayer, name), atol=1e-9)
+
+    (ys, xs) = np.nonzero(clayer.matrix)
+    np.testing.assert_array_equal(clayer.cities.get_coords(), np.stack((xs, ys), axis=1))
+
+def test_fields(terrain):
+    clayer = terrain.get_layer_by_type(CityLayer)
+
+    assert len(clayer.cities)
+    assert_fields(clayer)
+
+def test_add_remove(terrain):
+    clayer = terrain.get_layer_by_type(CityLayer)
+    water = \
+        (terrain.get_layer_by_type(SeaLayer).matrix != 0) | \
+        (terrain.get_layer_by_type(RiverLayer).matrix != 0)
+    rng = np.random.default_rng(1)
+
+    # Compute the fields first, so that they are updated in place
+
+    assert_fields(clayer)
+
+    for (y, x) in np.argwhere(~water)[rng.choice(np.count_nonzero(~water), 20, replace=False)]:
+        clayer.add_city(int(x), int(y))
+
+    for (y, x) in np.argwhere(clayer.matrix)[::3]:
+        clayer.remove_city(int(x), int(y))
+
+    assert_fields(clayer)
+
+    (y, x) = np.argwhere(water)[0]
+
+    with pytest.raises(ValueError):
+        clayer.add_city(int(x), int(y))
+    with pytest.raises(ValueError):
+        clayer.add_city(terrain.dim, 0)
+
+def test_replaced_matrix(terrain):
+    clayer = terrain.get_layer_by_type(CityLayer)
+    assert_fields(clayer)
+
+    matrix = clayer.matrix.copy()
+    (ys, xs) = np.nonzero(matrix)
+    matrix[ys[::2], xs[::2]] = 0
+    clayer.matrix = matrix
+
+    assert matrix.any()
+
+    for name in clayer.field_specs:
+        np.testing.assert_allclose(clayer.get_field(name), sum_kernels(clayer, name), atol=1e-9)
@@ -0,0 +1,42 @@
+""" FlowField rankings and receivers must equal those found by examining
+every tile's neighbors in turn.
+"""
+
+import numpy as np
+import pytest
+
+from juice.flowfield import FlowField
+from juice.kernels import DX, DY
+
+def rank_tile(keys, x, y):
+
+    """ Return the directions from (x, y) sorted by neighbor key, off-map
+    neighbors last and ties by direction.
+    """
+
+    (dim_y, dim_x) = keys.shape
+    ranked = []
+
+    for (d, (dx, dy)) in enumerate(zip(DX, DY)):
+        (nx, ny) = (x + dx, y + dy)
+        inside = (nx >= 0 and ny >= 0 and nx < dim_x and ny < dim_y)
+        ranked.append((keys[ny, nx] if inside else np.inf, d))
+
+    return [d for (k, d) in sorted(ranked)]
+
+@pytest.mark.parametrize("integer", (False, True))
+def test_flowfield(integer, monkeypatch):
+    monkeypatch.setattr(FlowField, "CHUNK_ROWS", 5)
+    rng = np.random.default_rng(5)
+    keys = rng.integers(0, 8, (23, 31)) if integer else rng.random((23, 31))
+    flowfield = FlowField(keys)
+    (dim_y, dim_x) = keys.shape
+
+    for y in range(dim_y):
+        for x in range(dim_x):
+            ranked = rank_tile(keys, x, y)
+            (dx, dy) = (DX[ranked[0]], DY[ranked[0]])
+            lower = (0 <= x + dx < dim_x and 0 <= y + dy < dim_y and keys[y + dy, x + dx] < keys[y, x])
+
+            assert [FlowField.get_direction(flowfield.order[y, x], r) for r in range(4)] == ranked
+            assert flowfield.receivers[y, x] == (ranked[0] if lower else FlowField.NO_DIRECTION)
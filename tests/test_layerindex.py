@@ -0,0 +1,75 @@
+""" LayerIndex queries must equal counts, sums and tests by slicing the
+layer's matrix, however it was changed.
+"""
+
+import numpy as np
+
+from juice.gamefieldlayer import GameFieldLayer
+from juice.layerindex import LayerIndex
+
+VALUES = (1, 3)
+
+def make_layer(dim, seed):
+    rng = np.random.default_rng(seed)
+    matrix = np.where(rng.random((dim, dim)) < 0.7, 0, rng.integers(1, 5, (dim, dim)))
+
+    return GameFieldLayer(matrix.astype(np.uint8))
+
+def assert_queries(layer, index, rng, n=50):
+    m = layer.matrix
+    dim = m.shape[0]
+
+    for i in range(n):
+        (x, y) = rng.integers(-4, dim, 2)
+        (w, h) = rng.integers(0, dim // 2, 2)
+        window = m[max(y, 0):max(y + h, 0), max(x, 0):max(x + w, 0)]
+
+        assert index.count(x, y, w, h) == np.count_nonzero(window)
+        assert index.sum(x, y, w, h) == int(window.sum(dtype=np.int64))
+        assert index.any(x, y, w, h) == bool(window.any())
+
+        for v in VALUES:
+            assert index.count(x, y, w, h, v) == np.count_nonzero(window == v)
+
+def test_assignments():
+    rng = np.random.default_rng(1)
+    layer = make_layer(67, 1)
+    index = layer.build_index(VALUES)
+
+    # Interleave writes and queries, pending corrections growing beyond
+    # PENDING_LIMIT between queries at times
+
+    for batch in (10, LayerIndex.PENDING_LIMIT * 3, 1, LayerIndex.PENDING_LIMIT + 5):
+        for i in range(batch):
+            (x, y) = rng.integers(0, 67, 2).tolist()
+            layer[x, y] = int(rng.integers(0, 5))
+
+        assert_queries(layer, index, rng)
+
+def test_refresh():
+    rng = np.random.default_rng(2)
+    layer = make_layer(64, 2)
+    index = layer.build_index(VALUES)
+
+    for i in range(6):
+        (x, y) = rng.integers(0, 48, 2)
+        layer.matrix[y:y+16, x:x+16] = rng.integers(0, 5, (16, 16))
+        index.refresh(x, y, 16, 16)
+
+        assert_queries(layer, index, rng)
+
+    layer.matrix = make_layer(64, 3).matrix
+    assert_queries(layer, index, rng)
+
+def test_occupied_blocks():
+    layer = make_layer(50, 4)
+    index = layer.build_index()
+    layer[49, 49] = 2
+    layer[0, 0] = 0
+
+    for level in range(4):
+        bdim = 1 << level
+        m = np.pad(layer.matrix, ((0, -50 % bdim), (0, -50 % bdim)))
+        blocks = m.reshape(m.shape[0] // bdim, bdim, -1, bdim).any(axis=(1, 3))
+
+        np.testing.assert_array_equal(index.get_occupied_blocks(level), blocks)
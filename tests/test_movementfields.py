@@ -0,0 +1,104 @@
+""" Movement fields must hold the costs of exact searches from every tile
+to its nearest target, and steps along them must lead there at those
+costs; the cache must follow changes to the roads.
+"""
+
+import numpy as np
+import pytest
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from juice.kernels import NO_DIRECTION
+from juice.terrainlayer import CityLayer, RoadLayer
+
+from tests.common import get_terrain
+
+@pytest.fixture(params=((128, 7), (256, 1)), ids=str)
+def rlayer(request):
+    return get_terrain(*request.param).get_layer_by_type(RoadLayer)
+
+def get_graph(rlayer):
+
+    """ Return the movement graph of the whole map, with road costs. """
+
+    terrain = rlayer.terrain
+    dim = terrain.dim
+    (src, dst, costs) = rlayer.get_grid_edges()
+    costs = np.where(rlayer.matrix.flat[dst] > 0, terrain.MP_ROAD, costs)
+
+    return scipy.sparse.csr_matrix((costs, (src, dst)), shape=(dim * dim, dim * dim))
+
+def assert_field(rlayer, field, targets):
+    dim = rlayer.terrain.dim
+    graph = get_graph(rlayer)
+    flat = np.array([y * dim + x for (x, y) in targets])
+
+    # Costs to the nearest target by searching the reversed graph
+
+    exact = scipy.sparse.csgraph.dijkstra(graph.T, indices=flat, min_only=True).reshape(dim, dim)
+    np.testing.assert_allclose(field.costs, exact, rtol=1e-9)
+
+    # Each step costs what it saves, ending at a target
+
+    moving = field.directions != NO_DIRECTION
+    at_target = np.zeros((dim, dim), dtype=bool)
+    at_target.flat[flat] = True
+
+    np.testing.assert_array_equal(moving, np.isfinite(exact) & ~at_target)
+
+    (ys, xs) = np.nonzero(moving)
+    (nxs, nys) = field.next_steps(xs, ys)
+    steps = np.asarray(graph[ys * dim + xs, nys * dim + nxs]).ravel()
+
+    np.testing.assert_allclose(field.costs[ys, xs], steps + field.costs[nys, nxs], rtol=1e-9)
+
+    for i in np.linspace(0, len(xs) - 1, 20).astype(int).tolist():
+        assert field.next_step(xs[i], ys[i]) == (nxs[i], nys[i])
+
+    assert field.next_step(*targets[0]) is None
+
+def get_targets(rlayer, n, seed):
+    coords = rlayer.terrain.get_layer_by_type(CityLayer).cities.get_coords()
+    rng = np.random.default_rng(seed)
+
+    return [tuple(c) for c in coords[rng.choice(len(coords), n, replace=False)].tolist()]
+
+@pytest.mark.parametrize("n", (1, 5))
+def test_fields(rlayer, n):
+    targets = get_targets(rlayer, n, n)
+    field = rlayer.get_movement_fields().get(targets)
+
+    assert_field(rlayer, field, targets)
+
+def test_cache(rlayer):
+    fields = rlayer.get_movement_fields()
+    fields.capacity = 2
+    (a, b, c) = (get_targets(rlayer, 3, seed) for seed in range(3))
+    field = fields.get(a)
+
+    assert fields.get(a[::-1] + a[:1]) is field
+
+    fields.get(b)
+    fields.get(a)
+    fields.get(c)
+
+    # The least recently used field was dropped
+
+    assert fields.get(a) is field
+    assert fields.get(b) is not None and len(fields._cache) == 2
+
+    # Roads changed in place or replaced
+
+    cities = rlayer.terrain.get_layer_by_type(CityLayer).cities
+    off_roads = np.flatnonzero(rlayer.matrix[cities.ys, cities.xs] == 0)
+
+    assert any(rlayer.connect_city(int(cities.xs[i]), int(cities.ys[i])) for i in off_roads[:5])
+
+    updated = fields.get(a)
+
+    assert updated is not field
+    assert_field(rlayer, updated, a)
+
+    rlayer.matrix = rlayer.matrix.copy()
+
+    assert fields.get(a) is not updated
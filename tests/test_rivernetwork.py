@@ -0,0 +1,100 @@
+""" RiverNetwork topology must agree with the river layer and with
+tributary trees rebuilt by following parents one river at a time.
+"""
+
+import numpy as np
+import pytest
+
+from juice.terrainlayer import SeaLayer, RiverLayer
+
+from tests.common import get_terrain
+
+@pytest.fixture(params=((128, 11), (128, 7), (256, 2)), ids=str)
+def rivers(request):
+    terrain = get_terrain(*request.param, layers=(SeaLayer, RiverLayer))
+    rlayer = terrain.get_layer_by_type(RiverLayer)
+    smatrix = terrain.get_layer_by_type(SeaLayer).matrix
+
+    return (rlayer.matrix, smatrix, rlayer.network)
+
+def get_ancestors(network, r):
+    ancestors = []
+
+    while (network.parent[r]):
+        r = network.parent[r]
+        ancestors.append(r)
+
+    return ancestors
+
+def get_root(network, r):
+    ancestors = get_ancestors(network, r)
+    return ancestors[-1] if ancestors else r
+
+def get_strahler(network, r):
+
+    """ Strahler order by its definition: the river's own headwater is of
+    order 1, and joining a tributary of the same order raises it.
+    """
+
+    order = 1
+
+    for c in network.get_children(r).tolist():
+        c_order = get_strahler(network, c)
+        order = order + 1 if c_order == order else max(order, c_order)
+
+    return order
+
+def test_polylines(rivers):
+    (matrix, smatrix, network) = rivers
+    river_ids = np.unique(matrix[(matrix > 0) & (smatrix == 0)])
+
+    assert len(river_ids) > 10
+
+    for r in river_ids.tolist():
+        polyline = network.get_polyline(r)
+        (ys, xs) = np.nonzero((matrix == r) & (smatrix == 0))
+
+        assert sorted(map(tuple, polyline.tolist())) == sorted(zip(xs.tolist(), ys.tolist()))
+        assert (np.abs(np.diff(polyline, axis=0)).sum(axis=1) == 1).all()
+        assert network.get_length(r) == len(polyline)
+
+def test_confluences(rivers):
+    (matrix, smatrix, network) = rivers
+    tributaries = np.flatnonzero(network.parent)
+
+    assert len(tributaries)
+
+    for r in tributaries.tolist():
+        p = network.parent[r]
+        parent_line = network.get_polyline(p).tolist()
+        confluence = network.confluence[r].tolist()
+
+        assert p < r
+        assert confluence in parent_line
+        assert np.abs(network.get_polyline(r)[-1] - confluence).max() <= 1
+
+def test_topology(rivers):
+    (matrix, smatrix, network) = rivers
+    river_ids = np.unique(matrix[matrix > 0]).tolist()
+
+    for r in river_ids:
+        children = [c for c in river_ids if network.parent[c] == r]
+        upstream = [c for c in river_ids if c != r and r in get_ancestors(network, c)]
+        parent_line = network.get_polyline(r).tolist()
+        joins = [parent_line.index(network.confluence[c].tolist()) for c in network.get_children(r)]
+
+        assert sorted(network.get_children(r).tolist()) == children
+        assert joins == sorted(joins)
+        assert sorted(network.get_upstream(r).tolist()) == upstream
+        assert network.strahler[r] == get_strahler(network, r)
+
+        # Rivers drain to the delta of their root, a sea tile next to the end
+        # of the root's polyline
+
+        root = get_root(network, r)
+        (x, y) = network.get_delta(r)
+
+        assert network.mouth[r] == root
+        assert network.get_delta_mouth(x, y) == root
+        assert smatrix[y, x] > 0 and matrix[y, x] == root
+        assert np.abs(network.get_polyline(root)[-1] - (x, y)).sum() == 1
@@ -0,0 +1,189 @@
+""" Roads routed in parallel must equal roads routed serially with
+REROUTE_EXACT, for either search, and must not depend on the number of
+workers with the other modes. Edits must leave roads as cheap as exact
+searches over the whole grid find them, passable, connected and classified
+as by classifying the whole layer.
+"""
+
+import random
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from juice import backend
+from juice.terrainlayer import SeaLayer, CityLayer, RoadLayer
+
+from tests.common import get_terrain
+
+@pytest.fixture(autouse=True)
+def restore_workers():
+    workers = backend.get_workers()
+    yield
+    backend.set_workers(workers)
+
+def generate_roads(dim, seed, workers, **options):
+
+    """ Generate the roads of a terrain anew with RoadLayer options and
+    return the road matrix.
+    """
+
+    rlayer = get_terrain(dim, seed).get_layer_by_type(RoadLayer)
+
+    for (k, v) in options.items():
+        setattr(rlayer, k, v)
+
+    backend.set_workers(workers)
+    random.seed(seed)
+    rlayer.generate()
+
+    return rlayer.matrix
+
+@pytest.mark.parametrize("search", (RoadLayer.SEARCH_DIJKSTRA, RoadLayer.SEARCH_ASTAR))
+@pytest.mark.parametrize("planner", (RoadLayer.PLANNER_RANDOM, RoadLayer.PLANNER_NETWORK))
+def test_parallel_exact(search, planner):
+    serial = generate_roads(256, 1, 1, search=search, planner=planner)
+
+    assert serial.any()
+
+    for workers in (2, 3):
+        parallel = generate_roads(256, 1, workers, search=search, planner=planner, parallel_batch=6)
+        np.testing.assert_array_equal(parallel, serial)
+
+@pytest.mark.parametrize("search", (RoadLayer.SEARCH_DIJKSTRA, RoadLayer.SEARCH_ASTAR))
+@pytest.mark.parametrize("mode", (RoadLayer.REROUTE_COSTS, RoadLayer.REROUTE_NONE))
+def test_parallel_workers(search, mode):
+    options = dict(search=search, planner=RoadLayer.PLANNER_NETWORK, parallel_reroute=mode)
+    single = generate_roads(128, 7, 1, **options)
+
+    assert single.any()
+    np.testing.assert_array_equal(generate_roads(128, 7, 2, **options), single)
+
+def get_graph(rlayer, tiles=None):
+
+    """ Return the movement graph of the whole map, with road costs, or of
+    the tiles of a mask only.
+    """
+
+    terrain = rlayer.terrain
+    dim = terrain.dim
+    (src, dst, costs) = rlayer.get_grid_edges()
+    costs = np.where(rlayer.matrix.flat[dst] > 0, terrain.MP_ROAD, costs)
+
+    if (tiles is not None):
+        kept = tiles.flat[src] & tiles.flat[dst]
+        (src, dst, costs) = (src[kept], dst[kept], costs[kept])
+
+    return scipy.sparse.csr_matrix((costs, (src, dst)), shape=(dim * dim, dim * dim))
+
+def get_passable(rlayer):
+    return np.isfinite(rlayer.get_weightmap()) | (rlayer.matrix > 0)
+
+def assert_classified(rlayer):
+
+    """ The classification must equal that of the whole layer, which must
+    not remove any further tiles.
+    """
+
+    matrix = rlayer.matrix.copy()
+    full = rlayer._make_classifier().classify()
+
+    np.testing.assert_array_equal(rlayer.matrix, matrix)
+    np.testing.assert_array_equal(rlayer.classification.matrix, full.matrix)
+
+def test_connect_city():
+    rlayer = get_terrain(256, 1).get_layer_by_type(RoadLayer)
+    rlayer.local_radius = 256
+    cities = rlayer.terrain.get_layer_by_type(CityLayer).cities
+    dim = rlayer.terrain.dim
+    off_roads = np.flatnonzero(rlayer.matrix[cities.ys, cities.xs] == 0)[:6]
+    n_connected = 0
+
+    assert len(off_roads)
+
+    for (x, y) in cities.get_coords()[off_roads].tolist():
+        before = rlayer.matrix != 0
+        graph = get_graph(rlayer)
+        labels = ndi.label(get_passable(rlayer))[0]
+        reachable = (labels[before] == labels[y, x]).any()
+
+        assert rlayer.connect_city(x, y) == reachable
+        assert_classified(rlayer)
+
+        if (not reachable):
+            np.testing.assert_array_equal(rlayer.matrix != 0, before)
+            continue
+
+        # The cheapest road to any road, the new road tiles leading there
+
+        optimal = scipy.sparse.csgraph.dijkstra(graph, indices=y * dim + x)[before.ravel()].min()
+        new = (rlayer.matrix != 0) & ~before
+        rlayer.matrix[new] = 0
+        restricted = get_graph(rlayer, new | before)
+        rlayer.matrix[new] = 1
+        cost = scipy.sparse.csgraph.dijkstra(restricted, indices=y * dim + x)[before.ravel()].min()
+
+        assert new[y, x] and cost == pytest.approx(optimal)
+        n_connected += 1
+
+    assert n_connected
+
+def test_connect_city_limit():
+    rlayer = get_terrain(256, 1).get_layer_by_type(RoadLayer)
+    (rlayer.local_radius, rlayer.local_max_radius) = (2, 8)
+    before = rlayer.matrix.copy()
+    far = ndi.distance_transform_cdt(before == 0, metric="chessboard") > 12
+    (y, x) = np.argwhere(far & get_passable(rlayer))[0]
+
+    assert not rlayer.connect_city(int(x), int(y))
+    np.testing.assert_array_equal(rlayer.matrix, before)
+
+@pytest.mark.parametrize("dim,seed", ((128, 7), (256, 1)))
+def test_update_terrain(dim, seed):
+    terrain = get_terrain(dim, seed)
+    rlayer = terrain.get_layer_by_type(RoadLayer)
+    smatrix = terrain.get_layer_by_type(SeaLayer).matrix
+    rng = np.random.default_rng(seed)
+    roads = np.argwhere(rlayer.matrix[4:-4, 4:-4] != 0) + 4
+
+    for (y, x) in roads[rng.choice(len(roads), 4, replace=False)].tolist():
+        # Flood a rectangle across a road, whose ends around it were joined
+
+        (x0, y0, w, h) = (x - 1, y - 1, 3, 3)
+        before = rlayer.matrix != 0
+        flooded = np.zeros_like(before)
+        flooded[y0:y0 + h, x0:x0 + w] = True
+        rim = ndi.binary_dilation(flooded) & ~flooded & before
+        old_labels = ndi.label(before)[0]
+        joined = np.unique(old_labels[rim])
+
+        smatrix[flooded] = 1
+        n_removed = rlayer.update_terrain(x0, y0, w, h)
+        weights = rlayer._compute_weights((slice(None), slice(None)))
+        impassable = ~np.isfinite(weights)
+
+        # Weights as computed anew, no roads left on impassable tiles (river
+        # crossings stay passable)
+
+        np.testing.assert_array_equal(rlayer.get_weightmap(), weights)
+        assert rlayer._min_weight == weights.min()
+        assert n_removed == np.count_nonzero(before & flooded & impassable) > 0
+        assert not ((rlayer.matrix != 0) & impassable).any()
+        assert_classified(rlayer)
+
+        # Road ends which can still reach each other are connected; ends of
+        # one road are joined when they were before
+
+        roads_now = rlayer.matrix != 0
+        labels = ndi.label(roads_now)[0]
+        passable = ndi.label(get_passable(rlayer))[0]
+        ends = np.argwhere(rim & roads_now)
+
+        for label in joined.tolist():
+            group = ends[old_labels[ends[:, 0], ends[:, 1]] == label]
+
+            for (a, b) in zip(group[:-1].tolist(), group[1:].tolist()):
+                if (passable[tuple(a)] == passable[tuple(b)]):
+                    assert labels[tuple(a)] == labels[tuple(b)]
@@ -0,0 +1,121 @@
+""" RoadNetwork edges must cover the roads tile by tile, and its shortest
+paths and components must equal breadth-first searches over the road
+tiles; the network of a RoadLayer must be kept current as roads change.
+"""
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from juice.roadnetwork import RoadNetwork
+from juice.terrainlayer import CityLayer, RoadLayer
+
+from tests.common import get_terrain
+
+@pytest.fixture(params=((128, 7), (256, 1)), ids=str)
+def rlayer(request):
+    return get_terrain(*request.param).get_layer_by_type(RoadLayer)
+
+def get_tile_graph(roads):
+
+    """ Return the graph of edge neighboring road tiles, over flat
+    indices, with one directed edge per pair of neighbors.
+    """
+
+    (dim_y, dim_x) = roads.shape
+    (src, dst) = ([], [])
+
+    for (dy, dx) in ((0, 1), (1, 0)):
+        both = roads[:dim_y - dy, :dim_x - dx] & roads[dy:, dx:]
+        (ys, xs) = np.nonzero(both)
+        src.append(ys * dim_x + xs)
+        dst.append((ys + dy) * dim_x + xs + dx)
+
+    (src, dst) = (np.concatenate(src), np.concatenate(dst))
+    n = dim_y * dim_x
+
+    return scipy.sparse.csr_matrix((np.ones(len(src)), (src, dst)), shape=(n, n))
+
+def test_edges(rlayer):
+    network = rlayer.get_network()
+    roads = rlayer.matrix != 0
+    covered = np.zeros_like(roads)
+    cities = rlayer.terrain.get_layer_by_type(CityLayer).cities
+
+    assert len(network.edges)
+
+    for (i, (u, v)) in enumerate(network.edges.tolist()):
+        polyline = network.get_polyline(i)
+
+        assert polyline[0].tolist() == network.node_coords[u].tolist()
+        assert polyline[-1].tolist() == network.node_coords[v].tolist()
+        assert (np.abs(np.diff(polyline, axis=0)).sum(axis=1) == 1).all()
+        assert network.lengths[i] == len(polyline) - 1
+
+        covered[polyline[:, 1], polyline[:, 0]] = True
+
+    # Nodes without edges are isolated road tiles
+
+    covered[network.node_coords[:, 1], network.node_coords[:, 0]] = True
+    np.testing.assert_array_equal(covered, roads)
+
+    for (i, (x, y)) in enumerate(cities.get_coords().tolist()):
+        assert network.city_node[i] == network.get_node(x, y)
+        assert (network.city_node[i] >= 0) == roads[y, x]
+
+def test_shortest_paths(rlayer):
+    network = rlayer.get_network()
+    roads = rlayer.matrix != 0
+    dim = roads.shape[1]
+    graph = get_tile_graph(roads)
+    labels = ndi.label(roads)[0]
+    rng = np.random.default_rng(1)
+    nodes = rng.choice(len(network.node_coords), (60, 2))
+    tiles = network.node_coords[:, 1] * dim + network.node_coords[:, 0]
+    dists = scipy.sparse.csgraph.shortest_path(
+        graph, directed=False, unweighted=True, indices=tiles[nodes[:, 0]])
+
+    for (i, (u, v)) in enumerate(nodes.tolist()):
+        ((ux, uy), (vx, vy)) = network.node_coords[[u, v]].tolist()
+        (length, path) = network.get_shortest_path(u, v)
+
+        assert network.is_connected(u, v) == (labels[uy, ux] == labels[vy, vx])
+        assert length == dists[i, tiles[v]]
+
+        if (path is None):
+            continue
+
+        coords = network.get_path_coords(path)
+
+        assert coords[0].tolist() == [ux, uy] and coords[-1].tolist() == [vx, vy]
+        assert len(coords) - 1 == length
+        assert (np.abs(np.diff(coords, axis=0)).sum(axis=1) == 1).all()
+        assert roads[coords[:, 1], coords[:, 0]].all()
+
+def assert_current(rlayer):
+    cities = rlayer.terrain.get_layer_by_type(CityLayer).cities
+    rebuilt = RoadNetwork(rlayer.matrix, rlayer.classification, cities)
+
+    for k in ("node_coords", "edges", "coords", "city_node", "component"):
+        np.testing.assert_array_equal(getattr(rlayer.network, k), getattr(rebuilt, k), err_msg=k)
+
+def test_updates(rlayer):
+    cities = rlayer.terrain.get_layer_by_type(CityLayer).cities
+
+    # Built during generation
+
+    assert rlayer.network is not None
+    assert_current(rlayer)
+
+    (xs, ys) = (cities.xs, cities.ys)
+    off_roads = np.flatnonzero(rlayer.matrix[ys, xs] == 0)
+
+    assert len(off_roads)
+
+    connected = [i for i in off_roads[:5].tolist() if rlayer.connect_city(int(xs[i]), int(ys[i]))]
+
+    assert connected
+    assert (rlayer.network.city_node[connected] >= 0).all()
+    assert_current(rlayer)
@@ -0,0 +1,130 @@
+""" RouteService routes must cost no less than exact searches over the
+whole grid, refined paths mostly as much; the service must agree with a
+rebuilt one after updates and report unreachable tiles.
+"""
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from juice.routeservice import RouteService
+from juice.terrainlayer import RoadLayer
+
+from tests.common import get_terrain
+
+def get_graph(rlayer):
+
+    """ Return the movement graph of the whole map, with road costs. """
+
+    terrain = rlayer.terrain
+    dim = terrain.dim
+    (src, dst, costs) = rlayer.get_grid_edges()
+    costs = np.where(rlayer.matrix.flat[dst] > 0, terrain.MP_ROAD, costs)
+
+    return scipy.sparse.csr_matrix((costs, (src, dst)), shape=(dim * dim, dim * dim))
+
+def get_components(rlayer):
+    passable = np.isfinite(rlayer.get_weightmap()) | (rlayer.matrix > 0)
+    return ndi.label(passable)[0]
+
+def get_pairs(rlayer, n, seed):
+
+    """ Return n pairs of random tiles of the largest passable component. """
+
+    labels = get_components(rlayer)
+    largest = np.argmax(np.bincount(labels.ravel())[1:]) + 1
+    (ys, xs) = np.nonzero(labels == largest)
+    i = np.random.default_rng(seed).choice(len(xs), (n, 2))
+
+    return [(xs[a], ys[a], xs[b], ys[b]) for (a, b) in i.tolist()]
+
+def trace_exact(preds, dim, x, y):
+    path = []
+    i = y * dim + x
+
+    while (i >= 0):
+        path.append((i % dim, i // dim))
+        i = preds[i]
+
+    return np.array(path[::-1])
+
+@pytest.mark.parametrize("dim,seed,cluster_size", ((128, 7, 16), (128, 3, 32), (256, 1, 32)))
+def test_routes(dim, seed, cluster_size):
+    rlayer = get_terrain(dim, seed).get_layer_by_type(RoadLayer)
+    routes = RouteService(rlayer, cluster_size)
+    graph = get_graph(rlayer)
+    ratios = []
+
+    for (x0, y0, x1, y1) in get_pairs(rlayer, 60, seed):
+        (exact, preds) = scipy.sparse.csgraph.dijkstra(
+            graph, indices=y0 * dim + x0, return_predecessors=True)
+        optimal = exact[y1 * dim + x1]
+
+        # The path cost as computed by the service matches the search
+
+        np.testing.assert_allclose(routes.get_path_cost(trace_exact(preds, dim, x1, y1)), optimal)
+
+        (cost, waypoints) = routes.query(x0, y0, x1, y1)
+        path = routes.get_path(x0, y0, x1, y1)
+        (refined, refined_waypoints) = routes.query(x0, y0, x1, y1, refine=True)
+
+        assert cost >= optimal - 1e-9
+        assert refined == pytest.approx(routes.get_path_cost(path))
+        assert optimal - 1e-9 <= refined <= cost + 1e-9
+
+        for points in (waypoints, refined_waypoints, path):
+            assert points[0].tolist() == [x0, y0] and points[-1].tolist() == [x1, y1]
+
+        assert (np.abs(np.diff(path, axis=0)).sum(axis=1) == 1).all()
+        ratios.append(refined / optimal if optimal else 1.0)
+
+    assert np.mean(ratios) < 1.01
+    assert np.mean(np.isclose(ratios, 1.0)) >= 0.8
+
+def test_unreachable():
+    rlayer = get_terrain(128, 3).get_layer_by_type(RoadLayer)
+    routes = RouteService(rlayer, 16)
+    labels = get_components(rlayer)
+    sizes = np.bincount(labels.ravel())[1:]
+    (a, b) = np.argsort(sizes)[-2:] + 1
+    ((y0, x0), (y1, x1)) = (np.argwhere(labels == a)[0], np.argwhere(labels == b)[0])
+
+    assert routes.query(x0, y0, x1, y1) == (float("inf"), None)
+    assert routes.query(x0, y0, x1, y1, refine=True) == (float("inf"), None)
+    assert routes.get_path(x0, y0, x1, y1) is None
+
+def test_update():
+    rlayer = get_terrain(128, 7).get_layer_by_type(RoadLayer)
+    routes = RouteService(rlayer, 16)
+    pairs = get_pairs(rlayer, 30, 3)
+    passable = np.isfinite(rlayer.get_weightmap())
+
+    # Guide searches before the changes
+
+    routes.query(*pairs[0])
+
+    # A road inside a cluster, off its borders, then one across clusters
+
+    inside = passable & (rlayer.matrix == 0)
+    inside[np.arange(128) % 16 == 0] = False
+    inside[np.arange(128) % 16 == 15] = False
+    inside[:, np.arange(128) % 16 == 0] = False
+    inside[:, np.arange(128) % 16 == 15] = False
+    (ys, xs) = np.nonzero(inside)
+    new_roads = [(xs[:5], ys[:5]), tuple(routes.get_path(*pairs[1]).T)]
+
+    for (xs, ys) in new_roads:
+        rlayer.matrix[ys, xs] = 1
+        routes.update(xs, ys)
+
+    rebuilt = RouteService(rlayer, 16)
+
+    np.testing.assert_array_equal(routes._node_tiles, rebuilt._node_tiles)
+    np.testing.assert_array_equal(routes._road_dist, rebuilt._road_dist)
+    np.testing.assert_allclose(routes._costs, rebuilt._costs)
+
+    for pair in pairs:
+        assert routes.query(*pair)[0] == pytest.approx(rebuilt.query(*pair)[0])
+        np.testing.assert_array_equal(routes.get_path(*pair), rebuilt.get_path(*pair))
@@ -0,0 +1,181 @@
+""" Tile classification must equal matching the tilespecs tile by tile in
+full passes until no tile is removed, in either mode of convergence; the
+frontier mode must equal the full mode on the layers of a terrain.
+Reclassifying the edited tiles of a layer must equal classifying the whole
+layer again, and report exactly the tiles whose classification changed.
+"""
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+
+from juice.gamefieldlayer import GameFieldLayer
+from juice.terrainlayer import SeaLayer, RiverLayer, DeltaLayer, RoadLayer
+from juice.tileclassifier import TileClassifier, TileClassifierSolid, TileClassifierLine
+
+from tests.common import get_terrain
+
+MODES = (TileClassifier.MODE_FULL, TileClassifier.MODE_FRONTIER)
+
+def make_layer(dim, seed, sigma):
+
+    """ Return a GameFieldLayer of random blobs, thin for small sigma. """
+
+    rng = np.random.default_rng(seed)
+    noise = ndi.gaussian_filter(rng.random((dim, dim)), sigma)
+
+    return GameFieldLayer((noise > np.median(noise)).astype(np.uint8) * 3)
+
+def match_tile(cfier, tilespecs, nhood):
+
+    """ Return the tile type of a 3x3 boolean neighborhood by the first
+    tilespec matching it at any rotation, None to keep the tile as is, or
+    False if it is illegal.
+    """
+
+    solid_tt = getattr(cfier, "TT_SOLID", 0)
+
+    if (solid_tt and nhood.all()):
+        return solid_tt
+
+    for tilespec in tilespecs:
+        array = tilespec.array
+
+        for i in range(tilespec.rotations or 4):
+            if (all(v is None or v == n for (v, n) in zip(array.flat, nhood.flat))):
+                return None if tilespec.initial_tt is None else tilespec.initial_tt + i
+
+            array = np.rot90(array, -1)
+
+    return False
+
+def classify(cfier, values, rev, extend):
+
+    """ Classify a matrix of layer values tile by tile, returning the
+    classification and the layer with illegal tiles cleared.
+    """
+
+    values = values.copy()
+    m = np.where((values == 0) if rev else (values != 0), cfier.TT_NA, cfier.TT_EMPTY).astype(np.uint8)
+    (dim_y, dim_x) = m.shape
+
+    while (True):
+        n = 0
+
+        for tilespecs in cfier.TILESPECS:
+            ext = np.pad(m != 0, 1, mode="edge" if extend else "constant")
+            before = m.copy()
+
+            for (y, x) in np.argwhere(before != 0).tolist():
+                tt = match_tile(cfier, tilespecs, ext[y:y + 3, x:x + 3])
+
+                if (tt is False):
+                    m[y, x] = cfier.TT_EMPTY
+                    values[y, x] = 0xFE if rev else 0
+                    n += 1
+                elif (tt is not None):
+                    m[y, x] = tt
+
+        if (n == 0):
+            return (m, values)
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("rev,extend", ((False, True), (True, True), (False, False)))
+@pytest.mark.parametrize("cls,sigma", ((TileClassifierSolid, 2.5), (TileClassifierLine, 0.7)))
+def test_classify(cls, sigma, rev, extend, mode):
+    for seed in range(3):
+        flayer = make_layer(40, seed, sigma)
+        (expected, values) = classify(cls, flayer.matrix, rev, extend)
+        cfier = cls(flayer, rev=rev, extend=extend, mode=mode)
+
+        # Examine frontiers however large
+
+        cfier.FRONTIER_COST = 0
+        classification = cfier.classify()
+
+        np.testing.assert_array_equal(classification.matrix, expected)
+        np.testing.assert_array_equal(flayer.matrix, values)
+
+        if (mode == TileClassifier.MODE_FRONTIER and cfier.passes > 2):
+            assert cfier.cells_touched < cfier.passes * len(cls.TILESPECS) * flayer.matrix.size
+
+@pytest.mark.parametrize("cls", (SeaLayer, RiverLayer, RoadLayer))
+def test_modes(cls):
+    tlayer = get_terrain(256, 1).get_layer_by_type(cls)
+    rng = np.random.default_rng(1)
+    matrix = tlayer.matrix.copy()
+
+    # Flip scattered tiles for slivers and stubs to remove
+
+    flips = rng.random(matrix.shape) < 0.02
+    matrix[flips] = np.where(matrix[flips] == 0, 1, 0)
+    results = []
+
+    for mode in MODES:
+        tlayer.matrix = matrix.copy()
+        tlayer.classify_mode = mode
+        cfier = tlayer._make_classifier()
+        cfier.FRONTIER_COST = 0
+        results.append((cfier.classify().matrix, tlayer.matrix))
+
+    for (full, frontier) in zip(*results):
+        np.testing.assert_array_equal(frontier, full)
+
+def edit_layer(tlayer, rng, values, n_scattered):
+
+    """ Set the tiles of an 8 x 8 rectangle around a random nonzero tile of
+    a layer and of n_scattered random tiles to random values, returning the
+    rectangle's corner (x, y) and the arrays (xs, ys) of the edited tiles.
+    """
+
+    (dim_y, dim_x) = tlayer.matrix.shape
+    tiles = np.argwhere(tlayer.matrix != 0)
+    (y, x) = (tiles[rng.integers(len(tiles))] - 4).tolist()
+    (ys, xs) = np.mgrid[max(y, 0):min(y + 8, dim_y), max(x, 0):min(x + 8, dim_x)].reshape(2, -1)
+    xs = np.concatenate((xs, rng.integers(0, dim_x, n_scattered)))
+    ys = np.concatenate((ys, rng.integers(0, dim_y, n_scattered)))
+    tlayer.matrix[ys, xs] = rng.choice(values, len(xs))
+
+    return (x, y, xs, ys)
+
+@pytest.mark.parametrize("cls,values", (
+    (SeaLayer, (0, 1)),
+    (RiverLayer, (0, 0, 1)),
+    (RoadLayer, (0, 0, 1)),
+    (DeltaLayer, (0, 0, 80, 81))
+))
+@pytest.mark.parametrize("dim,seed", ((128, 7), (256, 1)))
+def test_reclassify(cls, values, dim, seed):
+    tlayer = get_terrain(dim, seed).get_layer_by_type(cls)
+    rng = np.random.default_rng(seed)
+
+    # River tiles next to deltas keep the tile types leading into them (see
+    # DeltaLayer.generate), which classifying the whole layer would change
+
+    tlayer.classification = tlayer._make_classifier().classify()
+
+    for i in range(6):
+        before = tlayer.classification.matrix.copy()
+        (x, y, xs, ys) = edit_layer(tlayer, rng, values, 40 * (i % 2))
+        edited = tlayer.matrix.copy()
+
+        # Classify a copy of the edited layer as a whole
+
+        tlayer.matrix = edited.copy()
+        full = tlayer._make_classifier().classify()
+        classified = tlayer.matrix
+        tlayer.matrix = edited
+
+        if (i % 2):
+            (xs, ys) = tlayer.reclassify(xs, ys)
+        else:
+            (xs, ys) = tlayer.reclassify_rect(x, y, 8, 8)
+
+        np.testing.assert_array_equal(tlayer.classification.matrix, full.matrix)
+        np.testing.assert_array_equal(tlayer.matrix, classified)
+
+        changed = np.zeros(before.shape, dtype=bool)
+        changed[ys, xs] = True
+
+        assert len(xs) == np.count_nonzero(changed)
+        np.testing.assert_array_equal(changed, tlayer.classification.matrix != before)
@@ -0,0 +1,112 @@
+""" Viewsheds must equal a line of sight walked tile by tile along each ray
+from the observer, over the whole map and at its edges; the cache must
+follow the heightmap.
+"""
+
+import numpy as np
+import pytest
+
+from tests.common import get_terrain
+
+@pytest.fixture(scope="module")
+def terrain():
+    return get_terrain(128, 7)
+
+def get_visible(hmatrix, x, y, radius, height):
+
+    """ Return the visible tiles of an observer as a boolean matrix of the
+    map, walking the rays one tile at a time: a tile within radius is
+    visible if its slope from the observer is at least that of every tile
+    before it on some ray, and rays stop at the edge of the map.
+    """
+
+    (dim_y, dim_x) = hmatrix.shape
+    visible = np.zeros((dim_y, dim_x), dtype=bool)
+    visible[y, x] = True
+    h0 = np.float32(float(hmatrix[y, x]) + height)
+    r = radius
+    ends = [(e, -r) for e in range(-r, r)] + [(r, e) for e in range(-r, r)] + \
+        [(-e, r) for e in range(-r, r)] + [(-r, -e) for e in range(-r, r)]
+
+    for (ex, ey) in ends:
+        steepest = -np.inf
+
+        for k in range(1, r + 1):
+            dx = int(np.rint(k / r * ex))
+            dy = int(np.rint(k / r * ey))
+            (tx, ty) = (x + dx, y + dy)
+
+            if (not (0 <= tx < dim_x and 0 <= ty < dim_y)):
+                break
+
+            dist = np.hypot(dx, dy)
+            slope = (np.float32(hmatrix[ty, tx]) - h0) * np.float32(1.0 / dist)
+
+            if (dist <= r and slope >= steepest):
+                visible[ty, tx] = True
+
+            steepest = max(steepest, slope)
+
+    return visible
+
+def get_full(terrain, x, y, radius, height):
+    (x0, y0, local) = terrain.viewshed.get(x, y, radius, height)
+    (h, w) = local.shape
+    full = np.zeros(terrain.heightmap.matrix.shape, dtype=bool)
+    full[y0:y0 + h, x0:x0 + w] = local
+
+    return full
+
+@pytest.mark.parametrize("x,y", ((64, 64), (3, 5), (126, 60), (0, 127), (20, 100)))
+@pytest.mark.parametrize("radius,height", ((1, 0), (9, 0), (16, 3)))
+def test_viewshed(terrain, x, y, radius, height):
+    expected = get_visible(terrain.heightmap.matrix, x, y, radius, height)
+
+    np.testing.assert_array_equal(get_full(terrain, x, y, radius, height), expected)
+
+def test_flat():
+    terrain = get_terrain(128, 7)
+    terrain.heightmap.matrix = np.full_like(terrain.heightmap.matrix, 10)
+    (ys, xs) = np.mgrid[:128, :128]
+
+    for (x, y) in ((64, 64), (2, 120)):
+        within = np.hypot(xs - x, ys - y) <= 12
+        np.testing.assert_array_equal(get_full(terrain, x, y, 12, 0), within)
+
+def test_mask(terrain):
+    observers = [(10, 10), (15, 12), (100, 40)]
+    expected = np.zeros_like(terrain.heightmap.matrix, dtype=bool)
+
+    for (x, y) in observers:
+        expected |= get_visible(terrain.heightmap.matrix, x, y, 8, 1)
+
+    np.testing.assert_array_equal(terrain.viewshed.get_mask(observers, 8, 1), expected)
+
+def test_cache():
+    terrain = get_terrain(128, 7)
+    viewshed = terrain.viewshed
+    viewshed.capacity = 2
+    entry = viewshed.get(30, 30, 8)
+
+    assert viewshed.get(30, 30, 8) is entry
+    assert viewshed.get(30, 30, 8, 1) is not entry
+
+    viewshed.get(40, 40, 8)
+
+    # The least recently used viewshed was dropped
+
+    assert viewshed.get(30, 30, 8, 1) is not None and len(viewshed._cache) == 2
+    assert viewshed.get(30, 30, 8) is not entry
+
+    # Edits in place are announced, replaced heightmaps are found
+
+    entry = viewshed.get(30, 30, 8)
+    terrain.heightmap.matrix[31, 31] = 255
+    viewshed.invalidate()
+    np.testing.assert_array_equal(
+        get_full(terrain, 30, 30, 8, 0), get_visible(terrain.heightmap.matrix, 30, 30, 8, 0))
+
+    entry = viewshed.get(30, 30, 8)
+    terrain.heightmap.matrix = terrain.heightmap.matrix.copy()
+
+    assert viewshed.get(30, 30, 8) is not entry